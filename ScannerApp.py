@@ -6,158 +6,249 @@ Standalone app
 
 #For the GUI
 import sys
+import time
+STARTED = time.perf_counter()
 import yaml
 import os
-
-import pyqtgraph as pg
-import numpy as np
-from time import sleep
 import asyncio
+import threading
 
 from PySide6 import QtWidgets
 from PySide6 import QtCore, QtGui
 from PySide6.QtWidgets import QApplication, QMainWindow, QLabel, QMessageBox, QWidget, QHBoxLayout, QVBoxLayout, QFormLayout, QLineEdit, QSpinBox, QPushButton
 from PySide6.QtCore import QTimer, QObject, QThread, Signal, Slot
 
+import logs
 import gui
 from gui import LineEdit, ScanEditor
-
-import numpy as np
+from snom import neaSNOM, create_snom, instrument_id, simulated, load_sdk, cached_dll_path
+from eventloop import EventLoopThread
+from session import Session
+from scanplan import ScanPlan
+import startup
+
+# numpy, pyqtgraph, h5py and the scan engine are imported by the startup.Preloader once the window shows,
+# the methods that need them import them locally
 import logging
 
-logger = logging.getLogger('logger')
-logger.setLevel(logging.DEBUG)
-if not logger.hasHandlers():
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-logger.info('Starting AutoScanApp')
-
-# import neaSDK
-try:
-    import nea_tools
-    offline_mode = False
-except:
-    logger.warning("nea_tools module not found, working in offline mode")
-    offline_mode = True
-
-class neaSNOM():
-    def __init__(self,path_to_dll,fingerprint):
-
-        self.name = None
-        self.connected = False
-        self.context = None
-        self.nea = None
-        self.scan_parameters = None
-
-    def connect(self,path_to_dll,fingerprint):
-        if "nea_tools" not in sys.modules:
-            print("nea_tools module was not found, missing SDK!")
-            return False
-
-        host = 'nea-server'
-    
-        loop = asyncio.get_event_loop()
-        try:
-            loop.run_until_complete(nea_tools.connect(host, fingerprint, path_to_dll))
-        except ConnectionError:
-            print("Could not connect!")
-            return False
-
-        try:
-            from neaspec import context
-            import Nea.Client.SharedDefinitions as nea
-
-            # global nea_tools
-            # import nea_tools
-
-            global scan
-            from nea_tools.logic import scan
-            # from nea_tools import database, plotter
-            # from nea_tools.utils.colors import COLORS,CMAPS
-            global approach_sample
-            from nea_tools.logic.approach import approach_sample
-
-        except ModuleNotFoundError:
-            raise ConnectionError('Connection refused or timeout. Retry to connect again.')
-        else:
-            self.connected = True
-
-            self.context = context
-            self.nea = nea
-
-            return True
-        
-    def spawn_parameters(self):
-        if self.connected:
-            self.scan_parameters = self.context.Logic.DefaultScanParameters.Spawn()
-
-    def close(self):
-        if self.connected:
-            logger.debug('\nDisconnecting from neaServer!')
-            nea_tools.disconnect()
-            self.connected = False
-        else:
-            logger.debug("SNOM was not connected!")
+logger = logging.getLogger('logger.ScannerApp')
 
 ## Worker class to handle computaionally heavy tasks in a separate thread
 class Worker(QObject):
+    """Runs the SNOM calls and scans as coroutines on its own long-lived asyncio loop
+
+    The slots only schedule work on the loop and return at once, results come back through the signals
+    """
 
     progress = Signal(str)
     finished = Signal()
     error = Signal(str)
-
-    parameters = {}
+    connection_changed = Signal(bool)
+    cube_created = Signal(str)
+    step_done = Signal(int, float)
+    started = Signal()
 
     def __init__(self, snom):
         super().__init__()
 
         self.snom = snom
-        self.newscan = None
+        self.output_dir = "data"
+        self.storage_settings = None
+        self.cost_model = None
+        self.cost_model_path = None
+        self.tracing_settings = None
+        self.processor = None
+        self.drift_settings = None
+        self.session_settings = None
+        self.session = None
+        self.metrics = None
+        self.remote = None
+        self.connect_span = None
+        self.loop_thread = EventLoopThread(name="WorkerLoop")
+        self.engine = None
+        # asyncio Task of the running measurement, only touched in the loop thread
+        self.task = None
+        self._running = False
+        # The GUI thread and remote clients on the loop thread both start measurements
+        self._start_lock = threading.Lock()
+        # Replaced as a whole by the GUI, a scan keeps the plan it was started with
+        self.plan = None
 
     def print_params(self):
-        logger.info("Current parameters: %s", self.parameters)
-
-    def create_measurement(self):
-        if self.parameters is not None:
+        logger.info("Current plan: %s", self.plan)
+
+    @property
+    def busy(self):
+        """True from the start of a measurement until its coroutine has finished its cleanup"""
+        return self._running
+
+    @property
+    def session_open(self):
+        """Connected, or trying to reconnect after a drop"""
+        return self.session is not None and not self.session.closed
+
+    def connect_snom(self, path_to_dll, fingerprint):
+        self.loop_thread.submit(self._connect(path_to_dll, fingerprint))
+
+    def disconnect_snom(self):
+        self.loop_thread.submit(self._disconnect())
+
+    def new_tracer(self):
+        from tracing import Tracer
+        tracer = Tracer(**(self.tracing_settings or {}))
+        if self.connect_span is not None:
+            tracer.record("connect", *self.connect_span)
+        return tracer
+
+    def _on_session_state(self, connected):
+        if not connected and self.session_open:
+            self.progress.emit("Connection lost, reconnecting...")
+        elif connected and self.session.reconnects:
+            self.progress.emit(f"Reconnected, {self.session.reconnects} reconnect(s) this session")
+        self.connection_changed.emit(connected)
+
+    async def _connect(self, path_to_dll, fingerprint):
+        from tracing import Tracer
+        self.session = Session(self.snom, path_to_dll, fingerprint, self.session_settings, on_state=self._on_session_state)
+        try:
+            with Tracer(enabled=False).span("connect") as span:
+                await self.session.connect()
+            self.connect_span = (span.start, span.duration)
+        except Exception as e:
+            logger.error("Connection failed: %s", e)
+            self.error.emit(str(e))
+            self.connection_changed.emit(False)
+
+    async def _disconnect(self):
+        if self.busy and self.task is not None:
+            self.task.cancel()
+            # The scan stops the writer, the instrument and its cube before the session goes away
+            await asyncio.gather(self.task, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+        else:
+            self.snom.close()
+            self.connection_changed.emit(False)
+
+    def _resume(self, run_dir):
+        from stepscan import StepScan
+        self.engine = StepScan.from_run(self.snom, run_dir, storage_settings=self.storage_settings, progress=self.progress.emit,
+                                        on_cube=self.cube_created.emit, on_step=self.step_done.emit,
+                                        cost_model=self.cost_model, tracer=self.new_tracer(), processor=self.processor,
+                                        drift_settings=self.drift_settings)
+        return self.engine
+
+    def run_measurement(self, plan=None):
+        """Start a step scan of `plan`, the GUI's plan by default, False when a measurement is already running"""
+        from stepscan import StepScan
+        with self._start_lock:
+            if self.busy:
+                logger.warning("A measurement is already running")
+                return False
+            plan = plan if plan is not None else self.plan
+            logger.info("Starting measurement with %s", plan)
+            self.engine = StepScan(self.snom, plan.to_parameters(), output_dir=self.output_dir,
+                                   storage_settings=self.storage_settings, progress=self.progress.emit,
+                                   on_cube=self.cube_created.emit, on_step=self.step_done.emit,
+                                   cost_model=self.cost_model, tracer=self.new_tracer(),
+                                   processor=self.processor, drift_settings=self.drift_settings)
+            self._start(self._measure(self.engine, self._resume))
+        self.started.emit()
+        return True
+
+    def resume_run(self, run_dir):
+        with self._start_lock:
+            if self.busy:
+                logger.warning("A measurement is already running")
+                return False
+            logger.info("Resuming run %s", run_dir)
+            self._start(self._measure(self._resume(run_dir), self._resume))
+        self.started.emit()
+        return True
+
+    def run_queue(self, jobs):
+        from scanqueue import ScanQueue
+        with self._start_lock:
+            if self.busy:
+                logger.warning("A measurement is already running")
+                return False
+            logger.info("Starting queue of %d jobs", len(jobs))
+            self.engine = ScanQueue(self.snom, jobs, output_dir=self.output_dir,
+                                    storage_settings=self.storage_settings, progress=self.progress.emit,
+                                    on_cube=self.cube_created.emit, on_step=self.step_done.emit,
+                                    cost_model=self.cost_model, new_tracer=self.new_tracer,
+                                    processor=self.processor, session=self.session, drift_settings=self.drift_settings)
+            self._start(self._measure(self.engine))
+        self.started.emit()
+        return True
+
+    def _start(self, coroutine):
+        self._running = True
+        self.loop_thread.call(self._create_task, coroutine)
+
+    def _create_task(self, coroutine):
+        self.task = asyncio.ensure_future(coroutine)
+        self.task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        # Also reached by a task cancelled before it started, which never runs _measure's finally
+        self._running = False
+        self.finished.emit()
+
+    async def _measure(self, engine, resume=None):
+        try:
+            if resume is not None and self.session is not None:
+                await self.session.run(engine, resume)
+            else:
+                await engine.run()
+        except asyncio.CancelledError:
+            self.progress.emit("Measurement cancelled")
+        except Exception as e:
+            logger.error("Measurement failed: %s", e)
+            self.error.emit(str(e))
+        finally:
+            if self.cost_model is not None:
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, self.cost_model.save, self.cost_model_path)
+                except OSError as e:
+                    logger.error("Could not save cost model: %s", e)
+
+    def cancel_measurement(self):
+        if self.busy:
+            # Queued after the call that creates the task, so a measurement that was just started is cancelled too
+            self.loop_thread.call(self._cancel)
+
+    def _cancel(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    def pause_measurement(self):
+        if self.busy:
+            self.loop_thread.call(self.engine.pause)
+
+    def resume_measurement(self):
+        if self.busy:
+            self.loop_thread.call(self.engine.resume)
+
+    def shutdown(self):
+        self.cancel_measurement()
+        if self.remote is not None:
             try:
-                p = self.snom.context.Logic.DefaultScanParameters.Spawn()
-                return scan.Whitelight(Name = "Test Scan", 
-                                PhysicalOffsetX=self.parameters["scan"]["PhysicalOffsetX"], 
-                                PhysicalOffsetY=self.parameters["scan"]["PhysicalOffsetY"],
-                                PhysicalSizeX=self.parameters["scan"]["PhysicalSizeX"],
-                                PhysicalSizeY=self.parameters["scan"]["PhysicalSizeY"],
-                                TargetResolutionWidth=self.parameters["scan"]["TargetResolutionWidth"],
-                                TargetResolutionHeight=self.parameters["scan"]["TargetResolutionHeight"],
-                                Angle=self.parameters["scan"]["Angle"], 
-                                TargetMillisecondsPerPixel=self.parameters["scan"]["TargetMillisecondsPerPixel"],
-                                LaserSourceTargetWavelength=p.LaserSourceTargetWavelength,
-                                PhysicalRangeM=(665.5,665.5))
+                self.loop_thread.submit(self.remote.stop()).result(timeout=5.0)
             except Exception as e:
-                logger.error("Error creating scan object: %s", e)
-                return None
-        else:
-            logger.error("Could not configure scan object.")
-            return None
-
-    def run_measurement(self):
-        logger.info("Starting measurement with parameters: %s", self.parameters)
-        newscan = self.create_measurement()
-        if newscan is not None:
-            approach_sample(0.8)
-            with newscan as wl:
-                wl.scan()
-                logger.debug("Measurement started, waiting for scan to finish...")
-                wl.wait_for_scan()
-                logger.debug("Scan finished, downloading data...")
-                data = wl.data[f"M1A"]
-                logger.info(f"Data type: {type(data)}, Data shape: {np.shape(data)}")
-                np.savetxt("TestSave", data)
+                logger.error("Remote control did not stop: %s", e)
+        self.loop_thread.stop()
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.processor is not None:
+            self.processor.close()
+        from datacube import remove_discarded
+        remove_discarded(self.output_dir)
 
 class AutoScanApp(QMainWindow):
 
     offline_mode = False
+    modules_loaded = Signal()
 
     def __init__(self):
         super().__init__()
@@ -167,14 +258,33 @@ class AutoScanApp(QMainWindow):
         self.settings = None
         self.read_config()
         
-        # Create the worker thread
+        # Create the worker, it runs its own event loop thread
         self.worker = Worker(snom=None)
-        self.worker_thread = QThread()
-        self.worker.moveToThread(self.worker_thread)
-        self.worker_thread.start()
+        self.worker.output_dir = self.config.get('output_dir', 'data')
+        self.worker.storage_settings = self.config.get('storage')
+        self.worker.tracing_settings = self.config.get('tracing')
+        self.worker.session_settings = self.config.get('session')
+        self.worker.drift_settings = self.config.get('drift')
+
+        # Editor changes are collected and turned into one new plan when control returns to the event loop
+        self.plan = None
+        self.plan_error = None
+        self.plan_timer = QTimer(self)
+        self.plan_timer.setSingleShot(True)
+        self.plan_timer.setInterval(0)
+        self.plan_timer.timeout.connect(self.apply_plan)
 
         # Set up UI
         self.setup_ui()
+
+        # The heavy modules, the SDK and the cost model load in the background once the window shows
+        self.startup_settings = dict(startup.DEFAULT_SETTINGS)
+        self.startup_settings.update(self.config.get('startup') or {})
+        self.shown = False
+        self.preview = None
+        self.preloader = startup.Preloader(warmups=[("sdk", load_sdk), ("numpy", startup.warm_numpy), ("dll cache", self.cache_dll)],
+                                           on_done=self.modules_loaded.emit)
+        self.modules_loaded.connect(self.on_modules_loaded)
         
     def setup_ui(self):
 
@@ -197,43 +307,154 @@ class AutoScanApp(QMainWindow):
         self.connect_button.clicked.connect(self.connect_snom)
 
         self.start_measurement_button = QPushButton("Start Measurement")
-        self.start_measurement_button.clicked.connect(self.worker.run_measurement)
+        self.start_measurement_button.clicked.connect(self.start_measurement)
         self.start_measurement_button.setEnabled(False)
 
-        self.ifg_editor.edited.connect(self.on_parameters_changed)
-        self.ifg_editor.edited.emit(self.ifg_editor.parameters)
+        self.queue_button = QPushButton("Run Recipe...")
+        self.queue_button.clicked.connect(self.start_queue)
+        self.resume_button = QPushButton("Resume Run...")
+        self.resume_button.clicked.connect(self.resume_run)
+
+        self.control_widget = QWidget()
+        self.control_widget.setLayout(QHBoxLayout())
+        self.pause_button = QPushButton("Pause")
+        self.pause_button.setCheckable(True)
+        self.pause_button.toggled.connect(self.pause_measurement)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.worker.cancel_measurement)
+        self.control_widget.layout().addWidget(self.queue_button)
+        self.control_widget.layout().addWidget(self.resume_button)
+        self.control_widget.layout().addWidget(self.pause_button)
+        self.control_widget.layout().addWidget(self.cancel_button)
+        self.set_measurement_running(False)
+
+        self.status_label = QLabel("Loading...")
+
+        self.worker.progress.connect(self.status_label.setText)
+        self.worker.error.connect(self.on_worker_error)
+        self.worker.finished.connect(self.on_measurement_finished)
+        self.worker.connection_changed.connect(self.on_connection_changed)
+        self.worker.started.connect(self.on_measurement_started)
 
+        self.ifg_editor.edited.connect(self.on_parameters_changed)
         self.scan_editor.edited.connect(self.on_parameters_changed)
-        self.scan_editor.edited.emit(self.scan_editor.parameters)
+        self.apply_plan()
 
         mainlayout.addWidget(self.scan_editor)
         mainlayout.addWidget(self.ifg_editor)
         mainlayout.addWidget(self.info)
         mainlayout.addWidget(self.connect_widget)
         mainlayout.addWidget(self.start_measurement_button)
+        mainlayout.addWidget(self.control_widget)
+        mainlayout.addWidget(self.status_label)
+
+        controls = QWidget()
+        controls.setLayout(mainlayout)
 
         container = QWidget()
-        container.setLayout(mainlayout)
+        container.setLayout(QHBoxLayout())
+        container.layout().addWidget(controls)
+        self.preview_placeholder = QLabel("Loading preview...")
+        self.preview_placeholder.setAlignment(QtCore.Qt.AlignCenter)
+        container.layout().addWidget(self.preview_placeholder, 1)
         self.setCentralWidget(container)
 
-    def on_parameters_changed(self):
-        self.set_info_display()
-        self.send_parameters_to_worker()
-
-        logger.debug("Parameters changed, info display and worker parameters updated")
-
-    def set_info_display(self):
-        self.info.set_scan_parameters(self.scan_editor.parameters)
-        self.info.set_ifg_parameters(self.ifg_editor.parameters)
+    def showEvent(self, event):
+        super().showEvent(event)
+        if not self.shown:
+            self.shown = True
+            # Runs once the first frame is on screen
+            QTimer.singleShot(0, self.on_first_shown)
+
+    def on_first_shown(self):
+        startup.check_budget(time.perf_counter() - STARTED, self.startup_settings["budget"])
+        self.preloader.start()
+
+    def cache_dll(self):
+        if not simulated(self.config, self.offline_mode):
+            cached_dll_path(self.config['path_to_dll'], self.startup_settings['dll_cache'])
+
+    def ensure_loaded(self):
+        """Finish the background loading now, for actions that need the scan engine right away"""
+        if self.preview is None:
+            self.preloader.start()
+            self.preloader.wait()
+            self.on_modules_loaded()
+
+    def on_modules_loaded(self):
+        if self.preview is not None:
+            return
+        from preview import LivePreview
+        from processing import ProcessingEngine
+        from estimator import CostModel, MODEL_FILE
+        from checkpoint import find_unfinished
+        from metrics import Metrics
+        from remote import RemoteServer
+
+        self.worker.processor = ProcessingEngine(self.config.get('processing'))
+        self.worker.cost_model_path = os.path.join(os.path.dirname(os.path.abspath('config.yaml')), MODEL_FILE)
+        self.worker.cost_model = CostModel.load(self.worker.cost_model_path, self.instrument_id())
+        self.info.set_cost_model(self.worker.cost_model)
+        self.worker.metrics = Metrics(self.config.get('metrics'), self.instrument_id(),
+                                      engine=lambda: self.worker.engine, session=lambda: self.worker.session).start()
+        remote_settings = self.config.get('remote') or {}
+        if remote_settings.get('enabled'):
+            self.worker.remote = RemoteServer(self.worker, remote_settings)
+            # Direct connections hand the signals over in the emitting thread, the server moves them to its loop
+            for signal, slot in ((self.worker.progress, self.worker.remote.on_progress),
+                                 (self.worker.connection_changed, self.worker.remote.on_connection),
+                                 (self.worker.cube_created, self.worker.remote.on_cube),
+                                 (self.worker.step_done, self.worker.remote.on_step),
+                                 (self.worker.finished, self.worker.remote.on_finished),
+                                 (self.worker.error, self.worker.remote.on_error)):
+                signal.connect(slot, QtCore.Qt.DirectConnection)
+            self.worker.loop_thread.submit(self.worker.remote.start())
+
+        self.preview = LivePreview(self)
+        self.worker.cube_created.connect(self.preview.open_cube)
+        self.worker.step_done.connect(self.preview.step_done)
+        self.centralWidget().layout().replaceWidget(self.preview_placeholder, self.preview)
+        self.centralWidget().layout().setStretchFactor(self.preview, 1)
+        self.preview_placeholder.deleteLater()
+
+        self.status_label.setText("Idle")
+        unfinished = find_unfinished(self.worker.output_dir)
+        if unfinished:
+            self.status_label.setText(f"{len(unfinished)} interrupted run(s) in {self.worker.output_dir}, use Resume Run... to continue")
+        self.set_measurement_running(self.worker.busy)
+        logger.info("Ready after %.2f s", time.perf_counter() - STARTED)
 
-        logger.debug("Info display updated with current parameters")
+    def on_parameters_changed(self):
+        # Restarting the pending timer folds all edits of this event loop pass into one update
+        self.plan_timer.start()
 
-    def send_parameters_to_worker(self):
-        self.worker.parameters = {
-            'scan': self.scan_editor.parameters,
-            'ifg': self.ifg_editor.parameters
-        }
-        logger.info("Parameters sent to worker")
+    def apply_plan(self):
+        """Build a plan from the editors, update the info display and hand the worker the new snapshot"""
+        self.plan_timer.stop()
+        try:
+            plan = ScanPlan(self.scan_editor.parameters, self.ifg_editor.parameters)
+        except ValueError as e:
+            self.plan_error = str(e)
+            self.info.set_error(self.plan_error)
+            self.set_measurement_running(self.worker.busy)
+            return
+        changes = plan.diff(self.plan)
+        had_error, self.plan_error = self.plan_error, None
+        if not changes:
+            if had_error:
+                self.info.update_info()
+                self.set_measurement_running(self.worker.busy)
+            return
+        first = self.plan is None
+        self.plan = plan
+        self.worker.plan = plan
+        self.info.set_plan(plan)
+        if had_error:
+            self.set_measurement_running(self.worker.busy)
+        if first:
+            logger.debug("Scan plan: %s", plan)
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Scan plan changed: %s", ", ".join(f"{key} {old} -> {new}" for key, (new, old) in sorted(changes.items())))
 
     def check_snom_config(self):
         if (self.config['fingerprint'] == 'CHANGEMEE') or (self.config['path_to_dll'] == r"CHANGEMEE"):
@@ -258,60 +479,133 @@ class AutoScanApp(QMainWindow):
     def read_settings(self):
         with open('settings.yaml', 'r') as file:
             all_settings = yaml.safe_load(file)
-            print(all_settings)
+            logger.debug("Settings: %s", all_settings)
 
     def write_settings(self):
         with open('settings.yaml', 'w') as file:
-            yaml.dump([self.scan_editor.parameters, self.ifg_editor.parameters], file)
+            parameters = self.plan.to_parameters()
+            yaml.dump([parameters['scan'], parameters['ifg']], file)
+
+    def instrument_id(self):
+        return instrument_id(self.config, self.offline_mode)
+
+    def create_snom(self):
+        return create_snom(self.config, self.offline_mode)
 
     def connect_snom(self):
-        self.check_snom_config()
-        if self.offline_mode:
-            logger.warning("Working in offline mode, no SNOM connection")
-            return
+        if not simulated(self.config):
+            self.check_snom_config()
+        self.ensure_loaded()
+        from estimator import CostModel
+
+        self.connect_button.setEnabled(False)
+        # While the session reconnects on its own the button stops it
+        if not self.worker.session_open:
+            if self.worker.snom is None:
+                self.worker.snom = self.create_snom()
+                if self.worker.cost_model.instrument != self.instrument_id():
+                    self.worker.cost_model = CostModel.load(self.worker.cost_model_path, self.instrument_id())
+                    self.info.set_cost_model(self.worker.cost_model)
+                    self.worker.metrics.labels["instrument"] = self.instrument_id()
+            self.worker.connect_snom(self.config['path_to_dll'], self.config['fingerprint'])
         else:
-            if not self.snom_connected:
-                if self.worker.snom is None:
-                    self.worker.snom = neaSNOM(self.config['path_to_dll'], self.config['fingerprint'])
-                
-                if self.worker.snom.connect(self.config['path_to_dll'], self.config['fingerprint']):
-                    if self.worker.snom.connected == True:
-                        self.snom_connected = True
-                        self.connect_led.setChecked(True)
-                        self.connect_button.setText("Disconnect")
-                        logger.info("Connected to SNOM")
-                else:
-                    logger.error("Failed to connect to SNOM")
-                    self.connect_led.setChecked(False)
-                    self.connect_button.setText("Connect")
-                    QMessageBox.critical(self, "Connection Error", "Failed to connect to SNOM. Check your configuration.")
-            else:
-                self.worker.snom.close()
-                self.snom_connected = False
-                self.connect_led.setChecked(False)
-                self.connect_button.setText("Connect")
+            self.worker.disconnect_snom()
+
+    def on_connection_changed(self, connected):
+        if connected:
+            logger.info("Connected to SNOM")
+        elif not self.snom_connected and not self.worker.session_open:
+            logger.error("Failed to connect to SNOM")
+            QMessageBox.critical(self, "Connection Error", "Failed to connect to SNOM. Check your configuration.")
+        self.snom_connected = connected
+        self.connect_led.setChecked(connected)
+        self.connect_button.setText("Disconnect" if connected or self.worker.session_open else "Connect")
+        self.connect_button.setEnabled(True)
+        self.set_measurement_running(self.worker.busy)
+
+    def start_measurement(self):
+        # Edits still waiting for the timer belong to this scan
+        if self.plan_timer.isActive():
+            self.apply_plan()
+        if self.plan_error is not None:
+            QMessageBox.critical(self, "Parameter Error", self.plan_error)
+            return
+        self.set_measurement_running(True)
+        self.worker.run_measurement()
 
-            self.start_measurement_button.setEnabled(self.snom_connected)
+    def start_queue(self):
+        from scanqueue import load_recipe
+        path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Open scan recipe", "", "YAML files (*.yaml *.yml)")
+        if not path:
+            return
+        try:
+            jobs = load_recipe(path, defaults=self.plan.to_parameters())
+        except (OSError, yaml.YAMLError, KeyError, ValueError) as e:
+            QMessageBox.critical(self, "Recipe Error", f"Could not load recipe: {e}")
+            return
+        self.set_measurement_running(True)
+        self.worker.run_queue(jobs)
+
+    def resume_run(self):
+        from checkpoint import find_unfinished
+        unfinished = find_unfinished(self.worker.output_dir)
+        start = unfinished[0] if unfinished else self.worker.output_dir
+        run_dir = QtWidgets.QFileDialog.getExistingDirectory(self, "Resume interrupted run", start)
+        if not run_dir:
+            return
+        if os.path.abspath(run_dir) not in [os.path.abspath(path) for path in unfinished]:
+            QMessageBox.critical(self, "Resume Error", f"{run_dir} is not an interrupted run")
+            return
+        self.set_measurement_running(True)
+        self.worker.resume_run(run_dir)
 
+    def pause_measurement(self, paused):
+        if paused:
+            self.worker.pause_measurement()
+            self.pause_button.setText("Resume")
+        else:
+            self.worker.resume_measurement()
+            self.pause_button.setText("Pause")
+
+    def set_measurement_running(self, running):
+        self.start_measurement_button.setEnabled(self.snom_connected and not running and self.plan_error is None)
+        self.queue_button.setEnabled(self.snom_connected and not running)
+        self.resume_button.setEnabled(self.snom_connected and not running)
+        self.pause_button.setEnabled(running)
+        self.cancel_button.setEnabled(running)
+        if not running:
+            self.pause_button.setChecked(False)
+
+    def on_measurement_started(self):
+        # Measurements started by remote clients update the buttons too
+        self.set_measurement_running(True)
+
+    def on_measurement_finished(self):
+        self.set_measurement_running(False)
+        # The cost model was refitted with the timings of the run
+        self.info.update_info()
+
+    def on_worker_error(self, message):
+        self.status_label.setText(f"Error: {message}")
 
     def closeEvent(self, event):
         quit_msg = "Are you sure you want to exit the program?"
+        if self.worker.busy:
+            quit_msg += "\nThe running scan is stopped, it can be continued later with Resume Run..."
         reply = QtWidgets.QMessageBox.question(self, 'Message', quit_msg, QtWidgets.QMessageBox.Yes, QtWidgets.QMessageBox.No)
 
         if reply == QtWidgets.QMessageBox.Yes:
             event.accept()
 
+            self.worker.shutdown()
+            logger.info("Worker loop closed before program exit!")
+
             if self.worker.snom is not None:
                 try:
                     self.worker.snom.close()
                     logger.info("SNOM connection closed before program exit!")
                 except:
-                    logger.error(f'{self.worker.snom} could NOT be closed upon program exit!')
-
-            if self.worker_thread.isRunning():
-                self.worker_thread.quit()
-                self.worker_thread.wait()
-                logger.info("Worker thread closed before program exit!")
+                    logger.error('%s could NOT be closed upon program exit!', self.worker.snom)
             logger.info("Exiting AutoScanApp! Bye-bye!")
 
         else:
@@ -319,6 +613,9 @@ class AutoScanApp(QMainWindow):
 
 
 if __name__ == '__main__':
+    with open('config.yaml', 'r') as file:
+        logs.setup((yaml.safe_load(file) or {}).get('logging'))
+    logger.info('Starting AutoScanApp')
     app = QtWidgets.QApplication(sys.argv)
     ex = AutoScanApp()
     ex.show()
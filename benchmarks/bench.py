@@ -0,0 +1,329 @@
+"""
+Benchmark suite for the acquisition, storage, GUI update and startup paths
+Drives the step-scan engine against the simulated backend and keeps the results as JSON baselines
+
+    python benchmarks/bench.py                      # quick sweep, prints and saves results
+    python benchmarks/bench.py --full               # full sweep
+    python benchmarks/bench.py --save-baseline      # store the results as the new baseline
+    python benchmarks/bench.py --compare            # fail (exit 1) on regressions against the baseline
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import asyncio
+import argparse
+import datetime
+import platform
+import tempfile
+import threading
+import tracemalloc
+import itertools
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+import logging
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+import nea_sim
+import storage
+import logs
+from datacube import DataCube
+from stepscan import StepScan
+
+logger = logging.getLogger('logger')
+
+BASELINE_FILE = os.path.join(ROOT, "benchmarks", "baseline.json")
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+CHANNEL_NAMES = ("Z", "M1A", "O2A", "O2P", "O3A", "O3P", "O4A", "O4P")
+
+QUICK_SWEEP = {"grid": [32, 128], "points": [16], "channels": [1, 4]}
+FULL_SWEEP = {"grid": [32, 128, 512], "points": [16, 64], "channels": [1, 2, 4, 8]}
+LARGE_CUBE = {"grid": 1024, "points": 32, "channels": 2}
+
+# Higher is better for these metrics, lower for everything else
+HIGHER_IS_BETTER = ("pixels_per_s", "MB_per_s")
+
+
+def scan_parameters(grid, points):
+    return {"scan": {"PhysicalOffsetX": 50.0, "PhysicalOffsetY": 50.0, "PhysicalSizeX": 10.0, "PhysicalSizeY": 10.0,
+                     "TargetResolutionWidth": grid, "TargetResolutionHeight": grid, "Angle": 0.0,
+                     "TargetMillisecondsPerPixel": 9.8, "ScanMode": "WLI"},
+            "ifg": {"InterferometerCenter": 400.0, "InterferometerDistance": 800.0, "NumberOfPoints": points,
+                    "NumberOfSkippedPoints": 0, "StartPosition": 800.0, "EndPosition": 0.0}}
+
+
+def simulated_snom():
+    # No instrument time at all, the benchmark measures only our own pipeline
+    snom = nea_sim.SimulatedSNOM({"scan_duration": 0.0, "download_latency": 0.0, "seed": 0})
+    asyncio.run(snom.connect("", ""))
+    return snom
+
+
+def bench_engine(workdir, grid, points, channels):
+    return StepScan(simulated_snom(), scan_parameters(grid, points), output_dir=workdir, name="bench",
+                    channels=CHANNEL_NAMES[:channels], storage_settings={"format": "none"})
+
+
+def bench_acquisition(workdir, grid, points, channels):
+    """Throughput of a run with nothing else measured, memory tracing would slow it down"""
+    engine = bench_engine(workdir, grid, points, channels)
+    gc.collect()
+    start = time.perf_counter()
+    asyncio.run(engine.run())
+    elapsed = time.perf_counter() - start
+    pixels = grid * grid * points
+    return {"seconds": elapsed,
+            "pixels_per_s": pixels / elapsed,
+            "cube_MB": grid * grid * points * channels * engine.dtype.itemsize / 1e6}
+
+
+def resident_bytes():
+    """Resident memory of this process, with the mapped cube pages and the writer buffers, None when unknown"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def bench_memory(workdir, grid, points, channels, interval=0.005):
+    """Peak Python heap (tracemalloc) and peak growth of the resident memory during a separate, untimed run"""
+    engine = bench_engine(workdir, grid, points, channels)
+    gc.collect()
+    before = resident_bytes()
+    peak_rss = [before]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            peak_rss[0] = max(peak_rss[0], resident_bytes())
+    sampler = threading.Thread(target=sample, daemon=True) if before is not None else None
+    if sampler is not None:
+        sampler.start()
+    tracemalloc.start()
+    try:
+        asyncio.run(engine.run())
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        stop.set()
+        if sampler is not None:
+            sampler.join()
+    result = {"heap_peak_MB": peak / 1e6,
+              "cube_MB": grid * grid * points * channels * engine.dtype.itemsize / 1e6}
+    if before is not None:
+        result["rss_peak_MB"] = (max(peak_rss[0], resident_bytes()) - before) / 1e6
+    return result
+
+
+def bench_storage(workdir, grid, points, channels, compression):
+    positions = np.linspace(800.0, 0.0, points)
+    cube = DataCube.create(os.path.join(workdir, f"store_{grid}_{points}_{channels}"),
+                           CHANNEL_NAMES[:channels], positions, grid, grid)
+    rng = np.random.default_rng(0)
+    for step in range(points):
+        for channel in cube.channels:
+            cube.write_frame(channel, step, rng.normal(size=(grid, grid)))
+        cube.mark_done(step)
+    path = os.path.join(cube.path, f"result_{compression}.h5")
+    start = time.perf_counter()
+    storage.export_hdf5(cube, path, compression=compression)
+    elapsed = time.perf_counter() - start
+    result = {"seconds": elapsed, "MB_per_s": cube.data.nbytes / elapsed / 1e6,
+              "ratio": cube.data.nbytes / os.path.getsize(path)}
+    cube.discard()
+    return result
+
+
+def bench_gui_latency(repeats=50):
+    """Time from a keystroke in the ScanEditor to the InfoDisplay showing the new estimate"""
+    try:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PySide6 import QtWidgets, QtCore
+        from PySide6.QtTest import QTest
+    except ImportError:
+        return None
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        import ScannerApp
+        # Logged at DEBUG through the app's queue, so the cost the GUI thread pays is measured, but nothing is written
+        logs.setup({"console": False, "file": None}, level=logging.DEBUG)
+        app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+        window = ScannerApp.AutoScanApp()
+        edit = window.scan_editor.timeedit
+        latencies = []
+        for i in range(repeats):
+            edit.setText("9.8")
+            before = window.info.line1.text()
+            key = QtCore.Qt.Key_1 + (i % 8)
+            start = time.perf_counter()
+            QTest.keyClick(edit, key)
+            while window.info.line1.text() == before and time.perf_counter() - start < 1.0:
+                app.processEvents()
+            latencies.append(time.perf_counter() - start)
+        window.worker.shutdown()
+        window.deleteLater()
+    finally:
+        os.chdir(cwd)
+        logs.shutdown()
+        logger.setLevel(logging.WARNING)
+    latencies = np.asarray(latencies) * 1e3
+    return {"median_ms": float(np.median(latencies)), "p95_ms": float(np.percentile(latencies, 95))}
+
+
+STARTUP_SCRIPT = """
+import os, sys, time
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+from PySide6 import QtWidgets
+app = QtWidgets.QApplication(sys.argv)
+import ScannerApp
+window = ScannerApp.AutoScanApp()
+window.show()
+app.processEvents()
+print("shown", flush=True)
+while window.preview is None:
+    app.processEvents()
+    time.sleep(0.001)
+print("ready", flush=True)
+window.worker.shutdown()
+"""
+
+
+def bench_startup(repeats=3):
+    """Cold start of the GUI in a fresh interpreter: time to the shown window and to the loaded scan engine"""
+    try:
+        import PySide6
+    except ImportError:
+        return None
+    import subprocess
+    shown, ready = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-c", STARTUP_SCRIPT], cwd=ROOT, stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL, text=True)
+        for line in process.stdout:
+            if line.strip() == "shown":
+                shown.append(time.perf_counter() - start)
+            elif line.strip() == "ready":
+                ready.append(time.perf_counter() - start)
+        process.wait()
+    if not shown or not ready:
+        return None
+    return {"window_s": float(np.median(shown)), "ready_s": float(np.median(ready))}
+
+
+def run(sweep, large=True, gui=True):
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for grid, points, channels in itertools.product(sweep["grid"], sweep["points"], sweep["channels"]):
+            key = f"acquisition/grid{grid}_points{points}_ch{channels}"
+            results[key] = bench_acquisition(workdir, grid, points, channels)
+            logger.warning("%s: %.0f pixels/s", key, results[key]["pixels_per_s"])
+            for compression in (None, "lzf", "gzip"):
+                key = f"storage/{compression}/grid{grid}_points{points}_ch{channels}"
+                results[key] = bench_storage(workdir, grid, points, channels, compression)
+                logger.warning("%s: %.0f MB/s", key, results[key]["MB_per_s"])
+        if large:
+            key = "memory/grid{grid}_points{points}_ch{channels}".format(**LARGE_CUBE)
+            results[key] = bench_memory(workdir, **LARGE_CUBE)
+            logger.warning("%s: heap peak %.1f MB, resident peak %s MB for a %.0f MB cube", key,
+                           results[key]["heap_peak_MB"], f"{results[key]['rss_peak_MB']:.1f}"
+                           if "rss_peak_MB" in results[key] else "?", results[key]["cube_MB"])
+    if gui:
+        cold = bench_startup()
+        if cold is not None:
+            results["gui/startup"] = cold
+            logger.warning("gui/startup: window after %.2f s, ready after %.2f s", cold["window_s"], cold["ready_s"])
+        latency = bench_gui_latency()
+        if latency is not None:
+            results["gui/edit_to_info"] = latency
+            logger.warning("gui/edit_to_info: median %.2f ms", latency["median_ms"])
+    return results
+
+
+def startup_budget():
+    """Cold-start budget of the window in seconds, from the startup section of config.yaml"""
+    import yaml
+    from startup import DEFAULT_SETTINGS
+    with open(os.path.join(ROOT, "config.yaml"), 'r') as file:
+        settings = (yaml.safe_load(file) or {}).get("startup") or {}
+    return settings.get("budget", DEFAULT_SETTINGS["budget"])
+
+
+def compare(results, baseline, tolerance):
+    """Metrics that got worse than the baseline by more than `tolerance` (relative)"""
+    regressions = []
+    for key, metrics in results.items():
+        for metric, value in metrics.items():
+            reference = baseline.get(key, {}).get(metric)
+            if reference is None or metric in ("cube_MB", "ratio") or reference == 0:
+                continue
+            change = (value - reference) / abs(reference)
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            if worse > tolerance:
+                regressions.append((key, metric, reference, value))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--full", action="store_true", help="run the full parameter sweep")
+    parser.add_argument("--no-large", action="store_true", help="skip the large-cube memory benchmark")
+    parser.add_argument("--no-gui", action="store_true", help="skip the GUI latency benchmark")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="compare with the baseline, exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression (default 0.25)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    logger.setLevel(logging.WARNING)
+
+    results = run(FULL_SWEEP if args.full else QUICK_SWEEP, large=not args.no_large, gui=not args.no_gui)
+    report = {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+              "machine": platform.node(), "python": platform.python_version(),
+              "numpy": np.__version__, "results": results}
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + ".json")
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=1)
+    print(f"Results written to {path}")
+
+    if args.save_baseline:
+        with open(BASELINE_FILE, 'w') as file:
+            json.dump(report, file, indent=1)
+        print(f"Baseline written to {BASELINE_FILE}")
+
+    status = 0
+    budget = startup_budget()
+    if "gui/startup" in results and budget is not None and results["gui/startup"]["window_s"] > budget:
+        print(f"OVER BUDGET gui/startup window_s: {results['gui/startup']['window_s']:.2f} s > {budget:.2f} s")
+        status = 1
+
+    if args.compare:
+        if not os.path.exists(BASELINE_FILE):
+            print("No baseline to compare with, run with --save-baseline first")
+            return 2
+        with open(BASELINE_FILE, 'r') as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for key, metric, reference, value in regressions:
+            print(f"REGRESSION {key} {metric}: {reference:.4g} -> {value:.4g}")
+        return 1 if regressions else status
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+Checkpoint journal of a step scan
+Append-only JSON-lines record of every completed step and its data offset in the cube file, used to resume interrupted runs
+"""
+
+import os
+import json
+import datetime
+
+import logging
+
+from datacube import META_FILE
+
+logger = logging.getLogger('logger.checkpoint')
+
+JOURNAL_FILE = "journal.jsonl"
+
+
+def frame_offsets(cube, step):
+    """Byte offset of the frame of every channel at `step` in cube.npy"""
+    channels, steps, height, width = cube.shape
+    frame_bytes = height * width * cube.data.dtype.itemsize
+    return {channel: int(cube.data.offset + (index * steps + step) * frame_bytes)
+            for index, channel in enumerate(cube.channels)}
+
+
+class Journal():
+    """One JSON object per line, fsynced after every record
+
+    The frame data is flushed before its step is recorded, so a step in the journal is on disk.
+    A line cut short by a crash is ignored when the journal is read back.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    @property
+    def filename(self):
+        return os.path.join(self.path, JOURNAL_FILE)
+
+    def records(self):
+        if not os.path.exists(self.filename):
+            return []
+        records = []
+        with open(self.filename, "r") as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning("Ignoring damaged journal line in %s", self.filename)
+        return records
+
+    def write(self, event, **values):
+        if self.file is None:
+            self.file = open(self.filename, "a")
+        record = {"event": event, "time": datetime.datetime.now().isoformat(timespec="milliseconds")}
+        record.update(values)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record_step(self, cube, step, position):
+        self.write("step", step=int(step), position=float(position), offsets=frame_offsets(cube, step))
+
+    def completed_steps(self, cube):
+        """Steps recorded in the journal whose data is still where the journal says"""
+        steps = set()
+        for record in self.records():
+            if record["event"] != "step":
+                continue
+            step = record["step"]
+            if record["offsets"] != frame_offsets(cube, step):
+                raise ValueError(f"Journal of {self.path} does not match the layout of its data cube")
+            if cube.done[step]:
+                steps.add(step)
+        return steps
+
+    @property
+    def finished(self):
+        return any(record["event"] == "finished" for record in self.records())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def find_unfinished(output_dir):
+    """Run folders in `output_dir` with a journal but no finished record, newest first"""
+    if not os.path.isdir(output_dir):
+        return []
+    runs = []
+    for name in sorted(os.listdir(output_dir), reverse=True):
+        path = os.path.join(output_dir, name)
+        if os.path.exists(os.path.join(path, JOURNAL_FILE)) and os.path.exists(os.path.join(path, META_FILE)) \
+                and not Journal(path).finished:
+            runs.append(path)
+    return runs
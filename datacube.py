@@ -0,0 +1,201 @@
+"""
+Memory-mapped on-disk data cube of a step scan
+Frames are written into a preallocated .npy file as they arrive, so memory use does not grow with the scan size
+and other processes can open the cube read-only while the scan is still running
+"""
+
+import os
+import json
+import datetime
+
+import numpy as np
+import logging
+
+logger = logging.getLogger('logger.datacube')
+
+CUBE_FILE = "cube.npy"
+DONE_FILE = "done.npy"
+SCALES_FILE = "scales.npy"
+META_FILE = "cube.json"
+# Integer cubes map every frame onto the full range of their type, see DataCube.write_frame
+INTEGER_RANGE = 32767
+
+
+def run_folder(output_dir, name):
+    """Folder of a new run in `output_dir`, named after the time and `name`, numbered when it exists already"""
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    path = os.path.join(output_dir, f"{stamp}_{name.replace(' ', '_')}")
+    suffix = 1
+    while os.path.exists(path):
+        suffix += 1
+        path = os.path.join(output_dir, f"{stamp}_{name.replace(' ', '_')}_{suffix}")
+    return path
+
+
+class DataCube():
+    """Cube of shape (channels, steps, height, width), each channel one contiguous block
+
+    done.npy flags the steps that were completely written, readers should only trust those.
+    Integer cubes keep the (offset, scale) of every frame in scales.npy, frame(), spectrum() and
+    block() return the values in the units they were written in, `data` holds the stored integers.
+    """
+
+    def __init__(self, path, data, done, meta, scales=None):
+        self.path = path
+        self.data = data
+        self.done = done
+        self.meta = meta
+        self.scales = scales
+        self.channels = list(meta["channels"])
+
+    @classmethod
+    def create(cls, path, channels, positions, height, width, dtype=np.float64, metadata=None):
+        os.makedirs(path, exist_ok=True)
+        shape = (len(channels), len(positions), int(height), int(width))
+        data = np.lib.format.open_memmap(os.path.join(path, CUBE_FILE), mode="w+", dtype=dtype, shape=shape)
+        done = np.lib.format.open_memmap(os.path.join(path, DONE_FILE), mode="w+", dtype=np.uint8, shape=(len(positions),))
+        scales = None
+        if np.issubdtype(dtype, np.integer):
+            scales = np.lib.format.open_memmap(os.path.join(path, SCALES_FILE), mode="w+", dtype=np.float64,
+                                               shape=(len(channels), len(positions), 2))
+        meta = {"channels": list(channels),
+                "positions": [float(p) for p in positions],
+                "shape": list(shape),
+                "dtype": np.dtype(dtype).str,
+                "scaled": scales is not None,
+                "metadata": metadata or {}}
+        with open(os.path.join(path, META_FILE), "w") as file:
+            json.dump(meta, file, indent=1)
+        logger.info("Created data cube %s of %.1f MB", path, data.nbytes / 1e6)
+        return cls(path, data, done, meta, scales)
+
+    @classmethod
+    def open(cls, path, mode="r"):
+        with open(os.path.join(path, META_FILE), "r") as file:
+            meta = json.load(file)
+        data = np.load(os.path.join(path, CUBE_FILE), mmap_mode=mode)
+        done = np.load(os.path.join(path, DONE_FILE), mmap_mode=mode)
+        scales = np.load(os.path.join(path, SCALES_FILE), mmap_mode=mode) if meta.get("scaled") else None
+        return cls(path, data, done, meta, scales)
+
+    @property
+    def positions(self):
+        return np.asarray(self.meta["positions"])
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def channel_index(self, channel):
+        return self.channels.index(channel)
+
+    def write_frame(self, channel, step, frame):
+        index = self.channel_index(channel)
+        if self.scales is None:
+            self.data[index, step] = frame
+            return
+        # The frame's range is spread over the integers, the rounding error is half a step of that range
+        frame = np.asarray(frame, dtype=np.float64)
+        low, high = float(frame.min()), float(frame.max())
+        offset = (high + low) / 2
+        scale = (high - low) / (2 * INTEGER_RANGE)
+        # Flat frames and ranges so small that the step underflows are stored as their offset
+        if not scale >= np.finfo(np.float64).tiny:
+            scale = 1.0
+        self.data[index, step] = np.clip(np.rint((frame - offset) / scale), -INTEGER_RANGE, INTEGER_RANGE)
+        self.scales[index, step] = (offset, scale)
+
+    def mark_done(self, step):
+        self.data.flush()
+        if self.scales is not None:
+            self.scales.flush()
+        self.done[step] = 1
+        self.done.flush()
+
+    def completed_steps(self):
+        return np.flatnonzero(self.done)
+
+    def frame(self, channel, step):
+        return self.block(self.channel_index(channel), step)
+
+    def spectrum(self, channel, y, x):
+        """Interferogram of one pixel over all steps"""
+        return self.block(self.channel_index(channel), slice(None), y, x)
+
+    def block(self, index, steps=slice(None), rows=slice(None), columns=slice(None)):
+        """Values of channel `index` at the given steps and pixels, a view of the memory map unless the cube is scaled"""
+        values = self.data[index, steps, rows, columns]
+        if self.scales is None:
+            return values
+        scales = self.scales[index, steps]
+        # Steps come first, the pixel axes broadcast
+        shape = np.shape(scales)[:-1] + (1,) * (np.ndim(values) - np.ndim(scales) + 1)
+        return (values * scales[..., 1].reshape(shape) + scales[..., 0].reshape(shape)).astype(np.float32)
+
+    def update_metadata(self, **values):
+        self.meta["metadata"].update(values)
+        _write_meta(self.path, self.meta)
+
+    def close(self):
+        if self.data is None:
+            return
+        self.data.flush()
+        self.done.flush()
+        if self.scales is not None:
+            self.scales.flush()
+        # Dropping the references unmaps the files
+        self.data = None
+        self.done = None
+        self.scales = None
+
+    def discard(self):
+        """Close the cube and delete its data files, the metadata is kept
+
+        On Windows a file another thread or process still maps cannot be deleted, those are listed
+        in the metadata and left to remove_discarded(). True when all of them are gone.
+        """
+        self.close()
+        left = _remove_files(self.path, (CUBE_FILE, DONE_FILE, SCALES_FILE))
+        if left:
+            logger.warning("%s of %s still in use, removed later", ", ".join(left), self.path)
+            self.meta["discarded"] = left
+            _write_meta(self.path, self.meta)
+        return not left
+
+
+def _write_meta(path, meta):
+    with open(os.path.join(path, META_FILE), "w") as file:
+        json.dump(meta, file, indent=1)
+
+
+def _remove_files(path, names):
+    """Names of the files that could not be deleted"""
+    left = []
+    for name in names:
+        try:
+            if os.path.exists(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+        except OSError:
+            left.append(name)
+    return left
+
+
+def remove_discarded(output_dir):
+    """Delete the data files DataCube.discard() had to leave in the runs of `output_dir`"""
+    if not os.path.isdir(output_dir):
+        return
+    for name in os.listdir(output_dir):
+        path = os.path.join(output_dir, name)
+        try:
+            with open(os.path.join(path, META_FILE), "r") as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            continue
+        if not meta.get("discarded"):
+            continue
+        left = _remove_files(path, meta["discarded"])
+        if left:
+            meta["discarded"] = left
+        else:
+            del meta["discarded"]
+        _write_meta(path, meta)
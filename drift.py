@@ -0,0 +1,264 @@
+"""
+Drift tracking of step scans
+Measures how far the sample moved between frames by FFT cross-correlation of the topography, moves the next scans
+along with it and shifts the acquired frames back onto the first one afterwards
+
+    python drift.py data/<run folder>          # corrects the frames of a finished run in place
+"""
+
+import sys
+import json
+import math
+import argparse
+import functools
+import threading
+
+import numpy as np
+import logging
+
+from datacube import DataCube
+from registration import level, FLAT
+
+logger = logging.getLogger('logger.drift')
+
+DEFAULT_SETTINGS = {"enabled": False,
+                    "channel": "Z",           # channel the frames are compared on
+                    "reference": "previous",  # previous compares each frame with the one before, first with the first frame
+                    "feedback": True,         # move PhysicalOffsetX/Y of the next steps with the measured drift
+                    "gain": 1.0,              # fraction of the predicted drift fed back
+                    "smoothing": 0.5,         # weight of the newest measurement in the drift velocity
+                    "correct": True,          # shift the acquired frames onto the first one at the end of the scan
+                    "max_shift": 0.25,        # larger shifts are taken for mismatches, as a fraction of the scan field
+                    "max_pixels": 256}        # frames are binned to at most this many pixels per side for the correlation
+PASSES = 4          # correlations per measurement at most
+TOLERANCE = 0.02    # pixels, a pass that moves the estimate less ends the measurement
+
+
+@functools.lru_cache(maxsize=8)
+def _window(shape):
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1]))
+
+
+def _binned(image, max_pixels):
+    """Image block-averaged to at most `max_pixels` per side, and the block size"""
+    factor = max(1, int(math.ceil(max(image.shape) / max_pixels)))
+    if factor == 1:
+        return image, factor
+    height, width = (image.shape[0] // factor) * factor, (image.shape[1] // factor) * factor
+    return image[:height, :width].reshape(height // factor, factor, width // factor, factor).mean(axis=(1, 3)), factor
+
+
+def _peak_offset(values, index):
+    """Fraction of a sample the maximum of a parabola through values[index - 1:index + 2] lies off `index`, wrapping around"""
+    left, centre, right = values[index - 1], values[index], values[(index + 1) % len(values)]
+    curvature = left - 2 * centre + right
+    if curvature >= 0:
+        return 0.0
+    return float(np.clip(0.5 * (left - right) / curvature, -0.5, 0.5))
+
+
+def measure_shift(reference, image, max_pixels=DEFAULT_SETTINGS["max_pixels"]):
+    """(dy, dx, peak) in pixels the content of `image` moved relative to `reference`, None for featureless frames
+
+    Both frames are leveled and windowed and the peak of their partly whitened cross-power spectrum
+    is refined with a parabola. The fixed window pulls the peak towards zero shift, so `image` is
+    moved back by the estimate and the rest measured again until it is below TOLERANCE.
+    `peak` is the correlation of the aligned frames, 1 for identical content.
+    """
+    frames = []
+    for frame in (reference, image):
+        frame, factor = _binned(np.asarray(frame, dtype=np.float64), max_pixels)
+        frame = level(frame)
+        if np.std(frame) <= FLAT * max(np.abs(frame).max(), 1e-300):
+            return None
+        frames.append(frame)
+    reference, image = frames
+    window = _window(reference.shape)
+    spectrum = np.conj(np.fft.rfft2(reference * window))
+    height, width = reference.shape
+    dy = dx = 0.0
+    for _ in range(PASSES):
+        moved = shift_frame(image, -dy, -dx) * window
+        cross = np.fft.rfft2(moved) * spectrum
+        cross /= np.sqrt(np.abs(cross) + 1e-12 * np.abs(cross).max())
+        correlation = np.fft.irfft2(cross, s=reference.shape)
+        i, j = np.unravel_index(np.argmax(correlation), correlation.shape)
+        step_y = i + _peak_offset(correlation[:, j], i)
+        step_x = j + _peak_offset(correlation[i, :], j)
+        # Shifts past half the frame are negative ones wrapped around
+        step_y = step_y - height if step_y > height / 2 else step_y
+        step_x = step_x - width if step_x > width / 2 else step_x
+        dy, dx = dy + step_y, dx + step_x
+        if max(abs(step_y), abs(step_x)) < TOLERANCE:
+            break
+    aligned = shift_frame(image, -dy, -dx) * window
+    peak = float(np.corrcoef((reference * window).ravel(), aligned.ravel())[0, 1])
+    return dy * factor, dx * factor, peak
+
+
+def shift_frame(frame, dy, dx):
+    """Frame with its content moved by (dy, dx) pixels, the edges it uncovers repeat the border values"""
+    frame = np.asarray(frame)
+    if dy == 0 and dx == 0:
+        return frame
+    pad = (int(math.ceil(abs(dy))) + 1, int(math.ceil(abs(dx))) + 1)
+    padded = np.pad(frame.astype(np.float64), ((pad[0], pad[0]), (pad[1], pad[1])), mode="edge")
+    ky = np.fft.fftfreq(padded.shape[0])[:, None]
+    kx = np.fft.rfftfreq(padded.shape[1])[None, :]
+    moved = np.fft.irfft2(np.fft.rfft2(padded) * np.exp(-2j * np.pi * (ky * dy + kx * dx)), s=padded.shape)
+    return moved[pad[0]:pad[0] + frame.shape[0], pad[1]:pad[1] + frame.shape[1]].astype(frame.dtype, copy=False)
+
+
+class DriftTracker():
+    """Running estimate of the sample drift during a step scan, in µm of stage position
+
+    update() is called with the topography of every downloaded step and the offset it was scanned
+    at, offset() gives the PhysicalOffsetX/Y the next step should be scanned at. Because the next
+    step is already being acquired while one is downloaded, the offset extrapolates the drift with
+    its velocity per step. The two are called from different threads.
+    """
+
+    def __init__(self, scan_parameters, settings=None):
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(settings or {})
+        self.nominal = (float(scan_parameters["PhysicalOffsetX"]), float(scan_parameters["PhysicalOffsetY"]))
+        self.pitch = (scan_parameters["PhysicalSizeX"] / scan_parameters["TargetResolutionWidth"],
+                      scan_parameters["PhysicalSizeY"] / scan_parameters["TargetResolutionHeight"])
+        self.field = (float(scan_parameters["PhysicalSizeX"]), float(scan_parameters["PhysicalSizeY"]))
+        angle = math.radians(float(scan_parameters.get("Angle", 0.0)))
+        self.rotation = np.array([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]])
+        self.records = []
+        self.drift = (0.0, 0.0)
+        self.velocity = (0.0, 0.0)
+        self.last_step = None
+        self._reference = None
+        self._lock = threading.Lock()
+
+    def offset(self, step):
+        """(x, y) the scan of `step` should be centred on"""
+        with self._lock:
+            if not self.settings["feedback"] or self.last_step is None:
+                return self.nominal
+            ahead = step - self.last_step
+            gain = self.settings["gain"]
+            return (self.nominal[0] + gain * (self.drift[0] + self.velocity[0] * ahead),
+                    self.nominal[1] + gain * (self.drift[1] + self.velocity[1] * ahead))
+
+    def restore(self, record, frame):
+        """Continue from the journal `record` of an interrupted run and the frame of its step"""
+        with self._lock:
+            self.drift = tuple(record["drift"])
+            self.velocity = tuple(record["velocity"])
+            self.last_step = record["step"]
+            self._reference = (record["step"], np.array(frame, dtype=np.float64), tuple(record["offset"]), self.drift)
+
+    def update(self, step, frame, offset):
+        """Measure the frame of `step` scanned at `offset`, the record of the step or None when it could not be measured"""
+        frame = np.array(frame, dtype=np.float64)
+        if self._reference is None:
+            # The first frame defines zero drift
+            reference_offset, reference_drift, shift = tuple(offset), self.drift, (0.0, 0.0, 1.0)
+        else:
+            _, reference, reference_offset, reference_drift = self._reference
+            shift = measure_shift(reference, frame, self.settings["max_pixels"])
+        if shift is None:
+            logger.debug("Step %d has no features to measure the drift on", step)
+            return None
+        dy, dx, peak = shift
+        if abs(dx * self.pitch[0]) > self.settings["max_shift"] * self.field[0] \
+                or abs(dy * self.pitch[1]) > self.settings["max_shift"] * self.field[1]:
+            logger.warning("Ignoring drift of (%.1f, %.1f) px at step %d, larger than max_shift", dx, dy, step)
+            return None
+        # The content moves by the sample drift minus the change of the offset, turned by the scan angle
+        moved = self.rotation @ (dx * self.pitch[0], dy * self.pitch[1])
+        drift = (reference_drift[0] + moved[0] + offset[0] - reference_offset[0],
+                 reference_drift[1] + moved[1] + offset[1] - reference_offset[1])
+        with self._lock:
+            steps = max(1, step - self.last_step) if self.last_step is not None else 1
+            latest = ((drift[0] - self.drift[0]) / steps, (drift[1] - self.drift[1]) / steps)
+            smoothing = self.settings["smoothing"] if len(self.records) > 1 else 1.0
+            self.velocity = tuple(smoothing * new + (1 - smoothing) * old for new, old in zip(latest, self.velocity))
+            self.drift = drift
+            self.last_step = step
+        if self._reference is None or self.settings["reference"] == "previous":
+            self._reference = (step, frame, tuple(offset), drift)
+        record = {"step": int(step), "offset": [float(v) for v in offset], "drift": [float(v) for v in drift],
+                  "velocity": [float(v) for v in self.velocity], "shift": [float(dy), float(dx)], "peak": peak}
+        self.records.append(record)
+        return record
+
+    def summary(self):
+        """Metadata of the run, the records as JSON since HDF5 attributes cannot hold a list of dicts"""
+        return {"settings": self.settings, "nominal": list(self.nominal), "records": json.dumps(self.records)}
+
+
+def frame_shifts(cube, channel, reference="previous", max_pixels=DEFAULT_SETTINGS["max_pixels"]):
+    """{step: (dy, dx)} the content of every completed frame moved relative to the first one"""
+    done = cube.completed_steps()
+    if len(done) == 0:
+        return {}
+    first = np.asarray(cube.frame(channel, done[0]))
+    shifts = {int(done[0]): (0.0, 0.0)}
+    previous, total = first, (0.0, 0.0)
+    for step in done[1:]:
+        frame = np.asarray(cube.frame(channel, step))
+        measured = measure_shift(previous if reference == "previous" else first, frame, max_pixels)
+        if measured is not None:
+            base = total if reference == "previous" else (0.0, 0.0)
+            total = (base[0] + measured[0], base[1] + measured[1])
+            previous = frame
+        # A frame that could not be measured is taken to sit where the last measured one did
+        shifts[int(step)] = total
+    return shifts
+
+
+def correct_cube(cube, settings=None, progress=None):
+    """Shift every completed frame of every channel in place so it lines up with the first one
+
+    The shifts are measured on the frames themselves, so this also corrects runs scanned without
+    feedback and whatever drift the feedback left. Returns the shifts, {} when the cube was
+    already corrected or has no channel to measure on.
+    """
+    options = dict(DEFAULT_SETTINGS)
+    options.update(settings or {})
+    if "drift_correction" in cube.meta["metadata"]:
+        logger.info("%s is already drift corrected", cube.path)
+        return {}
+    if options["channel"] not in cube.channels:
+        logger.warning("%s has no %s channel to correct the drift with", cube.path, options["channel"])
+        return {}
+    shifts = frame_shifts(cube, options["channel"], options["reference"], options["max_pixels"])
+    for count, (step, (dy, dx)) in enumerate(shifts.items()):
+        if dy or dx:
+            for channel in cube.channels:
+                cube.write_frame(channel, step, shift_frame(cube.frame(channel, step), -dy, -dx))
+        if progress is not None and (count + 1) % 100 == 0:
+            progress(f"Drift correction: {count + 1}/{len(shifts)} frames")
+    cube.data.flush()
+    largest = max((math.hypot(*shift) for shift in shifts.values()), default=0.0)
+    cube.update_metadata(drift_correction={"channel": options["channel"], "reference": options["reference"],
+                                           "shifts": {str(step): list(shift) for step, shift in shifts.items()}})
+    logger.info("Drift corrected %d frames of %s, largest shift %.2f px", len(shifts), cube.path, largest)
+    return shifts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("run", help="run folder containing the data cube")
+    parser.add_argument("--channel", default=DEFAULT_SETTINGS["channel"], help="channel to measure the drift on")
+    parser.add_argument("--reference", choices=("previous", "first"), default=DEFAULT_SETTINGS["reference"])
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('logger').setLevel(logging.INFO)
+
+    cube = DataCube.open(args.run, "r+")
+    try:
+        correct_cube(cube, {"channel": args.channel, "reference": args.reference}, progress=logger.info)
+    finally:
+        cube.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
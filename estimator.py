@@ -0,0 +1,154 @@
+"""
+Self-calibrating scan time estimator
+Learns a per-instrument cost model from the measured phase timings of every run and predicts total duration and ETA
+"""
+
+import os
+import datetime
+
+import numpy as np
+import yaml
+import logging
+
+from scanplan import step_count, sample_size
+
+logger = logging.getLogger('logger.estimator')
+
+MODEL_FILE = "cost_model.yaml"
+MAX_SAMPLES = 200
+
+
+def scan_features(scan_parameters):
+    """Features of one Whitelight scan: nominal pixel time (forward and backward), number of lines, constant"""
+    pixels = scan_parameters["TargetResolutionWidth"] * scan_parameters["TargetResolutionHeight"]
+    pixel_time = pixels * scan_parameters["TargetMillisecondsPerPixel"] / 1000.0 * 2
+    return [pixel_time, float(scan_parameters["TargetResolutionHeight"]), 1.0]
+
+
+def download_features(scan_parameters, channels):
+    """Features of one step download: number of values, constant"""
+    pixels = scan_parameters["TargetResolutionWidth"] * scan_parameters["TargetResolutionHeight"]
+    return [float(pixels * len(channels)), 1.0]
+
+
+def _fit(samples, default):
+    """Weighted non-negative least squares of rows [features..., mean time, count]"""
+    if not samples:
+        return list(default)
+    rows = np.asarray(samples, dtype=float)
+    X, y, w = rows[:, :-2], rows[:, -2], np.sqrt(rows[:, -1])
+    active = list(range(X.shape[1]))
+    # Drop the most negative coefficient until all are non-negative, there are only a few features
+    while active:
+        coef, *_ = np.linalg.lstsq(X[:, active] * w[:, None], y * w, rcond=None)
+        if (coef >= 0).all():
+            break
+        active.pop(int(np.argmin(coef)))
+    result = np.zeros(X.shape[1])
+    if active:
+        result[active] = coef
+    return result.tolist()
+
+
+class CostModel():
+    """Step time = max(scan, download) because the download overlaps the next acquisition
+
+    scan = a * nominal pixel time + b * lines + c   (turnaround, step move and scan setup)
+    download = d * values + e
+    total = approach + steps * step time + last download + save
+    Without samples the model falls back to the nominal pixel time, like the old estimate.
+    """
+
+    def __init__(self, instrument="default"):
+        self.instrument = instrument
+        self.scan_samples = []
+        self.download_samples = []
+        self.approach_samples = []
+        self.save_samples = []
+        self.scan_coef = [1.0, 0.0, 0.0]
+        self.download_coef = [0.0, 0.0]
+        self.save_coef = [0.0, 0.0]
+        self.approach_time = 0.0
+
+    def predict_step(self, scan_parameters, channels):
+        scan = float(np.dot(self.scan_coef, scan_features(scan_parameters)))
+        download = float(np.dot(self.download_coef, download_features(scan_parameters, channels)))
+        return scan, download
+
+    def predict_total(self, scan_parameters, ifg_parameters, channels, approach=True):
+        steps = step_count(scan_parameters, ifg_parameters)
+        scan, download = self.predict_step(scan_parameters, channels)
+        pixels = scan_parameters["TargetResolutionWidth"] * scan_parameters["TargetResolutionHeight"]
+        save = float(np.dot(self.save_coef, [pixels * len(channels) * steps * float(sample_size(scan_parameters)), 1.0]))
+        total = steps * max(scan, download) + download + save
+        if approach:
+            total += self.approach_time
+        return total
+
+    def eta(self, scan_parameters, channels, steps_done, steps_total, elapsed_steps_time):
+        """Remaining seconds, blending the observed step time of this run with the model"""
+        scan, download = self.predict_step(scan_parameters, channels)
+        predicted = max(scan, download)
+        if steps_done:
+            weight = steps_done / (steps_done + 5.0)
+            predicted = weight * elapsed_steps_time / steps_done + (1 - weight) * predicted
+        return (steps_total - steps_done) * predicted + download
+
+    def add_run(self, scan_parameters, channels, timings):
+        """Add the timings measured by StepScan and refit"""
+        if timings["scan"]:
+            self.scan_samples.append(scan_features(scan_parameters) + [float(np.mean(timings["scan"])), len(timings["scan"])])
+        if timings["download"]:
+            self.download_samples.append(download_features(scan_parameters, channels) + [float(np.mean(timings["download"])), len(timings["download"])])
+        if timings["approach"] is not None:
+            self.approach_samples.append(float(timings["approach"]))
+        if timings["save"] is not None:
+            self.save_samples.append([float(timings["bytes"]), 1.0, float(timings["save"]), 1])
+        for samples in (self.scan_samples, self.download_samples, self.approach_samples, self.save_samples):
+            del samples[:-MAX_SAMPLES]
+        self.fit()
+
+    def fit(self):
+        self.scan_coef = _fit(self.scan_samples, [1.0, 0.0, 0.0])
+        self.download_coef = _fit(self.download_samples, [0.0, 0.0])
+        self.save_coef = _fit(self.save_samples, [0.0, 0.0])
+        self.approach_time = float(np.median(self.approach_samples)) if self.approach_samples else 0.0
+
+    def to_dict(self):
+        return {"updated": datetime.datetime.now().isoformat(timespec="seconds"),
+                "scan_coef": self.scan_coef,
+                "download_coef": self.download_coef,
+                "save_coef": self.save_coef,
+                "approach_time": self.approach_time,
+                "scan_samples": self.scan_samples,
+                "download_samples": self.download_samples,
+                "approach_samples": self.approach_samples,
+                "save_samples": self.save_samples}
+
+    @classmethod
+    def load(cls, path, instrument="default"):
+        model = cls(instrument)
+        if not os.path.exists(path):
+            return model
+        with open(path, 'r') as file:
+            models = yaml.safe_load(file) or {}
+        stored = models.get(instrument)
+        if stored:
+            for key in ("scan_samples", "download_samples", "approach_samples", "save_samples"):
+                setattr(model, key, list(stored.get(key, [])))
+            model.fit()
+        return model
+
+    def save(self, path):
+        models = {}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                models = yaml.safe_load(file) or {}
+        models[self.instrument] = self.to_dict()
+        with open(path, 'w') as file:
+            yaml.safe_dump(models, file, default_flow_style=None)
+        logger.info("Cost model of %s saved to %s", self.instrument, path)
+
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=int(round(seconds))))
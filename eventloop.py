@@ -0,0 +1,48 @@
+"""
+Long-lived asyncio event loop running in its own thread
+"""
+
+import asyncio
+import threading
+
+import logging
+
+logger = logging.getLogger('logger.eventloop')
+
+
+class EventLoopThread():
+
+    def __init__(self, name="AsyncioLoop"):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """Schedule a coroutine from any thread, returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def call(self, callback, *args):
+        """Run a plain callable inside the loop thread"""
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    async def _shutdown(self):
+        # Cancelled tasks get to run their cleanup, e.g. a scan closes its cube and journal
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop.stop()
+
+    def stop(self, timeout=5.0):
+        if not self.thread.is_alive():
+            return
+        self.submit(self._shutdown())
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            logger.error("Event loop thread did not stop in %.1f s", timeout)
+        else:
+            self.loop.close()
@@ -1,7 +1,7 @@
 
 from PySide6 import QtWidgets
 from PySide6 import QtCore, QtGui
-from PySide6.QtWidgets import QApplication, QMainWindow, QLabel, QMessageBox, QWidget, QHBoxLayout, QVBoxLayout, QFormLayout, QLineEdit, QSpinBox, QComboBox, QSizePolicy
+from PySide6.QtWidgets import QApplication, QMainWindow, QLabel, QMessageBox, QWidget, QHBoxLayout, QVBoxLayout, QFormLayout, QLineEdit, QSpinBox, QDoubleSpinBox, QComboBox, QSizePolicy
 from PySide6.QtCore import QTimer, QObject, QThread, Signal, Slot
 
 from PySide6.QtCore import Qt, QPointF, Property
@@ -9,18 +9,12 @@ from PySide6.QtGui import QColor, QPainter, QPen, QBrush, QRadialGradient
 from PySide6.QtWidgets import QAbstractButton
 
 from enum import Enum
-import datetime
+
+from scanplan import SCAN_DEFAULTS, IFG_DEFAULTS, SAMPLING_MODES, DATA_FORMATS, SCAN_RANGE, ifg_ends
 
 import logging
 
-logger = logging.getLogger('logger')
-logger.setLevel(logging.INFO)
-if not logger.hasHandlers():
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-logger.info('Starting GUI')
+logger = logging.getLogger('logger.gui')
 
 # Taken from https://github.com/nlamprian/pyqt5-led-indicator-widget
 class LedIndicator(QAbstractButton):
@@ -152,6 +146,7 @@ class FloatOrEmptyValidator(AnyOrEmptyValidator):
 
 # Copy-modified from orange-spectroscopy
 class LineEdit(QLineEdit):
+    # Only when the user changed the text to an acceptable value, not for every key press
     edited = Signal()
 
     def __init__(self, bottom, top, *args, **kwargs):
@@ -159,6 +154,7 @@ class LineEdit(QLineEdit):
         self.validator = FloatOrEmptyValidator(self, allow_empty=False, bottom=bottom, top=top)
         self.setValidator(self.validator)
         self.textChanged.connect(self.new_text)
+        self.textEdited.connect(self.on_text_edited)
         self.returnPressed.connect(self.check_validator)
         self.ntext = None
 
@@ -166,21 +162,27 @@ class LineEdit(QLineEdit):
         super().keyPressEvent(event)
         if event.key() == QtCore.Qt.Key_Return and not self.hasAcceptableInput():
             self.check_validator()
-        self.edited.emit()
 
     def new_text(self, text):
         if self.hasAcceptableInput():
             self.ntext = text
 
+    def on_text_edited(self, text):
+        if self.hasAcceptableInput():
+            self.edited.emit()
+
     def check_validator(self):
         try:
             if float(self.text()) > self.validator.dv.top():
                 self.setText(str(self.validator.dv.top()))
             elif float(self.text()) < self.validator.dv.bottom():
                 self.setText(str(self.validator.dv.bottom()))
+            else:
+                return
         except:
             mssg = QMessageBox.about(self, "Error", "Input can only be a number")
             self.setText(self.ntext)
+        self.edited.emit()
 
 def is_macstyle():
     style = QApplication.style()
@@ -397,16 +399,13 @@ ScanMode = Enum('ScanMode', [('WLI', 'Whitelight Step Scan'),('WLI_single','Sing
 class InterferometerEditor(QWidget):
 
     edited = Signal(dict)
-    parameters = {"InterferometerCenter": 400.0,
-                  "InterferometerDistance": 800.0,
-                  "NumberOfPoints": 600,
-                  "NumberOfSkippedPoints": 0,
-                  "StartPosition": 800.0,
-                  "EndPosition": 0.0}
 
     def __init__(self, parent=None, **kwargs):
         super().__init__(parent, **kwargs)
 
+        # Per editor, a second editor or the scan in progress must not see these change
+        self.parameters = dict(IFG_DEFAULTS)
+
         self.setLayout(QVBoxLayout())
         self.form = QFormLayout()
         self.basebox = widgetBox(self, "", orientation=self.form)
@@ -422,39 +421,52 @@ class InterferometerEditor(QWidget):
         self.sp1.setValue(600)
         self.form.addRow("Number of points:", self.sp1)
 
+        # Custom position lists come from recipes and settings files
+        self.sampling_selector = QComboBox()
+        self.sampling_selector.addItems([mode for mode in SAMPLING_MODES if mode != "custom"])
+        self.form.addRow("Sampling:", self.sampling_selector)
+        self.ratio_spin = QDoubleSpinBox()
+        self.ratio_spin.setRange(0.05, 1.0)
+        self.ratio_spin.setSingleStep(0.05)
+        self.form.addRow("Fraction of points measured:", self.ratio_spin)
+
         self.cast_default_values()
         self.connect_signals()
-        self.edited.emit(self.parameters)
 
     def cast_default_values(self):
         self.le1.setText(str(self.parameters["InterferometerCenter"]))
         self.le2.setText(str(self.parameters["InterferometerDistance"]))
         self.sp1.setValue(self.parameters["NumberOfPoints"])
+        self.sampling_selector.setCurrentText(self.parameters["Sampling"])
+        self.ratio_spin.setValue(self.parameters["SamplingRatio"])
+        self.ratio_spin.setEnabled(self.parameters["Sampling"] != "uniform")
 
     def connect_signals(self):
         self.le1.edited.connect(self.set_parameters)
         self.le2.edited.connect(self.set_parameters)
         self.sp1.valueChanged.connect(self.set_parameters)
+        self.sampling_selector.currentIndexChanged.connect(self.set_parameters)
+        self.ratio_spin.valueChanged.connect(self.set_parameters)
 
     def set_parameters(self):
         self.parameters["InterferometerCenter"] = float(self.le1.text())
         self.parameters["InterferometerDistance"] = float(self.le2.text())
         self.parameters["NumberOfPoints"] = int(self.sp1.value())
         self.parameters["NumberOfSkippedPoints"] = 0
-        self.parameters["StartPosition"] = 800.0
-        self.parameters["EndPosition"] = 0.0
-
-        logger.debug(self.parameters)
+        self.parameters["StartPosition"], self.parameters["EndPosition"] = ifg_ends(self.parameters)
+        self.parameters["Sampling"] = self.sampling_selector.currentText()
+        self.parameters["SamplingRatio"] = float(self.ratio_spin.value())
+        self.ratio_spin.setEnabled(self.parameters["Sampling"] != "uniform")
         self.edited.emit(self.parameters)
 
 class InfoDisplay(QWidget):
 
-    interferogram_parameters = None
-    scan_parameters = None
-    
     def __init__(self, parent=None, **kwargs):
         super().__init__(parent, **kwargs)
 
+        self.plan = None
+        self.cost_model = None
+
         self.setLayout(QVBoxLayout())
         self.boxlayout = QVBoxLayout()
         self.basebox = widgetBox(self, "Info", orientation=self.boxlayout)
@@ -462,57 +474,44 @@ class InfoDisplay(QWidget):
         self.line1 = QLabel("Estimated time: 0:00:00")
         self.basebox.layout().addWidget(self.line1)
 
-    def set_scan_parameters(self, scan_parameters):
-        self.scan_parameters = scan_parameters
+    def set_plan(self, plan):
+        self.plan = plan
         self.update_info()
 
-    def set_ifg_parameters(self, interferogram_parameters):
-        self.interferogram_parameters = interferogram_parameters
+    def set_error(self, message):
+        self.line1.setText(message)
+
+    def set_cost_model(self, cost_model):
+        self.cost_model = cost_model
         self.update_info()
 
     def update_info(self):
-        self.calculate_time()
-
-    def calculate_time(self):
-        if self.scan_parameters is not None and self.interferogram_parameters is not None:
-            try:
-                nop = self.scan_parameters["TargetResolutionWidth"] * self.scan_parameters["TargetResolutionHeight"] * self.interferogram_parameters["NumberOfPoints"]
-                time_per_pixel = self.scan_parameters["TargetMillisecondsPerPixel"] / 1000.0
-                total_time = nop * time_per_pixel * 2 # Multiply by 2 for forward and backward scan
-                self.line1.setText("Estimated time: " + str(datetime.timedelta(seconds=total_time)))
-            except KeyError:
-                self.line1.setText("Estimated time: Unknown")
+        if self.plan is not None:
+            self.line1.setText(self.plan.summary(self.cost_model))
 
 
 class ScanEditor(QWidget):
 
     edited = Signal(dict)
 
-    parameters = {"PhysicalOffsetX": 50.0,
-                  "PhysicalOffsetY": 50.0,
-                  "PhysicalSizeX": 100,
-                  "PhysicalSizeY": 100,
-                  "TargetResolutionWidth": 100,
-                  "TargetResolutionHeight": 100,
-                  "Angle": 0.0,
-                  "TargetMillisecondsPerPixel": 9.8}
-
     def __init__(self, parent=None, **kwargs):
         super().__init__(parent, **kwargs)
 
+        # Per editor, a second editor or the scan in progress must not see these change
+        self.parameters = dict(SCAN_DEFAULTS)
+
         layout = QVBoxLayout()
         self.setLayout(layout)
-
         # General settings for the scan
         form = QFormLayout()
         box = widgetBox(self, "Basic settings", orientation=form)
         # For scan mode selection
         self.mode_selector = QComboBox()
-        self.mode_selector.addItems(["Whitelight Step Scan"])
+        self.mode_selector.addItems([mode.value for mode in ScanMode])
         form.addRow("Scan Mode", self.mode_selector)
         # For center position of the scanner
-        self.cxedit = LineEdit(bottom=0.0, top=100.0)
-        self.cyedit = LineEdit(bottom=0.0, top=100.0)
+        self.cxedit = LineEdit(bottom=SCAN_RANGE[0], top=SCAN_RANGE[1])
+        self.cyedit = LineEdit(bottom=SCAN_RANGE[0], top=SCAN_RANGE[1])
         scanner_center_widget = QWidget()
         scanner_center_widget.setLayout(QHBoxLayout())
         scanner_center_widget.layout().addWidget(self.cxedit)
@@ -520,8 +519,8 @@ class ScanEditor(QWidget):
         scanner_center_widget.layout().addWidget(self.cyedit)
         form.addRow("Scanner Center Position", scanner_center_widget)
         # For scan area
-        self.axedit = LineEdit(bottom=0.0, top=100.0)
-        self.ayedit = LineEdit(bottom=0.0, top=100.0)
+        self.axedit = LineEdit(bottom=SCAN_RANGE[0], top=SCAN_RANGE[1])
+        self.ayedit = LineEdit(bottom=SCAN_RANGE[0], top=SCAN_RANGE[1])
         scan_area_widget = QWidget()
         scan_area_widget.setLayout(QHBoxLayout())
         scan_area_widget.layout().addWidget(self.axedit)
@@ -545,12 +544,20 @@ class ScanEditor(QWidget):
         # For integration time
         self.timeedit = LineEdit(bottom=0.4, top=1000.4)
         form.addRow("Integration Time (ms)", self.timeedit)
+        # Channels downloaded at every step, names the plan does not know show up as a plan error
+        self.channeledit = QLineEdit()
+        self.channeledit.setToolTip("Space separated, e.g. Z M1A O2A O2P")
+        form.addRow("Channels", self.channeledit)
+        self.format_selector = QComboBox()
+        self.format_selector.addItems(list(DATA_FORMATS))
+        self.format_selector.setToolTip("int16 stores every frame scaled to its own range")
+        form.addRow("Data Format", self.format_selector)
 
         self.cast_default_values()
         self.connect_signals()
-        self.edited.emit(self.parameters)
 
     def connect_signals(self):
+        self.mode_selector.currentIndexChanged.connect(self.set_parameters)
         self.timeedit.edited.connect(self.set_parameters)
         self.cxedit.edited.connect(self.set_parameters)
         self.cyedit.edited.connect(self.set_parameters)
@@ -558,21 +565,28 @@ class ScanEditor(QWidget):
         self.ayedit.edited.connect(self.set_parameters)
         self.pxedit.valueChanged.connect(self.set_parameters)
         self.pyedit.valueChanged.connect(self.set_parameters)
+        self.rotedit.edited.connect(self.set_parameters)
+        self.channeledit.editingFinished.connect(self.set_parameters)
+        self.format_selector.currentIndexChanged.connect(self.set_parameters)
 
     def cast_default_values(self):
+        self.mode_selector.setCurrentIndex([mode.name for mode in ScanMode].index(self.parameters["ScanMode"]))
         # Scanner center position
-        self.cxedit.setText(str(50.0))
-        self.cyedit.setText(str(50.0))
+        self.cxedit.setText(str(self.parameters["PhysicalOffsetX"]))
+        self.cyedit.setText(str(self.parameters["PhysicalOffsetY"]))
         # Scan area
-        self.axedit.setText(str(1.0))
-        self.ayedit.setText(str(1.0))
+        self.axedit.setText(str(self.parameters["PhysicalSizeX"]))
+        self.ayedit.setText(str(self.parameters["PhysicalSizeY"]))
         # Pixel area
-        self.pxedit.setValue(100)
-        self.pyedit.setValue(100)
+        self.pxedit.setValue(self.parameters["TargetResolutionWidth"])
+        self.pyedit.setValue(self.parameters["TargetResolutionHeight"])
         # Rotation
-        self.rotedit.setText(str(0.0))
+        self.rotedit.setText(str(self.parameters["Angle"]))
         # Integration time
-        self.timeedit.setText(str(9.8))
+        self.timeedit.setText(str(self.parameters["TargetMillisecondsPerPixel"]))
+        # Channels and data format
+        self.channeledit.setText(" ".join(self.parameters["Channels"]))
+        self.format_selector.setCurrentText(self.parameters["DataFormat"])
 
     def set_parameters(self):
         self.parameters["PhysicalOffsetX"] = float(self.cxedit.text())
@@ -583,6 +597,7 @@ class ScanEditor(QWidget):
         self.parameters["TargetResolutionHeight"] = int(self.pyedit.value())
         self.parameters["Angle"] = float(self.rotedit.text())
         self.parameters["TargetMillisecondsPerPixel"] = float(self.timeedit.text())
-
-        logger.debug("Scan parameters set: %s", self.parameters)
+        self.parameters["ScanMode"] = list(ScanMode)[self.mode_selector.currentIndex()].name
+        self.parameters["Channels"] = self.channeledit.text().replace(",", " ").split()
+        self.parameters["DataFormat"] = self.format_selector.currentText()
         self.edited.emit(self.parameters)
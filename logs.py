@@ -0,0 +1,143 @@
+"""
+Logging of the scanner
+Records are only queued by the thread that logs them, one listener thread formats and writes them to the console and to
+rotating JSON-lines files that carry the run and step the record belongs to
+"""
+
+import os
+import sys
+import json
+import queue
+import atexit
+import datetime
+import logging
+import logging.handlers
+
+ROOT = 'logger'
+
+DEFAULT_SETTINGS = {"level": "INFO",                 # level of every module without its own
+                    "levels": {},                    # per module, e.g. {stepscan: DEBUG, session: WARNING}
+                    "console": True,
+                    "console_level": "INFO",
+                    "file": "logs/scanner.jsonl",    # null writes no file
+                    "file_level": "DEBUG",
+                    "max_bytes": 10 << 20,           # size of a log file before it is rotated
+                    "backup_count": 20}              # rotated files kept
+
+CONSOLE_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Run and step the records belong to, set by the scan engine as it goes. One scan runs at a time,
+# records of the download and writer threads name their step explicitly with extra={"step": ...}
+_context = {"run": None, "step": None}
+_listener = None
+
+
+def set_run(run):
+    _context["run"] = run
+    _context["step"] = None
+
+
+def set_step(step):
+    _context["step"] = step
+
+
+def clear():
+    _context["run"] = None
+    _context["step"] = None
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Queues records as they are, the message is only formatted by the listener
+
+    The stock QueueHandler formats in the logging thread, here only the run and step are
+    attached. The arguments are referenced, not copied, so log immutable values or copies.
+    """
+
+    def prepare(self, record):
+        if getattr(record, "run", None) is None:
+            record.run = _context["run"]
+        if getattr(record, "step", None) is None:
+            record.step = _context["step"]
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record):
+        entry = {"time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+                 "level": record.levelname,
+                 "module": record.name[len(ROOT) + 1:] or ROOT,
+                 "message": record.getMessage(),
+                 "run": getattr(record, "run", None),
+                 "step": getattr(record, "step", None),
+                 "thread": record.threadName}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def _level(value):
+    return value if isinstance(value, int) else logging.getLevelName(str(value).upper())
+
+
+def setup(settings=None, level=None):
+    """Route the 'logger' hierarchy through a queue to the console and a rotating JSON-lines file
+
+    `level` overrides the configured one, e.g. for a --verbose flag. Called again it replaces
+    the previous setup. Returns the listener, which shutdown() stops at exit.
+    """
+    global _listener
+    config = dict(DEFAULT_SETTINGS)
+    config.update(settings or {})
+    shutdown()
+
+    handlers = []
+    if config["console"]:
+        console = logging.StreamHandler(sys.stderr)
+        console.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        console.setLevel(_level(level or config["console_level"]))
+        handlers.append(console)
+    if config["file"]:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(config["file"])), exist_ok=True)
+            file = logging.handlers.RotatingFileHandler(config["file"], maxBytes=int(config["max_bytes"]),
+                                                        backupCount=int(config["backup_count"]), encoding="utf-8")
+            file.setFormatter(JsonFormatter())
+            file.setLevel(_level(config["file_level"]))
+            handlers.append(file)
+        except OSError as e:
+            print(f"Cannot write the log file {config['file']}: {e}", file=sys.stderr)
+
+    records = queue.SimpleQueue()
+    logger = logging.getLogger(ROOT)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(ContextQueueHandler(records))
+    logger.propagate = False
+    logger.setLevel(_level(level or config["level"]))
+    for module, module_level in (config["levels"] or {}).items():
+        logging.getLogger(f"{ROOT}.{module}").setLevel(_level(module_level))
+
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown():
+    """Write the queued records, stop the listener and hand the 'logger' records back to the root logger"""
+    global _listener
+    if _listener is None:
+        return
+    logger = logging.getLogger(ROOT)
+    for handler in list(logger.handlers):
+        if isinstance(handler, ContextQueueHandler):
+            logger.removeHandler(handler)
+    logger.propagate = True
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,185 @@
+"""
+Live metrics of the scanner
+Serves the progress and throughput of the running scan in Prometheus text format on a local HTTP endpoint and writes the same
+text to a file, e.g. for the node_exporter textfile collector
+"""
+
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import logging
+
+logger = logging.getLogger('logger.metrics')
+
+DEFAULT_SETTINGS = {"enabled": False,
+                    "host": "127.0.0.1",     # 0.0.0.0 lets a dashboard on another machine scrape it
+                    "port": 9464,            # None serves no endpoint
+                    "textfile": None,        # e.g. C:/node_exporter/textfile/snom.prom
+                    "interval": 15.0}        # seconds between textfile writes
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# name: (type, help), in the order they are written
+METRICS = {"snom_connected": ("gauge", "1 while the SNOM connection is up"),
+           "snom_session_reconnects_total": ("counter", "Reconnects of the current session"),
+           "snom_scan_running": ("gauge", "1 while a step scan runs"),
+           "snom_scan_step": ("gauge", "Step the scan is at, counted from 1"),
+           "snom_scan_steps_total": ("gauge", "Steps of the running scan"),
+           "snom_scan_steps_done": ("gauge", "Steps of the running scan on disk"),
+           "snom_scan_pixels_per_second": ("gauge", "Pixels acquired per second in all channels since the scan started"),
+           "snom_scan_written_bytes": ("gauge", "Bytes of the running scan written to its data cube"),
+           "snom_scan_eta_seconds": ("gauge", "Predicted time until the scan finishes"),
+           "snom_scan_last_step_timestamp_seconds": ("gauge", "Unix time the last step was written, for stall alerts"),
+           "snom_writer_queue_depth": ("gauge", "Steps waiting to be written"),
+           "snom_writer_queue_capacity": ("gauge", "Steps the writer queue holds before the download waits")}
+
+# StepScan.metrics() key of each scan metric
+SCAN_KEYS = {"snom_scan_step": "step",
+             "snom_scan_steps_total": "steps",
+             "snom_scan_steps_done": "done",
+             "snom_scan_pixels_per_second": "pixels_per_second",
+             "snom_scan_written_bytes": "written_bytes",
+             "snom_scan_eta_seconds": "eta",
+             "snom_scan_last_step_timestamp_seconds": "last_step",
+             "snom_writer_queue_depth": "queue_depth",
+             "snom_writer_queue_capacity": "queue_capacity"}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render(values, labels=None):
+    """Prometheus text exposition of {name: value}, None values are left out"""
+    label = ",".join(f'{key}="{_escape(value)}"' for key, value in (labels or {}).items())
+    label = f"{{{label}}}" if label else ""
+    lines = []
+    for name, (kind, help) in METRICS.items():
+        value = values.get(name)
+        if value is None:
+            continue
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        # Full precision, the timestamps need all their digits
+        lines.append(f"{name}{label} {float(value)!r}")
+    return "\n".join(lines) + "\n"
+
+
+class Metrics():
+    """Collects the metrics when they are read, the scan itself does nothing for them
+
+    `engine()` and `session()` return what the owner currently runs, either may be None. A
+    ScanQueue is followed to the StepScan it runs. start() serves /metrics and starts the
+    textfile writes in background threads, stop() ends both.
+    """
+
+    def __init__(self, settings=None, instrument=None, engine=None, session=None):
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(settings or {})
+        self.labels = {"instrument": instrument} if instrument else {}
+        self.engine = engine
+        self.session = session
+        self.server = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    def collect(self):
+        values = {}
+        session = self.session() if self.session is not None else None
+        if session is not None:
+            values["snom_connected"] = int(not session.closed and session.connected)
+            values["snom_session_reconnects_total"] = session.reconnects
+        engine = self.engine() if self.engine is not None else None
+        # A ScanQueue runs its jobs through a StepScan of its own
+        engine = getattr(engine, "engine", engine)
+        scan = engine.metrics() if engine is not None and hasattr(engine, "metrics") else None
+        values["snom_scan_running"] = int(scan is not None)
+        if scan is not None:
+            values.update({name: scan.get(key) for name, key in SCAN_KEYS.items()})
+        return values
+
+    def text(self):
+        return render(self.collect(), self.labels)
+
+    def write_textfile(self):
+        path = self.settings["textfile"]
+        # Written next to the target and renamed, the collector never reads half a file
+        partial = f"{path}.{os.getpid()}.tmp"
+        with open(partial, "w", encoding="utf-8") as file:
+            file.write(self.text())
+        os.replace(partial, path)
+
+    def start(self):
+        if not self.settings["enabled"]:
+            return self
+        if self.settings["port"] is not None:
+            try:
+                self.server = ThreadingHTTPServer((self.settings["host"], int(self.settings["port"])), _handler(self))
+            except OSError as e:
+                logger.error("Cannot serve metrics on %s:%s: %s", self.settings["host"], self.settings["port"], e)
+            else:
+                self.server.daemon_threads = True
+                self._spawn(self.server.serve_forever, "metrics-http")
+                logger.info("Metrics on http://%s:%d/metrics", self.settings["host"], self.server.server_port)
+        if self.settings["textfile"]:
+            self._spawn(self._textfile_loop, "metrics-textfile")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        for thread in self._threads:
+            thread.join(timeout=5.0)
+        self._threads = []
+
+    def _spawn(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _textfile_loop(self):
+        failed = False
+        while True:
+            stopping = self._stop.is_set()
+            try:
+                self.write_textfile()
+                failed = False
+            except Exception as e:
+                # Logged once per outage, not on every write
+                if not failed:
+                    logger.error("Cannot write the metrics file %s: %s", self.settings["textfile"], e)
+                failed = True
+            # The last write after stop() leaves the final state in the file
+            if stopping:
+                return
+            self._stop.wait(float(self.settings["interval"]))
+
+
+def _handler(metrics):
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            try:
+                body = metrics.text().encode("utf-8")
+            except Exception as e:
+                logger.debug("Collecting metrics failed: %s", e)
+                self.send_error(500)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Every scrape would otherwise go to stderr
+            pass
+
+    return Handler
@@ -0,0 +1,254 @@
+"""
+Tiled mosaic acquisition
+Splits a region larger than one scan field into overlapping tiles visited as a serpentine, and stitches the finished tiles
+one at a time into a memory-mapped cube, so the mosaic never has to fit in memory
+"""
+
+import os
+import json
+import math
+
+import numpy as np
+import logging
+
+from datacube import DataCube, CUBE_FILE
+from registration import overlap_offsets, solve_origins
+from scanplan import SCAN_RANGE
+import storage
+
+logger = logging.getLogger('logger.mosaic')
+
+WEIGHTS_FILE = "weights.npy"
+DEFAULT_SETTINGS = {"overlap": 0.1,           # fraction of a tile shared with each neighbour
+                    "register": True,         # correct the tile positions by cross-correlating the overlaps
+                    "channel": "Z",           # channel the registration compares, the first one if missing
+                    "max_shift": 0.5,         # largest correction, as a fraction of the overlap
+                    "reference_steps": 8}     # frames averaged into the image a tile is registered with
+
+
+class MosaicLayout():
+    """Grid of tiles covering a region
+
+    Positions and sizes in µm are (x, y) like the scan parameters, pixel values are (rows, columns).
+    The grid is centred on the region and covers at least all of it, the tiles of a row are
+    visited left to right and right to left in turn.
+    """
+
+    def __init__(self, center, size, tile_size, tile_pixels, overlap=DEFAULT_SETTINGS["overlap"], name="Mosaic", settings=None):
+        if not 0.0 <= overlap < 0.5:
+            raise ValueError(f"Mosaic overlap must be in [0, 0.5), not {overlap}")
+        self.center = (float(center[0]), float(center[1]))
+        self.size = (float(size[0]), float(size[1]))
+        self.tile_size = (float(tile_size[0]), float(tile_size[1]))
+        self.tile_pixels = (int(tile_pixels[0]), int(tile_pixels[1]))
+        self.overlap = float(overlap)
+        self.name = name
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(settings or {})
+        self.settings["overlap"] = self.overlap
+
+        rows, columns = self.tile_pixels
+        self.pitch = (self.tile_size[0] / columns, self.tile_size[1] / rows)
+        self.overlap_pixels = (int(math.ceil(self.overlap * rows)), int(math.ceil(self.overlap * columns)))
+        self.stride = (rows - self.overlap_pixels[0], columns - self.overlap_pixels[1])
+        region = (self.size[1] / self.pitch[1], self.size[0] / self.pitch[0])
+        self.grid = tuple(max(1, int(math.ceil((region[i] - self.overlap_pixels[i]) / self.stride[i]))) for i in (0, 1))
+        self.shape = tuple(self.stride[i] * (self.grid[i] - 1) + self.tile_pixels[i] for i in (0, 1))
+
+    @classmethod
+    def from_recipe(cls, mosaic, scan):
+        """Layout of a recipe's 'mosaic' section, the tiles are scans with the given default scan parameters"""
+        if float(scan.get("Angle", 0.0)) != 0.0:
+            raise ValueError("Mosaic tiles cannot be rotated, set Angle to 0")
+        tile_size = mosaic.get("tile_size") or (scan["PhysicalSizeX"], scan["PhysicalSizeY"])
+        settings = {key: value for key, value in mosaic.items() if key in DEFAULT_SETTINGS}
+        layout = cls(mosaic["center"], mosaic["size"], tile_size,
+                     (scan["TargetResolutionHeight"], scan["TargetResolutionWidth"]),
+                     mosaic.get("overlap", DEFAULT_SETTINGS["overlap"]), mosaic.get("name", "Mosaic"), settings)
+        # Checked here, the instrument would only refuse the first tile outside once the queue reaches it
+        bottom, top = SCAN_RANGE
+        centers = [layout.tile_center(tile) for tile in layout.tiles()]
+        if any(not bottom <= value <= top for center in centers for value in center):
+            xs, ys = zip(*centers)
+            raise ValueError(f"{layout.name}: tile centres from x {min(xs):.1f} to {max(xs):.1f} µm and y {min(ys):.1f} "
+                             f"to {max(ys):.1f} µm fall outside the scanner range {bottom}-{top} µm")
+        return layout
+
+    def tiles(self):
+        """(row, column) of every tile in acquisition order"""
+        order = []
+        for row in range(self.grid[0]):
+            columns = range(self.grid[1]) if row % 2 == 0 else reversed(range(self.grid[1]))
+            order += [(row, column) for column in columns]
+        return order
+
+    def origin(self, tile):
+        """Nominal pixel (row, column) of the top left corner of a tile in the mosaic"""
+        return (tile[0] * self.stride[0], tile[1] * self.stride[1])
+
+    def tile_center(self, tile):
+        """Scan centre (x, y) in µm of a tile"""
+        row, column = self.origin(tile)
+        left = self.center[0] - self.shape[1] * self.pitch[0] / 2
+        top = self.center[1] - self.shape[0] * self.pitch[1] / 2
+        return (left + (column + self.tile_pixels[1] / 2) * self.pitch[0],
+                top + (row + self.tile_pixels[0] / 2) * self.pitch[1])
+
+    def neighbours(self):
+        """(tile, neighbour, axis) of every overlapping pair, axis 0 for the tile below and 1 for the one to the right"""
+        pairs = []
+        for row in range(self.grid[0]):
+            for column in range(self.grid[1]):
+                if column + 1 < self.grid[1]:
+                    pairs.append(((row, column), (row, column + 1), 1))
+                if row + 1 < self.grid[0]:
+                    pairs.append(((row, column), (row + 1, column), 0))
+        return pairs
+
+    def to_dict(self):
+        return {"name": self.name, "center": list(self.center), "size": list(self.size), "tile_size": list(self.tile_size),
+                "tile_pixels": list(self.tile_pixels), "grid": list(self.grid), "settings": self.settings}
+
+
+class TileSource():
+    """Frames of a finished tile, from its data cube or from its HDF5 result file when the cube was discarded"""
+
+    def __init__(self, result):
+        self.run_dir = result if os.path.isdir(result) else os.path.dirname(result)
+        self.cube = None
+        self.file = None
+        if os.path.exists(os.path.join(self.run_dir, CUBE_FILE)):
+            self.cube = DataCube.open(self.run_dir)
+            self.channels = self.cube.channels
+            self.positions = self.cube.positions
+            self.done = self.cube.completed_steps()
+            self.shape = self.cube.shape[2:]
+            self.dtype = np.float32 if self.cube.scales is not None else self.cube.data.dtype
+            self.simulated = bool(self.cube.meta["metadata"].get("simulated", False))
+        else:
+            if storage.h5py is None:
+                raise ImportError(f"h5py is required to read the tile {self.run_dir}")
+            self.file = storage.h5py.File(os.path.join(self.run_dir, storage.RESULT_FILE), "r")
+            self.channels = json.loads(self.file.attrs["channels"])
+            self.positions = self.file["positions"][()]
+            self.done = np.flatnonzero(self.file["done"][()])
+            dataset = self.file["channels"][self.channels[0]]
+            self.shape = dataset.shape[1:]
+            self.dtype = np.float32 if "scales" in self.file else dataset.dtype
+            self.simulated = bool(self.file["parameters"].attrs.get("simulated", False)) if "parameters" in self.file else False
+
+    def frame(self, channel, step):
+        if self.cube is not None:
+            return np.asarray(self.cube.frame(channel, step))
+        return storage.read_frames(self.file, channel, step)
+
+    def close(self):
+        if self.cube is not None:
+            self.cube.close()
+            self.cube = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def reference_image(source, channel, steps):
+    """Mean of up to `steps` frames spread over the scan"""
+    picks = np.unique(source.done[np.linspace(0, len(source.done) - 1, min(steps, len(source.done))).astype(int)])
+    return np.mean([source.frame(channel, step) for step in picks], axis=0)
+
+
+def tile_edges(image, depth):
+    rows, columns = depth
+    return {"top": image[:rows], "bottom": image[image.shape[0] - rows:],
+            "left": image[:, :columns], "right": image[:, image.shape[1] - columns:]}
+
+
+def feather(shape, overlap):
+    """Blending weight of a tile, rising linearly over the overlap towards its inside"""
+    ramps = []
+    for size, depth in zip(shape, overlap):
+        distance = np.minimum(np.arange(size), np.arange(size)[::-1]) + 1
+        ramps.append(np.minimum(distance, depth + 1) / (depth + 1))
+    return np.outer(*ramps)
+
+
+def register(layout, sources):
+    """Tile origins corrected by cross-correlating the overlaps, only the tile borders are kept in memory"""
+    nominal = {tile: layout.origin(tile) for tile in layout.tiles()}
+    if not layout.settings["register"] or len(sources) < 2 or min(layout.overlap_pixels) == 0:
+        return nominal
+    first = sources[layout.tiles()[0]]
+    channel = layout.settings["channel"] if layout.settings["channel"] in first.channels else first.channels[0]
+    # Strips reach `margin` beyond the overlap, so a tile that is off by up to that much still overlaps fully
+    margin = tuple(max(1, int(round(overlap * layout.settings["max_shift"]))) for overlap in layout.overlap_pixels)
+    depth = tuple(min(overlap + extra, size) for overlap, extra, size in zip(layout.overlap_pixels, margin, layout.tile_pixels))
+    margin = tuple(d - overlap for d, overlap in zip(depth, layout.overlap_pixels))
+    edges = {tile: tile_edges(reference_image(source, channel, layout.settings["reference_steps"]), depth)
+             for tile, source in sources.items()}
+    offsets = overlap_offsets(edges, layout.neighbours(), margin)
+    origins = solve_origins(nominal, offsets, anchor=layout.tiles()[0])
+    correction = max(math.dist(origins[tile], nominal[tile]) for tile in nominal)
+    logger.info("%s registered on %s, largest correction %.1f px", layout.name, channel, correction)
+    return origins
+
+
+def stitch(layout, results, path, storage_settings=None, progress=None):
+    """Blend the finished tiles into one cube in `path` and save it like a run
+
+    `results` maps every tile to the result path of its scan. The tiles are placed at their
+    registered origins rounded to whole pixels and feathered across the overlaps. Only one tile
+    frame and the mosaic's 2D weight map, itself memory-mapped, are handled at a time.
+    """
+    sources = {}
+    try:
+        for tile in layout.tiles():
+            sources[tile] = TileSource(results[tile])
+        first = sources[layout.tiles()[0]]
+        for tile, source in sources.items():
+            if source.channels != first.channels or tuple(source.shape) != tuple(first.shape) \
+                    or not np.allclose(source.positions, first.positions):
+                raise ValueError(f"Tile {tile} of {layout.name} does not match the others in channels, size or positions")
+        height, width = first.shape
+
+        origins = register(layout, sources)
+        top = min(int(round(origin[0])) for origin in origins.values())
+        left = min(int(round(origin[1])) for origin in origins.values())
+        placed = {tile: (int(round(y)) - top, int(round(x)) - left) for tile, (y, x) in origins.items()}
+        shape = (max(y for y, _ in placed.values()) + height, max(x for _, x in placed.values()) + width)
+        done = sorted(set.intersection(*(set(source.done.tolist()) for source in sources.values())))
+
+        weight = feather((height, width), layout.overlap_pixels)
+        output = DataCube.create(path, first.channels, first.positions, shape[0], shape[1],
+                                 dtype=np.result_type(first.dtype, np.float32),
+                                 # As JSON, like the channels, so they go into the result file as plain attributes
+                                 metadata={"name": layout.name, "mosaic": json.dumps(layout.to_dict()),
+                                           "tiles": json.dumps([{"tile": list(tile), "result": results[tile],
+                                                                 "origin": list(placed[tile])} for tile in layout.tiles()]),
+                                           "simulated": any(source.simulated for source in sources.values())})
+        weights = np.lib.format.open_memmap(os.path.join(path, WEIGHTS_FILE), mode="w+", dtype=np.float32, shape=shape)
+        for y, x in placed.values():
+            weights[y:y + height, x:x + width] += weight
+
+        for count, tile in enumerate(layout.tiles()):
+            y, x = placed[tile]
+            share = weight / weights[y:y + height, x:x + width]
+            source = sources[tile]
+            for index, channel in enumerate(first.channels):
+                for step in done:
+                    output.data[index, step, y:y + height, x:x + width] += source.frame(channel, step) * share
+            source.close()
+            if progress is not None:
+                progress(f"{layout.name}: stitched tile {count + 1}/{len(placed)}")
+        output.done[done] = 1
+        output.data.flush()
+        del weights
+        os.remove(os.path.join(path, WEIGHTS_FILE))
+
+        result = storage.save_cube(output, storage_settings)
+        output.close()
+        logger.info("%s of %dx%d tiles stitched into %s (%d x %d px)", layout.name, layout.grid[0], layout.grid[1],
+                    result, shape[0], shape[1])
+        return result
+    finally:
+        for source in sources.values():
+            source.close()
@@ -0,0 +1,251 @@
+"""
+Simulated neaSNOM backend
+Stands in for nea_tools so scans can run, be profiled and load-tested without the SDK or the microscope
+"""
+
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import logging
+
+logger = logging.getLogger('logger.nea_sim')
+
+DEFAULT_SETTINGS = {"scan_duration": None,      # seconds per scan, None derives it from the pixel time
+                    "time_scale": 0.001,        # fraction of the real pixel time spent when scan_duration is None
+                    "approach_time": 0.0,       # seconds spent in approach_sample
+                    "connect_time": 0.0,        # seconds spent in connect
+                    "download_latency": 0.0,    # seconds per channel download
+                    "failure_rate": 0.0,        # probability that a scan raises ConnectionError
+                    "disconnect_rate": 0.0,     # probability that a call drops the connection until the next connect
+                    "drift": None,              # [x, y] µm the sample moves per scan, None keeps it still
+                    "seed": None}
+
+# Broadband source and sample absorption lines of the synthetic sample, in cm^-1
+SOURCE_CENTER = 1200.0
+SOURCE_WIDTH = 250.0
+ZERO_PATH_POSITION = 400.0
+MATERIALS = [(1050.0, 0.4), (1450.0, 0.3), (1730.0, 0.5)]
+
+
+class SimulatedSample():
+    """Synthetic sample made of a few round particles on a tilted substrate"""
+
+    def __init__(self, seed=None):
+        rng = np.random.default_rng(seed)
+        self.particles = [(rng.uniform(0.0, 100.0),         # x center (um)
+                           rng.uniform(0.0, 100.0),         # y center (um)
+                           rng.uniform(0.5, 5.0),           # radius (um)
+                           rng.uniform(20.0, 150.0),        # height (nm)
+                           int(rng.integers(len(MATERIALS))))
+                          for _ in range(40)]
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def maps(self, parameters):
+        """Height and coverage maps of a scan area, cached because every step of a step scan shares them"""
+        key = tuple(float(parameters.get(name, 0.0)) for name in
+                    ("TargetResolutionWidth", "TargetResolutionHeight", "PhysicalOffsetX", "PhysicalOffsetY",
+                     "PhysicalSizeX", "PhysicalSizeY"))
+        if key not in self._maps:
+            width, height, cx, cy, sx, sy = key
+            x = cx + np.linspace(-sx / 2, sx / 2, int(width))
+            y = cy + np.linspace(-sy / 2, sy / 2, int(height))
+            self._maps.clear()
+            self._maps[key] = self.material_maps(*np.meshgrid(x, y))
+        return self._maps[key]
+
+    def material_maps(self, X, Y):
+        """Height (nm) and per-material coverage of every pixel"""
+        height = 0.002 * X + 0.001 * Y
+        coverage = np.zeros((len(MATERIALS),) + X.shape)
+        for px, py, radius, h, material in self.particles:
+            r2 = ((X - px)**2 + (Y - py)**2) / radius**2
+            mask = np.exp(-r2**2)
+            height = height + h * mask
+            coverage[material] += mask
+        return height, np.clip(coverage, 0.0, 1.0)
+
+    def interferogram(self, coverage, position):
+        """Optical signal at one interferometer position for every pixel"""
+        opd = 2.0 * (position - ZERO_PATH_POSITION) * 1e-4     # optical path difference in cm
+        envelope = np.exp(-2.0 * (np.pi * SOURCE_WIDTH * opd)**2)
+        signal = np.full(coverage.shape[1:], envelope * np.cos(2 * np.pi * SOURCE_CENTER * opd))
+        for (wavenumber, strength), cov in zip(MATERIALS, coverage):
+            line = np.exp(-np.pi * 10.0 * abs(opd)) * envelope * np.cos(2 * np.pi * wavenumber * opd)
+            signal -= strength * cov * line
+        return signal
+
+    def channel(self, name, parameters, position):
+        with self._lock:
+            height, coverage = self.maps(parameters)
+        if name == "Z":
+            return height.copy()
+        order = int(name[1]) if name[1:2].isdigit() else 1
+        signal = self.interferogram(coverage, position)
+        if name.endswith("P"):
+            return 0.1 * signal / (order + 1)
+        return (1.0 + signal) / (order + 1)
+
+
+class SimulatedScanData():
+    """Lazy channel access of a finished scan, each download costs download_latency"""
+
+    def __init__(self, scan):
+        self.scan = scan
+
+    def __getitem__(self, channel):
+        backend = self.scan.backend
+        if backend.settings["download_latency"]:
+            time.sleep(backend.settings["download_latency"])
+        position = self.scan.parameters.get("PhysicalRangeM", (ZERO_PATH_POSITION, ZERO_PATH_POSITION))[0]
+        return backend.sample.channel(channel, self.scan.view, position)
+
+
+class Whitelight():
+    """Mimics nea_tools.logic.scan.Whitelight"""
+
+    def __init__(self, backend, **parameters):
+        self.backend = backend
+        self.parameters = parameters
+        self.data = SimulatedScanData(self)
+        self._stopped = threading.Event()
+        self._started = None
+        self._duration = 0.0
+        # Scanned area relative to the sample, moved by the drift when the scan starts
+        self.view = parameters
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def scan_duration(self):
+        settings = self.backend.settings
+        if settings["scan_duration"] is not None:
+            return float(settings["scan_duration"])
+        pixels = self.parameters.get("TargetResolutionWidth", 1) * self.parameters.get("TargetResolutionHeight", 1)
+        return pixels * self.parameters.get("TargetMillisecondsPerPixel", 0.0) / 1000.0 * 2 * settings["time_scale"]
+
+    def scan(self):
+        self.backend.check_connection()
+        self.backend.maybe_fail("scan start")
+        self._stopped.clear()
+        drift_x, drift_y = self.backend.advance_drift()
+        self.view = dict(self.parameters, PhysicalOffsetX=self.parameters.get("PhysicalOffsetX", 0.0) - drift_x,
+                         PhysicalOffsetY=self.parameters.get("PhysicalOffsetY", 0.0) - drift_y)
+        self._duration = self.scan_duration()
+        self._started = time.perf_counter()
+
+    def wait_for_scan(self):
+        if self._started is None:
+            raise RuntimeError("Scan was not started")
+        remaining = self._started + self._duration - time.perf_counter()
+        if remaining > 0:
+            self._stopped.wait(remaining)
+        self.backend.maybe_fail("scan")
+
+    def stop(self):
+        self._stopped.set()
+
+
+class SimulatedNea():
+    """Stand-in for the nea_tools module and the neaspec context"""
+
+    def __init__(self, settings=None):
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(settings or {})
+        self.rng = np.random.default_rng(self.settings["seed"])
+        self.sample = SimulatedSample(self.settings["seed"])
+        self.connected = False
+
+        self.scan = SimpleNamespace(Whitelight=lambda **kwargs: Whitelight(self, **kwargs))
+        self.spawned = 0
+        self.drift = (0.0, 0.0)
+        self.context = SimpleNamespace(Logic=SimpleNamespace(DefaultScanParameters=SimpleNamespace(Spawn=self.spawn)))
+
+    async def connect(self, host, fingerprint, path_to_dll):
+        await asyncio.sleep(self.settings["connect_time"])
+        self.connected = True
+        logger.info("Connected to simulated %s", host)
+
+    def disconnect(self):
+        self.connected = False
+
+    def spawn(self):
+        self.check_connection()
+        self.maybe_fail("spawn")
+        self.spawned += 1
+        return SimpleNamespace(LaserSourceTargetWavelength=0.0)
+
+    def advance_drift(self):
+        """Sample position of the next scan"""
+        if self.settings["drift"] is not None:
+            self.drift = (self.drift[0] + self.settings["drift"][0], self.drift[1] + self.settings["drift"][1])
+        return self.drift
+
+    def check_connection(self):
+        if not self.connected:
+            raise ConnectionError("Simulated SNOM is not connected")
+
+    def maybe_fail(self, what):
+        if self.settings["disconnect_rate"] and self.rng.random() < self.settings["disconnect_rate"]:
+            self.connected = False
+            raise ConnectionError(f"Simulated connection drop during {what}")
+        if self.settings["failure_rate"] and self.rng.random() < self.settings["failure_rate"]:
+            raise ConnectionError(f"Simulated failure during {what}")
+
+    def approach_sample(self, setpoint):
+        self.check_connection()
+        time.sleep(self.settings["approach_time"])
+
+
+class SimulatedSNOM():
+    """Drop-in replacement of ScannerApp.neaSNOM backed by SimulatedNea"""
+
+    # Recorded in the run metadata, synthetic data never passes for a measurement
+    simulated = True
+
+    def __init__(self, settings=None):
+        self.name = "Simulated SNOM"
+        self.connected = False
+        self.engaged = False
+        self.context = None
+        self.nea = None
+        self.scan_parameters = None
+        self.backend = SimulatedNea(settings)
+        self.scan = self.backend.scan
+        self.approach_sample = self.backend.approach_sample
+
+    async def connect(self, path_to_dll, fingerprint):
+        await self.backend.connect('nea-server', fingerprint, path_to_dll)
+        self.connected = True
+        self.engaged = False
+        self.context = self.backend.context
+        self.scan_parameters = None
+        return True
+
+    def spawn_parameters(self):
+        if self.connected:
+            self.scan_parameters = self.context.Logic.DefaultScanParameters.Spawn()
+
+    def default_parameters(self):
+        """Spawned default scan parameters, cached until the next connect"""
+        if self.scan_parameters is None:
+            if not self.connected:
+                raise ConnectionError("Simulated SNOM is not connected")
+            self.spawn_parameters()
+        return self.scan_parameters
+
+    def close(self):
+        if self.connected:
+            logger.debug('\nDisconnecting from simulated neaServer!')
+            self.backend.disconnect()
+            self.connected = False
+            self.engaged = False
+        else:
+            logger.debug("SNOM was not connected!")
@@ -0,0 +1,139 @@
+"""
+Live preview of a running step scan
+Shows the latest step image and the interferogram of a chosen pixel, read straight from the memory-mapped data cube
+"""
+
+import numpy as np
+import pyqtgraph as pg
+
+from PySide6.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLabel, QComboBox
+from PySide6.QtCore import QTimer
+
+from datacube import DataCube
+
+import logging
+
+logger = logging.getLogger('logger.preview')
+
+MAX_DISPLAY_PIXELS = 512
+REFRESH_INTERVAL_MS = 200
+
+
+class LivePreview(QWidget):
+    """Redraws at most every REFRESH_INTERVAL_MS and only when a new step arrived
+
+    step_done() is cheap, it only records the step and writes one value per step into the
+    interferogram buffer, all drawing happens in the throttled refresh()
+    """
+
+    def __init__(self, parent=None, **kwargs):
+        super().__init__(parent, **kwargs)
+
+        self.cube = None
+        self.channel = None
+        self.channel_index = 0
+        self.pixel = (0, 0)
+        self.latest_step = None
+        self.interferogram = np.zeros(0)
+        self.dirty = False
+
+        self.setLayout(QVBoxLayout())
+        header = QWidget()
+        header.setLayout(QHBoxLayout())
+        header.layout().setContentsMargins(0, 0, 0, 0)
+        self.channel_selector = QComboBox()
+        self.channel_selector.currentTextChanged.connect(self.set_channel)
+        self.pixel_label = QLabel("Pixel: -")
+        header.layout().addWidget(QLabel("Channel"))
+        header.layout().addWidget(self.channel_selector)
+        header.layout().addWidget(self.pixel_label)
+        header.layout().addStretch()
+        self.layout().addWidget(header)
+
+        self.image_plot = pg.PlotWidget()
+        self.image_plot.setAspectLocked(True)
+        self.image_plot.invertY(True)
+        self.image = pg.ImageItem(axisOrder='row-major')
+        self.image_plot.addItem(self.image)
+        self.marker = pg.ScatterPlotItem(size=10, pen=pg.mkPen('r'), brush=None)
+        self.image_plot.addItem(self.marker)
+        self.image.mouseClickEvent = self.on_image_clicked
+        self.layout().addWidget(self.image_plot, 3)
+
+        self.ifg_plot = pg.PlotWidget()
+        self.ifg_plot.setLabel('bottom', "Interferometer position")
+        self.ifg_curve = self.ifg_plot.plot(pen='y')
+        self.layout().addWidget(self.ifg_plot, 2)
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(REFRESH_INTERVAL_MS)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start()
+
+    def open_cube(self, path):
+        self.cube = DataCube.open(path)
+        self.latest_step = None
+        self.interferogram = np.full(self.cube.shape[1], np.nan)
+        height, width = self.cube.shape[2:]
+        self.pixel = (height // 2, width // 2)
+        channels = self.cube.channels
+        self.channel_selector.blockSignals(True)
+        self.channel_selector.clear()
+        self.channel_selector.addItems(channels)
+        self.channel_selector.blockSignals(False)
+        optical = [channel for channel in channels if channel != "Z"]
+        self.channel_selector.setCurrentText(optical[0] if optical else channels[0])
+        self.set_channel(self.channel_selector.currentText())
+
+    def step_done(self, step, position):
+        if self.cube is None:
+            return
+        self.latest_step = step
+        y, x = self.pixel
+        self.interferogram[step] = self.cube.block(self.channel_index, step, y, x)
+        self.dirty = True
+
+    def set_channel(self, channel):
+        if self.cube is None or not channel:
+            return
+        self.channel = channel
+        self.channel_index = self.cube.channel_index(channel)
+        self.reload_interferogram()
+
+    def set_pixel(self, y, x):
+        height, width = self.cube.shape[2:]
+        self.pixel = (int(np.clip(y, 0, height - 1)), int(np.clip(x, 0, width - 1)))
+        self.reload_interferogram()
+
+    def reload_interferogram(self):
+        # Only needed when the channel or the pixel changes, new steps are added one by one
+        done = self.cube.completed_steps()
+        self.interferogram[:] = np.nan
+        y, x = self.pixel
+        self.interferogram[done] = self.cube.block(self.channel_index, done, y, x)
+        self.dirty = True
+
+    def display_stride(self):
+        height, width = self.cube.shape[2:]
+        return max(1, int(np.ceil(max(height, width) / MAX_DISPLAY_PIXELS)))
+
+    def on_image_clicked(self, event):
+        if self.cube is None:
+            return
+        stride = self.display_stride()
+        pos = event.pos()
+        self.set_pixel(int(pos.y()) * stride, int(pos.x()) * stride)
+
+    def refresh(self):
+        if not self.dirty or self.cube is None:
+            return
+        self.dirty = False
+        stride = self.display_stride()
+        if self.latest_step is not None:
+            frame = np.asarray(self.cube.block(self.channel_index, self.latest_step, slice(None, None, stride), slice(None, None, stride)))
+            self.image.setImage(frame, autoLevels=True)
+        y, x = self.pixel
+        self.marker.setData([x / stride + 0.5], [y / stride + 0.5])
+        self.pixel_label.setText(f"Pixel: {x}, {y}")
+        valid = ~np.isnan(self.interferogram)
+        self.ifg_curve.setData(self.cube.positions[valid], self.interferogram[valid])
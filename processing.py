@@ -0,0 +1,324 @@
+"""
+Interferogram to spectrum processing
+Turns the white-light interferograms of a whole step-scan cube into spectra, tile by tile over the memory map:
+offset removal, apodization, zero-filling, batched real FFT and Mertz phase correction.
+Tiles are spread over a process pool, the workers map the cubes themselves so no array data is pickled.
+Cubes measured at a subset of the interferometer positions are rebuilt with sampling.SampledTransform.
+
+    python processing.py data/<run folder>          # writes data/<run folder>/spectra
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import logging
+
+from datacube import DataCube
+
+logger = logging.getLogger('logger.processing')
+
+SPECTRA_DIR = "spectra"
+DEFAULT_SETTINGS = {"enabled": False,
+                    "channels": None,                   # None processes every optical channel (all but Z)
+                    "apodization": "blackman-harris",   # boxcar, triangle, happ-genzel or blackman-harris
+                    "zero_fill": 2,                     # FFT length is the next power of two of the steps times this
+                    "phase_correction": "mertz",        # mertz or None (keep the complex spectrum)
+                    "phase_points": 64,                 # points on each side of the ZPD used for the Mertz phase
+                    "zpd": None,                        # position of zero path difference, None finds it in the data
+                    "wavenumber_range": None,           # [min, max] in 1/cm, None keeps everything up to Nyquist
+                    "chunk_bytes": 64 << 20,            # working memory per tile
+                    "workers": None,                    # processes, None uses every core, 1 runs in-process
+                    "live": False,                      # also update the spectra from the finished steps during the scan
+                    "live_interval": 10,                # steps between live updates
+                    "reconstruction": "nudft",          # non-uniformly sampled cubes: nudft or sparse
+                    "sparse_iterations": 50}            # thresholding passes of the sparse reconstruction
+
+# Coefficients of cos(k pi u), u = |OPD| / max |OPD|
+WINDOWS = {"boxcar": (1.0,),
+           "happ-genzel": (0.54, 0.46),
+           "blackman-harris": (0.42323, 0.49755, 0.07922)}
+ZPD_SAMPLE_PIXELS = 64
+
+
+def apodization(name, opd):
+    """Window value at every optical path difference, 1 at the ZPD and 0 at the far end"""
+    extent = np.abs(opd).max()
+    u = np.abs(opd) / extent if extent > 0 else np.zeros_like(opd)
+    if name is None:
+        name = "boxcar"
+    if name == "triangle":
+        return 1.0 - u
+    if name not in WINDOWS:
+        raise ValueError(f"Unknown apodization {name}, use one of {['triangle'] + list(WINDOWS)}")
+    return sum(c * np.cos(k * np.pi * u) for k, c in enumerate(WINDOWS[name]))
+
+
+def find_zpd(cube, channel, done=None):
+    """Position of the strongest interferogram modulation, averaged over a subsample of the pixels"""
+    index = cube.channel_index(channel)
+    done = cube.completed_steps() if done is None else done
+    height, width = cube.shape[2:]
+    stride = max(1, int(np.ceil(max(height, width) / ZPD_SAMPLE_PIXELS)))
+    block = np.asarray(cube.block(index, done, slice(None, None, stride), slice(None, None, stride)), dtype=np.float64)
+    block -= block.mean(axis=0)
+    return float(cube.positions[done][np.argmax(np.abs(block).mean(axis=(1, 2)))])
+
+
+class SpectralTransform():
+    """Precomputed window, ordering and FFT plan of a set of interferometer positions
+
+    Positions are mirror positions in um, so the optical path difference is twice the mirror travel.
+    transform() works on any block of shape (steps, ...) and returns (wavenumbers, ...), so the same
+    plan serves a single pixel, a few image rows or a whole cube.
+    """
+
+    def __init__(self, positions, zpd, settings=None):
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(settings or {})
+        positions = np.asarray(positions, dtype=np.float64)
+        if len(positions) < 2:
+            raise ValueError("At least two interferometer positions are needed for a spectrum")
+
+        # FFT order is ascending path difference
+        self.order = np.argsort(positions)
+        opd = 2.0 * (positions[self.order] - zpd) * 1e-4     # cm
+        spacing = np.diff(opd)
+        if not np.allclose(spacing, spacing[0], rtol=1e-3):
+            raise ValueError("The interferometer positions are not evenly spaced")
+        self.spacing = float(spacing[0])
+        self.zpd = float(zpd)
+        self.zpd_index = int(np.argmin(np.abs(opd)))
+        self.steps = len(positions)
+
+        length = 1 << int(np.ceil(np.log2(self.steps)))
+        self.n_fft = length * max(1, int(self.settings["zero_fill"]))
+        wavenumbers = np.fft.rfftfreq(self.n_fft, self.spacing)
+        self.bins = np.arange(len(wavenumbers))
+        if self.settings["wavenumber_range"] is not None:
+            low, high = self.settings["wavenumber_range"]
+            self.bins = np.flatnonzero((wavenumbers >= low) & (wavenumbers <= high))
+        self.wavenumbers = wavenumbers[self.bins]
+
+        self.window = apodization(self.settings["apodization"], opd)
+        self.phase_window = None
+        if self.settings["phase_correction"] == "mertz":
+            # Short double-sided part around the ZPD, triangle weighted
+            points = int(self.settings["phase_points"])
+            offset = np.arange(self.steps) - self.zpd_index
+            self.phase_window = np.clip(1.0 - np.abs(offset) / max(points, 1), 0.0, None)
+            # Mertz ramp, the double-sided part is otherwise counted twice on a single-sided interferogram
+            short = min(self.zpd_index, self.steps - 1 - self.zpd_index)
+            if short < 0.9 * max(self.zpd_index, self.steps - 1 - self.zpd_index):
+                long_side = 1.0 if self.steps - 1 - self.zpd_index > self.zpd_index else -1.0
+                ramp = np.clip((long_side * offset + short) / (2.0 * max(short, 1)), 0.0, 1.0)
+                self.window = self.window * ramp
+        elif self.settings["phase_correction"] is not None:
+            raise ValueError(f"Unknown phase correction {self.settings['phase_correction']}")
+
+    def _rotated_fft(self, block, window):
+        """FFT with the ZPD sample at index 0 and the negative path differences wrapped to the end"""
+        shape = (window.shape[0],) + (1,) * (block.ndim - 1)
+        weighted = block * window.reshape(shape)
+        buffer = np.zeros((self.n_fft,) + block.shape[1:], dtype=np.float64)
+        head = self.steps - self.zpd_index
+        buffer[:head] = weighted[self.zpd_index:]
+        buffer[self.n_fft - self.zpd_index:] = weighted[:self.zpd_index]
+        return np.fft.rfft(buffer, axis=0)[self.bins]
+
+    def transform(self, block, valid=None):
+        """Spectra of interferograms of shape (steps, ...), in acquisition order
+
+        `valid` flags the steps that were measured, the others are treated as zero signal
+        """
+        block = np.asarray(block, dtype=np.float64)[self.order]
+        if valid is not None:
+            valid = np.asarray(valid, dtype=bool)[self.order]
+            block -= block[valid].mean(axis=0)
+            block[~valid] = 0.0
+        else:
+            block -= block.mean(axis=0)
+        spectrum = self._rotated_fft(block, self.window)
+        if self.phase_window is not None:
+            phase = np.angle(self._rotated_fft(block, self.phase_window))
+            spectrum *= np.exp(-1j * phase)
+        return spectrum
+
+    def rows_per_chunk(self, width):
+        # Float input, zero-filled buffer and the complex spectra of the main and the phase FFT
+        per_row = width * (self.steps * 8 + self.n_fft * 8 + self.n_fft * 16 * 2)
+        return max(1, int(self.settings["chunk_bytes"] // per_row))
+
+
+def spectral_transform(positions, zpd, settings=None, ifg=None):
+    """Transform plan of a cube, `ifg` are the interferometer parameters of its run if known"""
+    sampling = (ifg or {}).get("Sampling", "uniform")
+    spacing = np.diff(np.sort(np.asarray(positions, dtype=np.float64)))
+    if sampling == "uniform" and len(spacing) and np.allclose(spacing, spacing[0], rtol=1e-3):
+        return SpectralTransform(positions, zpd, settings)
+    # sampling builds on this module
+    from sampling import SampledTransform, reconstruction_grid
+    return SampledTransform(positions, zpd, reconstruction_grid(positions, ifg), settings)
+
+
+# Cubes mapped by a pool worker, reused by all tiles of the same processing pass
+_worker_cubes = {}
+
+
+def _open_cubes(source_path, output_path, generation):
+    key = (source_path, output_path, generation)
+    if key not in _worker_cubes:
+        _worker_cubes.clear()
+        _worker_cubes[key] = (DataCube.open(source_path, mode="r"), DataCube.open(output_path, mode="r+"))
+    return _worker_cubes[key]
+
+
+def _process_tile(source, output, plan, valid, pairs, rows):
+    y0, y1 = rows
+    for src, dst in pairs:
+        output.data[dst, :, y0:y1] = plan.transform(source.block(src, slice(None), slice(y0, y1)), valid)
+
+
+def _pool_tile(source_path, output_path, generation, plan, valid, pairs, rows):
+    source, output = _open_cubes(source_path, output_path, generation)
+    _process_tile(source, output, plan, valid, pairs, rows)
+
+
+class ProcessingEngine():
+    """Computes the spectra of a cube with a long-lived pool of worker processes
+
+    The cube is split into tiles of whole image rows, which are contiguous for every step in the
+    memory map. Each worker maps the source and the output cube read from disk and writes its tile
+    of the output in place, only the tile bounds and the small transform plan are sent to it.
+    process() only reads the steps flagged done, so it can run while the scan still writes the cube.
+    """
+
+    def __init__(self, settings=None):
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(settings or {})
+        self.workers = int(self.settings["workers"] or os.cpu_count() or 1)
+        self._pool = None
+        self._generation = 0
+
+    @property
+    def enabled(self):
+        return bool(self.settings["enabled"])
+
+    @property
+    def pool(self):
+        if self._pool is None and self.workers > 1:
+            # Spawned, forking a process with running Qt and asyncio threads is not safe
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def _output(self, cube, path, channels, plan):
+        """Output cube of the run, reused between the updates of a running scan"""
+        height, width = cube.shape[2:]
+        shape = (len(channels), len(plan.wavenumbers), height, width)
+        if os.path.exists(os.path.join(path, "cube.json")):
+            output = DataCube.open(path, mode="r+")
+            if output.shape == shape and output.channels == list(channels):
+                return output
+            output.close()
+        self._generation += 1
+        return DataCube.create(path, channels, plan.wavenumbers, height, width, dtype=np.complex64,
+                               metadata={"axis": "wavenumber", "unit": "1/cm"})
+
+    def process(self, cube, path=None, progress=None):
+        """Write the spectra of the optical channels into a complex64 cube of shape (channels, wavenumbers, height, width)
+
+        With Mertz phase correction the real part is the corrected spectrum, without it the complex
+        spectrum is kept so amplitude and phase can be taken from it. Steps that are not done yet count as zero.
+        """
+        config = self.settings
+        channels = config["channels"] or [channel for channel in cube.channels if channel != "Z"]
+        if not channels:
+            raise ValueError(f"No channels to process in {cube.path}")
+        done = cube.completed_steps()
+        if len(done) < 2:
+            raise ValueError(f"Only {len(done)} completed steps in {cube.path}")
+        valid = np.zeros(cube.shape[1], dtype=bool)
+        valid[done] = True
+
+        zpd = config["zpd"] if config["zpd"] is not None else find_zpd(cube, channels[0], done)
+        plan = spectral_transform(cube.positions, zpd, config, cube.meta.get("metadata", {}).get("ifg"))
+        height, width = cube.shape[2:]
+        path = path or os.path.join(cube.path, SPECTRA_DIR)
+        output = self._output(cube, path, channels, plan)
+        pairs = [(cube.channel_index(channel), index) for index, channel in enumerate(channels)]
+
+        start = time.perf_counter()
+        pool = self.pool
+        if pool is None:
+            rows = plan.rows_per_chunk(width)
+            for y in range(0, height, rows):
+                _process_tile(cube, output, plan, valid, pairs, (y, min(y + rows, height)))
+        else:
+            # A few tiles per worker balances the load, the bound keeps the memory per worker fixed
+            rows = max(1, min(plan.rows_per_chunk(width), height // (4 * self.workers)))
+            output.data.flush()
+            futures = [pool.submit(_pool_tile, cube.path, path, self._generation, plan, valid, pairs, (y, min(y + rows, height)))
+                       for y in range(0, height, rows)]
+            for future in futures:
+                future.result()
+
+        output.done[:] = 1
+        output.update_metadata(zpd=zpd, steps_done=int(len(done)), processing=config,
+                               source=cube.meta.get("metadata", {}))
+        output.close()
+        if progress is not None:
+            progress(f"Spectra of {len(channels)} channels computed from {len(done)}/{cube.shape[1]} steps")
+        logger.info("Spectra of %s (%d/%d steps) written to %s in %.2f s", cube.path, len(done), cube.shape[1],
+                    path, time.perf_counter() - start)
+        return path
+
+
+def process_cube(cube, settings=None, path=None, progress=None):
+    """Spectra of a cube with a one-off engine, see ProcessingEngine.process"""
+    engine = ProcessingEngine(settings)
+    try:
+        return engine.process(cube, path, progress)
+    finally:
+        engine.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("run", help="run folder containing the data cube")
+    parser.add_argument("--channels", nargs="+", help="channels to process (default: all but Z)")
+    parser.add_argument("--apodization", default=DEFAULT_SETTINGS["apodization"])
+    parser.add_argument("--zero-fill", type=int, default=DEFAULT_SETTINGS["zero_fill"])
+    parser.add_argument("--no-phase-correction", action="store_true", help="keep the complex spectrum")
+    parser.add_argument("--zpd", type=float, help="position of zero path difference")
+    parser.add_argument("--range", nargs=2, type=float, metavar=("MIN", "MAX"), help="wavenumber range in 1/cm")
+    parser.add_argument("--workers", type=int, help="worker processes (default: all cores)")
+    parser.add_argument("--reconstruction", choices=("nudft", "sparse"), default=DEFAULT_SETTINGS["reconstruction"],
+                        help="method for cubes measured at a subset of the positions")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('logger').setLevel(logging.INFO)
+
+    settings = {"channels": args.channels, "apodization": args.apodization, "zero_fill": args.zero_fill,
+                "phase_correction": None if args.no_phase_correction else "mertz",
+                "zpd": args.zpd, "wavenumber_range": args.range, "workers": args.workers,
+                "reconstruction": args.reconstruction}
+    cube = DataCube.open(args.run)
+    try:
+        process_cube(cube, settings, progress=logger.info)
+    finally:
+        cube.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Registration of overlapping image tiles
+Normalised cross-correlation over the overlap of neighbouring tiles and a least-squares fit of the tile origins to all measured offsets
+"""
+
+import numpy as np
+import logging
+
+logger = logging.getLogger('logger.registration')
+
+MIN_PEAK = 0.5          # pairs with a lower correlation keep their nominal offset
+NOMINAL_WEIGHT = 0.01   # weight of the nominal offset of an untrusted pair, keeps the fit determined
+MIN_SHARED = 0.5        # smallest shared area of a candidate shift, as a fraction of the strip
+FLAT = 1e-6             # strips whose relief is below this fraction of their values have nothing to lock on to
+
+
+def level(image):
+    """Image minus its least-squares plane, a tilted but otherwise featureless strip then has nothing to lock on to"""
+    height, width = image.shape
+    y, x = np.mgrid[0:height, 0:width]
+    design = np.column_stack((np.ones(image.size), y.ravel(), x.ravel()))
+    coefficients, *_ = np.linalg.lstsq(design, image.ravel(), rcond=None)
+    return image - (design @ coefficients).reshape(image.shape)
+
+
+def _ncc(a, b):
+    a = level(a)
+    b = level(b)
+    norm = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / norm) if norm > 0 else 0.0
+
+
+def cross_correlation(reference, moving, offset, max_shift):
+    """(dy, dx, peak) of the best match of `moving` placed at `offset` + (dy, dx) on `reference`
+
+    Every whole-pixel shift up to `max_shift` (rows, columns) is scored by the normalised
+    correlation of the area both images cover there, the best one is refined to a fraction of a
+    pixel with a parabola. `peak` is that correlation, near 1 for the same content.
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    moving = np.asarray(moving, dtype=np.float64)
+    for strip in (reference, moving):
+        if np.std(level(strip)) <= FLAT * max(np.abs(strip).max(), 1e-300):
+            return 0.0, 0.0, 0.0
+    limit_y, limit_x = int(max_shift[0]), int(max_shift[1])
+    scores = np.full((2 * limit_y + 1, 2 * limit_x + 1), -np.inf)
+    smallest = MIN_SHARED * min(reference.size, moving.size)
+    for i, dy in enumerate(range(-limit_y, limit_y + 1)):
+        for j, dx in enumerate(range(-limit_x, limit_x + 1)):
+            y0, x0 = offset[0] + dy, offset[1] + dx
+            top, left = max(0, y0), max(0, x0)
+            bottom = min(reference.shape[0], y0 + moving.shape[0])
+            right = min(reference.shape[1], x0 + moving.shape[1])
+            if (bottom - top) * (right - left) < smallest:
+                continue
+            scores[i, j] = _ncc(reference[top:bottom, left:right],
+                                moving[top - y0:bottom - y0, left - x0:right - x0])
+    i, j = np.unravel_index(np.argmax(scores), scores.shape)
+    peak = float(scores[i, j])
+
+    def refine(values, index):
+        if index == 0 or index == len(values) - 1:
+            return 0.0
+        left, centre, right = values[index - 1], values[index], values[index + 1]
+        curvature = left - 2 * centre + right
+        if not np.isfinite(curvature) or curvature >= 0:
+            return 0.0
+        return float(np.clip(0.5 * (left - right) / curvature, -0.5, 0.5))
+
+    return i - limit_y + refine(scores[:, j], i), j - limit_x + refine(scores[i, :], j), peak
+
+
+def overlap_offsets(edges, pairs, margin):
+    """Measured offset of every neighbouring pair from the image strips along their shared edge
+
+    `edges[tile]` holds the 'right', 'bottom', 'left' and 'top' strips of a tile, each the overlap
+    plus `margin` (rows, columns) pixels deep. `pairs` are (tile, neighbour, axis) with axis 0 for
+    the neighbour below and 1 for the neighbour to the right. Returns {(tile, neighbour): (dy, dx, peak)}
+    where (dy, dx) is how far the neighbour sits from its nominal place relative to the tile.
+    """
+    offsets = {}
+    for tile, neighbour, axis in pairs:
+        # At its nominal place the neighbour's strip starts `margin` into the tile's strip
+        if axis == 1:
+            reference, moving, offset = edges[tile]["right"], edges[neighbour]["left"], (0, margin[1])
+        else:
+            reference, moving, offset = edges[tile]["bottom"], edges[neighbour]["top"], (margin[0], 0)
+        offsets[(tile, neighbour)] = cross_correlation(reference, moving, offset, margin)
+    return offsets
+
+
+def solve_origins(nominal, offsets, anchor=None):
+    """Tile origins (y, x) that best agree with the measured pair offsets, `anchor` keeps its nominal origin"""
+    tiles = list(nominal)
+    index = {tile: i for i, tile in enumerate(tiles)}
+    anchor = tiles[0] if anchor is None else anchor
+    rows, rhs, weights = [], [], []
+    for (tile, neighbour), (dy, dx, peak) in offsets.items():
+        expected = np.subtract(nominal[neighbour], nominal[tile])
+        if peak >= MIN_PEAK:
+            measured, weight = expected + (dy, dx), peak
+        else:
+            logger.debug("Tiles %s and %s do not correlate (peak %.2f), keeping their nominal offset", tile, neighbour, peak)
+            measured, weight = expected, NOMINAL_WEIGHT
+        row = np.zeros(len(tiles))
+        row[index[neighbour]] = 1.0
+        row[index[tile]] = -1.0
+        rows.append(row)
+        rhs.append(measured)
+        weights.append(weight)
+    # The anchor pins the otherwise free overall translation
+    row = np.zeros(len(tiles))
+    row[index[anchor]] = 1.0
+    rows.append(row)
+    rhs.append(np.asarray(nominal[anchor], dtype=np.float64))
+    weights.append(1.0)
+
+    sqrt_w = np.sqrt(np.asarray(weights))[:, None]
+    solution, *_ = np.linalg.lstsq(np.asarray(rows) * sqrt_w, np.asarray(rhs, dtype=np.float64) * sqrt_w, rcond=None)
+    return {tile: (float(solution[i, 0]), float(solution[i, 1])) for tile, i in index.items()}
@@ -0,0 +1,359 @@
+"""
+Remote control of the scanner
+Local JSON-RPC 2.0 server, one JSON object per line over TCP, that lets other software submit, cancel and watch scans and
+stream their progress and preview frames
+"""
+
+import json
+import base64
+import asyncio
+
+import numpy as np
+import logging
+
+from scanplan import ScanPlan
+from scanqueue import parse_recipe
+
+logger = logging.getLogger('logger.remote')
+
+DEFAULT_SETTINGS = {"enabled": False,
+                    "host": "127.0.0.1",     # 0.0.0.0 accepts other machines, then set a token
+                    "port": 8765,
+                    "token": None,           # clients have to call login with it first
+                    "client_queue": 256,     # notifications buffered per client, newer ones are dropped beyond
+                    "preview_pixels": 64,    # preview frames are binned to at most this size
+                    "max_line": 1 << 20}     # longest request in bytes
+
+EVENTS = ("progress", "state", "cube", "step", "preview", "finished", "error")
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+REFUSED = -32000
+
+
+class RemoteError(Exception):
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def preview_frame(frame, pixels):
+    """Frame binned by whole factors to at most `pixels` on a side, as float32"""
+    frame = np.asarray(frame, dtype=np.float32)
+    factor = max(1, -(-max(frame.shape) // pixels))
+    height, width = frame.shape[0] // factor * factor, frame.shape[1] // factor * factor
+    if factor > 1:
+        frame = frame[:height, :width].reshape(height // factor, factor, width // factor, factor).mean(axis=(1, 3))
+    return frame
+
+
+class Client():
+
+    def __init__(self, reader, writer, size):
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info("peername")
+        self.events = set()
+        self.channel = None
+        self.authenticated = False
+        self.outbox = asyncio.Queue()
+        self.task = asyncio.current_task()
+        self.size = size
+        self.dropped = 0
+
+    def send(self, message):
+        self.outbox.put_nowait(message)
+
+    def notify(self, message):
+        """Queue a notification, a client that does not keep up misses the new ones until it caught up"""
+        if self.outbox.qsize() >= self.size:
+            self.dropped += 1
+            return
+        self.outbox.put_nowait(message)
+
+
+class RemoteServer():
+    """JSON-RPC server on the worker's event loop
+
+    `worker` is the ScannerApp Worker, its start, pause and cancel methods are called as the
+    buttons would. The on_* methods take the worker's signals from any thread. Each client has
+    its own queue and writer task, a slow or stuck client only ever delays itself.
+
+    Methods: login, status, plan, submit, submit_recipe, cancel, pause, resume, subscribe, unsubscribe.
+    Notifications: progress, state, cube, step, preview, finished, error.
+    """
+
+    def __init__(self, worker, settings=None):
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(settings or {})
+        self.worker = worker
+        self.clients = set()
+        self.server = None
+        self.loop = None
+        self.run_dir = None
+        self.methods = {"login": self.login, "status": self.status, "plan": self.plan, "submit": self.submit,
+                        "submit_recipe": self.submit_recipe, "cancel": self.cancel, "pause": self.pause,
+                        "resume": self.resume, "subscribe": self.subscribe, "unsubscribe": self.unsubscribe}
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        try:
+            self.server = await asyncio.start_server(self._serve, self.settings["host"], int(self.settings["port"]),
+                                                     limit=int(self.settings["max_line"]))
+        except OSError as e:
+            logger.error("Cannot serve remote control on %s:%s: %s", self.settings["host"], self.settings["port"], e)
+            return None
+        port = self.server.sockets[0].getsockname()[1]
+        logger.info("Remote control on %s:%d", self.settings["host"], port)
+        return port
+
+    async def stop(self):
+        if self.server is None:
+            return
+        self.server.close()
+        # Closed connections end their handlers, which then leave on their own
+        handlers = [client.task for client in self.clients]
+        for client in list(self.clients):
+            client.writer.close()
+        if handlers:
+            await asyncio.wait(handlers, timeout=2.0)
+        await self.server.wait_closed()
+        self.server = None
+
+    # Worker signals, called from whatever thread emits them
+
+    def on_progress(self, message):
+        self._threadsafe(self.publish, "progress", {"message": message})
+
+    def on_connection(self, connected):
+        self._threadsafe(self.publish, "state", {"connected": bool(connected)})
+
+    def on_cube(self, run_dir):
+        self._threadsafe(self._set_run, run_dir)
+
+    def on_step(self, step, position):
+        self._threadsafe(self._step, int(step), float(position))
+
+    def on_finished(self):
+        self._threadsafe(self._finished)
+
+    def on_error(self, message):
+        self._threadsafe(self.publish, "error", {"message": message})
+
+    def _threadsafe(self, callback, *args):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def _set_run(self, run_dir):
+        self.run_dir = run_dir
+        self.publish("cube", {"run": run_dir})
+
+    def _finished(self):
+        # Read on the loop, after the run set by an earlier on_cube
+        self.publish("finished", {"run": self.run_dir})
+
+    def _step(self, step, position):
+        self.publish("step", {"run": self.run_dir, "step": step, "position": position})
+        wanted = {client.channel for client in self.clients if "preview" in client.events}
+        if wanted:
+            asyncio.ensure_future(self._preview(step, wanted))
+
+    async def _preview(self, step, wanted):
+        engine = self._scan()
+        cube = engine.cube if engine is not None else None
+        if cube is None:
+            return
+        channels = [channel if channel in cube.channels else cube.channels[-1] for channel in wanted]
+
+        def frames():
+            return {channel: preview_frame(cube.frame(channel, step), int(self.settings["preview_pixels"]))
+                    for channel in set(channels)}
+        try:
+            # The cube is read off the loop, the acquisition never waits for a preview
+            images = await asyncio.get_running_loop().run_in_executor(None, frames)
+        except Exception as e:
+            logger.debug("No preview of step %d: %s", step, e)
+            return
+        messages = {channel: _notification("preview", {"run": self.run_dir, "step": step, "channel": channel,
+                                                        "shape": list(image.shape), "dtype": "float32",
+                                                        "data": base64.b64encode(image.tobytes()).decode("ascii")})
+                    for channel, image in images.items()}
+        for client in list(self.clients):
+            if "preview" in client.events:
+                channel = client.channel if client.channel in messages else next(iter(messages))
+                client.notify(messages[channel])
+
+    def publish(self, event, params):
+        if not any(event in client.events for client in self.clients):
+            return
+        message = _notification(event, params)
+        for client in list(self.clients):
+            if event in client.events:
+                client.notify(message)
+
+    def _scan(self):
+        engine = self.worker.engine
+        # A ScanQueue runs its jobs through a StepScan of its own
+        return getattr(engine, "engine", engine)
+
+    # Connections
+
+    async def _serve(self, reader, writer):
+        client = Client(reader, writer, int(self.settings["client_queue"]))
+        client.authenticated = not self.settings["token"]
+        self.clients.add(client)
+        logger.info("Remote client %s connected", client.peer)
+        sender = asyncio.create_task(self._send(client))
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    client.send(_error(None, INVALID_REQUEST, "Request too long"))
+                    break
+                if not line:
+                    break
+                reply = await self._handle(client, line) if line.strip() else None
+                if reply is not None:
+                    client.send(reply)
+        except (ConnectionError, asyncio.CancelledError):
+            # A cancelled handler just ends, asyncio's stream callback would report it as an error
+            pass
+        finally:
+            self.clients.discard(client)
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            writer.close()
+            logger.info("Remote client %s disconnected%s", client.peer,
+                        f", {client.dropped} notifications dropped" if client.dropped else "")
+
+    async def _send(self, client):
+        while True:
+            message = await client.outbox.get()
+            client.writer.write(message.encode("utf-8") + b"\n")
+            await client.writer.drain()
+
+    async def _handle(self, client, line):
+        try:
+            request = json.loads(line)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            return _error(None, PARSE_ERROR, f"Parse error: {e}")
+        if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+            return _error(None, INVALID_REQUEST, "Invalid request")
+        identifier = request.get("id")
+        method = self.methods.get(request["method"])
+        params = request.get("params") or {}
+        try:
+            if method is None:
+                raise RemoteError(METHOD_NOT_FOUND, f"Unknown method {request['method']}")
+            if not isinstance(params, dict):
+                raise RemoteError(INVALID_PARAMS, "params must be an object")
+            if not client.authenticated and method != self.login:
+                raise RemoteError(REFUSED, "Call login with the token first")
+            result = method(client, **params)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except RemoteError as e:
+            return _error(identifier, e.code, str(e))
+        except (TypeError, ValueError, KeyError) as e:
+            return _error(identifier, INVALID_PARAMS, str(e))
+        except Exception as e:
+            logger.error("Remote call %s failed: %s", request["method"], e)
+            return _error(identifier, REFUSED, str(e))
+        # Notifications from the client get no reply
+        if "id" not in request:
+            return None
+        return json.dumps({"jsonrpc": "2.0", "id": identifier, "result": result}, default=_plain)
+
+    # Methods, each takes the client and the request params
+
+    def login(self, client, token=None):
+        if self.settings["token"] and token != self.settings["token"]:
+            raise RemoteError(REFUSED, "Wrong token")
+        client.authenticated = True
+        return True
+
+    def status(self, client):
+        engine = self._scan()
+        scan = engine.metrics() if engine is not None and hasattr(engine, "metrics") else None
+        return {"connected": self.worker.session_open and bool(getattr(self.worker.snom, "connected", False)),
+                "busy": self.worker.busy,
+                "paused": bool(self.worker.busy and getattr(engine, "paused", False)),
+                "run": self.run_dir if self.worker.busy else None,
+                "scan": scan}
+
+    def plan(self, client):
+        return self.worker.plan.to_parameters() if self.worker.plan is not None else None
+
+    def submit(self, client, scan=None, ifg=None):
+        """Start a step scan with the current plan changed by `scan` and `ifg`"""
+        base = self.worker.plan if self.worker.plan is not None else ScanPlan()
+        plan = base.with_changes(scan=scan, ifg=ifg)
+        self._ready()
+        if not self.worker.run_measurement(plan):
+            raise RemoteError(REFUSED, "A measurement is already running")
+        return {"started": True, "plan": plan.to_parameters()}
+
+    def submit_recipe(self, client, recipe):
+        """Start a queue of jobs, `recipe` as in a recipe file, over the current plan"""
+        defaults = self.worker.plan.to_parameters() if self.worker.plan is not None else None
+        jobs = parse_recipe(recipe, defaults=defaults)
+        if not jobs:
+            raise ValueError("The recipe has no jobs")
+        self._ready()
+        if not self.worker.run_queue(jobs):
+            raise RemoteError(REFUSED, "A measurement is already running")
+        return {"started": True, "jobs": [job.name for job in jobs]}
+
+    def cancel(self, client):
+        busy = self.worker.busy
+        self.worker.cancel_measurement()
+        return busy
+
+    def pause(self, client):
+        if not self.worker.busy:
+            return False
+        self.worker.pause_measurement()
+        return True
+
+    def resume(self, client):
+        if not self.worker.busy:
+            return False
+        self.worker.resume_measurement()
+        return True
+
+    def subscribe(self, client, events=EVENTS, channel=None):
+        unknown = set(events) - set(EVENTS)
+        if unknown:
+            raise ValueError(f"Unknown events {sorted(unknown)}, use {list(EVENTS)}")
+        client.events.update(events)
+        if channel is not None:
+            client.channel = channel
+        return sorted(client.events)
+
+    def unsubscribe(self, client, events=EVENTS):
+        client.events.difference_update(events)
+        return sorted(client.events)
+
+    def _ready(self):
+        if not self.worker.session_open:
+            raise RemoteError(REFUSED, "Not connected to the SNOM")
+
+
+def _notification(method, params):
+    return json.dumps({"jsonrpc": "2.0", "method": method, "params": params}, default=_plain)
+
+
+def _error(identifier, code, message):
+    return json.dumps({"jsonrpc": "2.0", "id": identifier, "error": {"code": code, "message": message}})
+
+
+def _plain(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
@@ -0,0 +1,177 @@
+"""
+Headless runner for scan recipes
+Connects, runs the jobs of a recipe, saves the results and exits with a status code, without any Qt import
+
+    python runner.py recipe.yaml                    # run a recipe on the microscope configured in config.yaml
+    python runner.py recipe.yaml --simulate         # run it against the simulated backend
+    python runner.py --resume data/<run folder>     # continue interrupted runs
+    python runner.py recipe.yaml --dry-run          # list the jobs and the predicted duration
+
+Exit status: 0 all jobs succeeded, 1 a job failed, 2 recipe, configuration or connection error, 130 interrupted
+"""
+
+import os
+import sys
+import asyncio
+import argparse
+
+import yaml
+import logging
+
+from snom import create_snom, instrument_id
+from session import Session
+from scanqueue import ScanQueue, load_recipe
+from stepscan import StepScan
+from datacube import remove_discarded
+from estimator import CostModel, MODEL_FILE, format_duration
+from processing import ProcessingEngine
+from tracing import Tracer
+from metrics import Metrics
+import logs
+from scanplan import step_count
+
+logger = logging.getLogger('logger.runner')
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_ERROR = 2
+EXIT_INTERRUPTED = 130
+
+
+class Runner():
+    """Plays the role of the GUI Worker for a list of jobs or interrupted runs
+
+    The engines log their progress themselves, there is no progress callback to forward it to.
+    """
+
+    def __init__(self, config, offline=False, output_dir=None, config_dir="."):
+        self.config = config
+        self.snom = create_snom(config, offline)
+        self.output_dir = output_dir or config.get('output_dir', 'data')
+        self.cost_model_path = os.path.join(config_dir, MODEL_FILE)
+        self.cost_model = CostModel.load(self.cost_model_path, instrument_id(config, offline))
+        self.processor = ProcessingEngine(config.get('processing'))
+        self.session = Session(self.snom, config.get('path_to_dll'), config.get('fingerprint'), config.get('session'))
+        self.engine = None
+        self.metrics = Metrics(config.get('metrics'), instrument_id(config, offline),
+                               engine=lambda: self.engine, session=lambda: self.session)
+
+    def new_tracer(self):
+        return Tracer(**(self.config.get('tracing') or {}))
+
+    async def _connect(self):
+        try:
+            return await self.session.connect()
+        except Exception as e:
+            logger.error("Connection failed: %s", e)
+            return False
+
+    def _resume(self, run_dir):
+        self.engine = StepScan.from_run(self.snom, run_dir, storage_settings=self.config.get('storage'),
+                                        cost_model=self.cost_model, tracer=self.new_tracer(), processor=self.processor,
+                                        drift_settings=self.config.get('drift'))
+        return self.engine
+
+    async def run(self, jobs=(), resume=()):
+        """Results as (name, result path or exception) pairs, None when the connection failed"""
+        self.metrics.start()
+        if not await self._connect():
+            return None
+        try:
+            results = []
+            for run_dir in resume:
+                try:
+                    results.append((run_dir, await self.session.run(self._resume(run_dir), self._resume)))
+                except Exception as e:
+                    logger.error("Resuming %s failed: %s", run_dir, e)
+                    results.append((run_dir, e))
+            if jobs:
+                self.engine = ScanQueue(self.snom, jobs, output_dir=self.output_dir, storage_settings=self.config.get('storage'),
+                                        cost_model=self.cost_model, new_tracer=self.new_tracer,
+                                        processor=self.processor, session=self.session, drift_settings=self.config.get('drift'))
+                results += [(job.name, result) for job, result in await self.engine.run()]
+            return results
+        finally:
+            await self.session.close()
+            if self.session.reconnects:
+                logger.warning("%d reconnect(s) during this run", self.session.reconnects)
+            self.save_cost_model()
+
+    def save_cost_model(self):
+        try:
+            self.cost_model.save(self.cost_model_path)
+        except OSError as e:
+            logger.error("Could not save cost model: %s", e)
+
+    def close(self):
+        self.metrics.stop()
+        self.processor.close()
+        remove_discarded(self.output_dir)
+
+
+def load_defaults(path):
+    """Scan and interferometer defaults from a settings file as written by AutoScanApp.write_settings"""
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'r') as file:
+        scan, ifg = yaml.safe_load(file)
+    return {"scan": scan, "ifg": ifg}
+
+
+def dry_run(jobs, cost_model):
+    total = 0.0
+    for job in jobs:
+        duration = cost_model.predict_total(job.parameters["scan"], job.parameters["ifg"], job.parameters["scan"]["Channels"])
+        total += duration
+        print(f"{job.name}: center {job.center}, {step_count(job.parameters['scan'], job.parameters['ifg'])} positions, ~{format_duration(duration)}")
+    print(f"{len(jobs)} jobs, ~{format_duration(total)} in total")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recipe", nargs="?", help="YAML recipe, a [scan, ifg] settings list or a dict with jobs")
+    parser.add_argument("--config", default="config.yaml", help="configuration file (default: config.yaml)")
+    parser.add_argument("--defaults", default="settings.yaml",
+                        help="settings file with the default scan and interferometer parameters (default: settings.yaml)")
+    parser.add_argument("--output-dir", help="folder for the run data (default: output_dir of the configuration)")
+    parser.add_argument("--simulate", action="store_true", help="use the simulated backend")
+    parser.add_argument("--resume", nargs="+", default=[], metavar="RUN", help="interrupted run folders to continue first")
+    parser.add_argument("--dry-run", action="store_true", help="only list the jobs and their predicted duration")
+    parser.add_argument("-v", "--verbose", action="store_true", help="debug logging")
+    args = parser.parse_args(argv)
+
+    if not args.recipe and not args.resume:
+        parser.error("give a recipe or --resume")
+    try:
+        with open(args.config, 'r') as file:
+            config = yaml.safe_load(file)
+        jobs = load_recipe(args.recipe, load_defaults(args.defaults)) if args.recipe else []
+    except (OSError, yaml.YAMLError, KeyError, ValueError, TypeError) as e:
+        logger.error("Could not load the recipe or configuration: %s", e)
+        return EXIT_ERROR
+    logs.setup(config.get("logging"), level=logging.DEBUG if args.verbose else None)
+
+    runner = Runner(config, offline=args.simulate, output_dir=args.output_dir,
+                    config_dir=os.path.dirname(os.path.abspath(args.config)))
+    try:
+        if args.dry_run:
+            dry_run(jobs, runner.cost_model)
+            return EXIT_OK
+        results = asyncio.run(runner.run(jobs, args.resume))
+    except KeyboardInterrupt:
+        logger.error("Interrupted, unfinished runs can be continued with --resume")
+        return EXIT_INTERRUPTED
+    finally:
+        runner.close()
+
+    if results is None:
+        logger.error("Could not connect to the SNOM")
+        return EXIT_ERROR
+    failed = [(name, result) for name, result in results if isinstance(result, Exception)]
+    for name, result in results:
+        print(f"{'FAILED' if isinstance(result, Exception) else 'OK':6} {name}: {result}")
+    return EXIT_FAILED if failed else EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,258 @@
+"""
+Non-uniform sampling of the interferometer positions
+Chooses which positions of the evenly spaced grid a step scan measures and rebuilds the spectra from the measured subset,
+with a density compensated non-uniform DFT or an iterative sparse fill of the missing positions.
+
+    python sampling.py data/<run folder> --ratios 0.2 0.33 0.5     # quality lost when a full run is undersampled
+"""
+
+import sys
+import argparse
+
+import numpy as np
+import logging
+
+from datacube import DataCube
+from scanplan import IFG_DEFAULTS, sample_count
+from processing import DEFAULT_SETTINGS, ZPD_SAMPLE_PIXELS, SpectralTransform, find_zpd
+
+logger = logging.getLogger('logger.sampling')
+
+RECONSTRUCTIONS = ("nudft", "sparse")
+SPARSE_FLOOR = 1e-3         # last threshold of the sparse fill relative to the strongest spectral component
+
+
+def grid_positions(ifg):
+    """The NumberOfPoints evenly spaced positions from StartPosition to EndPosition"""
+    return np.linspace(float(ifg["StartPosition"]), float(ifg["EndPosition"]), int(ifg["NumberOfPoints"]))
+
+
+def sample_indices(ifg):
+    """Indices into grid_positions(ifg) of the positions a random or centerburst scan measures, ascending
+
+    Both ends are always measured, they fix the path difference range and so the resolution.
+    centerburst measures half of its positions as one block around the SamplingCenter, where the
+    Mertz phase comes from, and spreads the rest with a density falling off away from it.
+    The choice only depends on the parameters, a resumed run measures the same positions.
+    """
+    points = int(ifg["NumberOfPoints"])
+    count = sample_count(ifg)
+    mode = ifg.get("Sampling", "uniform")
+    if mode not in ("random", "centerburst") or count >= points:
+        return np.arange(points)
+    rng = np.random.default_rng(ifg.get("SamplingSeed", 0))
+    chosen = {0, points - 1}
+    rest = np.arange(1, points - 1)
+    weights = None
+    if mode == "centerburst":
+        center = ifg.get("SamplingCenter")
+        center = ifg["InterferometerCenter"] if center is None else center
+        middle = int(np.argmin(np.abs(grid_positions(ifg) - center)))
+        core = (count - 2) // 2
+        first = max(0, min(middle - core // 2, points - core))
+        chosen.update(range(first, first + core))
+        rest = np.setdiff1d(rest, list(chosen))
+        weights = 1.0 / (1.0 + np.abs(rest - middle) / max(core, 1))
+        weights /= weights.sum()
+    extra = count - len(chosen)
+    if extra > 0:
+        chosen.update(rng.choice(rest, size=extra, replace=False, p=weights).tolist())
+    return np.array(sorted(chosen))
+
+
+def sampled_positions(ifg):
+    """Mirror positions a step scan with these interferometer parameters measures, in the order it visits them"""
+    if ifg.get("Sampling", "uniform") == "custom":
+        return np.array([float(position) for position in ifg["SampledPositions"]])
+    return grid_positions(ifg)[sample_indices(ifg)]
+
+
+def reconstruction_grid(positions, ifg=None):
+    """Grid the spectra of `positions` are computed on, that of the run's parameters or the finest spacing of the positions"""
+    if ifg is not None and all(key in ifg for key in ("StartPosition", "EndPosition", "NumberOfPoints")):
+        return grid_positions(ifg)
+    positions = np.unique(np.asarray(positions, dtype=np.float64))
+    step = np.diff(positions).min()
+    return positions[0] + step * np.arange(int(round((positions[-1] - positions[0]) / step)) + 1)
+
+
+class SampledTransform():
+    """Spectra of interferograms measured at a subset of the positions of a grid
+
+    Drop-in for processing.SpectralTransform, the spectra have the wavenumbers, apodization and Mertz
+    phase correction SpectralTransform gives for the full grid.
+    nudft weights every sample by the stretch of path difference it stands for and evaluates the DFT at
+    the grid's wavenumbers, it takes any positions. sparse fills the missing grid positions by
+    iterative soft thresholding of the spectrum with a falling threshold, then transforms the full
+    grid, the positions have to lie on the grid.
+    """
+
+    def __init__(self, positions, zpd, grid, settings=None):
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(settings or {})
+        positions = np.asarray(positions, dtype=np.float64)
+        if len(positions) < 2:
+            raise ValueError("At least two interferometer positions are needed for a spectrum")
+        self.method = self.settings["reconstruction"]
+        if self.method not in RECONSTRUCTIONS:
+            raise ValueError(f"Unknown reconstruction {self.method}, use one of {list(RECONSTRUCTIONS)}")
+
+        # In ascending order, as SpectralTransform sorts them
+        grid = np.sort(np.asarray(grid, dtype=np.float64))
+        self.full = SpectralTransform(grid, zpd, self.settings)
+        self.order = np.argsort(positions)
+        self.steps = len(positions)
+        self.zpd = float(zpd)
+        self.wavenumbers = self.full.wavenumbers
+
+        # Path difference relative to the grid sample the FFT puts at index 0
+        grid_opd = 2.0 * (grid - zpd) * 1e-4
+        self.opd = 2.0 * (positions[self.order] - zpd) * 1e-4 - grid_opd[self.full.zpd_index]
+        grid_opd = grid_opd - grid_opd[self.full.zpd_index]
+        # Voronoi length of every sample in grid steps, 1 everywhere on the full grid
+        edges = np.concatenate(([self.opd[0] - self.full.spacing / 2], (self.opd[1:] + self.opd[:-1]) / 2,
+                                [self.opd[-1] + self.full.spacing / 2]))
+        self.weights = np.diff(edges) / self.full.spacing
+        self.window = np.interp(self.opd, grid_opd, self.full.window)
+        self.phase_window = None if self.full.phase_window is None else np.interp(self.opd, grid_opd, self.full.phase_window)
+
+        self.slots = None
+        if self.method == "sparse":
+            index = (positions[self.order] - grid[0]) / ((grid[-1] - grid[0]) / (len(grid) - 1))
+            self.slots = np.rint(index).astype(int)
+            if not np.allclose(index, self.slots, atol=1e-3) or len(np.unique(self.slots)) != len(self.slots):
+                raise ValueError("The sparse reconstruction needs distinct positions on the interferometer grid, use nudft")
+        self._kernels = None
+
+    def __getstate__(self):
+        # The kernels are rebuilt in each pool worker rather than pickled with every tile
+        state = dict(self.__dict__)
+        state["_kernels"] = None
+        return state
+
+    @property
+    def kernels(self):
+        """DFT matrices of shape (wavenumbers, steps) with the weights and windows applied"""
+        if self._kernels is None:
+            exponent = np.exp(-2j * np.pi * np.outer(self.wavenumbers, self.opd))
+            main = exponent * (self.weights * self.window)
+            phase = None if self.phase_window is None else exponent * (self.weights * self.phase_window)
+            self._kernels = (main, phase)
+        return self._kernels
+
+    def _fill(self, block, valid):
+        """Interferograms on the whole grid, the measured samples kept and the others filled in"""
+        slots = self.slots if valid is None else self.slots[valid]
+        measured = block if valid is None else block[valid]
+        n = len(self.full.window)
+        filled = np.zeros((n,) + block.shape[1:], dtype=np.float64)
+        filled[slots] = measured
+        iterations = max(1, int(self.settings["sparse_iterations"]))
+        top = np.abs(np.fft.rfft(filled, axis=0)).max(axis=0)
+        for i in range(iterations):
+            threshold = top * SPARSE_FLOOR ** ((i + 1) / iterations)
+            spectrum = np.fft.rfft(filled, axis=0)
+            spectrum *= np.clip(1.0 - threshold / np.maximum(np.abs(spectrum), 1e-300), 0.0, None)
+            filled = np.fft.irfft(spectrum, n=n, axis=0)
+            filled[slots] = measured
+        return filled
+
+    def transform(self, block, valid=None):
+        """Spectra of interferograms of shape (steps, ...), in acquisition order
+
+        `valid` flags the steps that were measured, the others are left out
+        """
+        block = np.asarray(block, dtype=np.float64)[self.order]
+        weights = self.weights
+        if valid is not None:
+            valid = np.asarray(valid, dtype=bool)[self.order]
+            weights = np.where(valid, weights, 0.0)
+        shape = (self.steps,) + (1,) * (block.ndim - 1)
+        block -= (block * weights.reshape(shape)).sum(axis=0) / weights.sum()
+        if self.method == "sparse":
+            return self.full.transform(self._fill(block, valid))
+        if valid is not None:
+            block[~valid] = 0.0
+        flat = block.reshape(self.steps, -1)
+        main, phase = self.kernels
+        spectrum = main @ flat
+        if phase is not None:
+            spectrum *= np.exp(-1j * np.angle(phase @ flat))
+        return spectrum.reshape((len(self.wavenumbers),) + block.shape[1:])
+
+    def rows_per_chunk(self, width):
+        if self.method == "sparse":
+            # The filled grid and its spectrum come on top of the full grid transform
+            return max(1, self.full.rows_per_chunk(width) // 2)
+        per_row = width * (self.steps * 8 + len(self.wavenumbers) * 16 * 3)
+        return max(1, int(self.settings["chunk_bytes"] // per_row))
+
+
+def quality_report(cube, ratios, mode="random", channel=None, settings=None, seed=0):
+    """Spectral quality kept when only part of the positions of a fully sampled cube are used
+
+    The measured subset is chosen as a scan with Sampling `mode` would, the spectra of a subsample of
+    the pixels are compared with those of all positions. Returns one dict per ratio with the
+    positions used, the acquisition time saved, the relative RMS error and the correlation.
+    """
+    config = dict(DEFAULT_SETTINGS)
+    config.update(settings or {})
+    positions = cube.positions
+    ifg = dict(IFG_DEFAULTS)
+    ifg.update(cube.meta.get("metadata", {}).get("ifg") or {})
+    ifg.update(Sampling=mode, SamplingSeed=seed, StartPosition=float(positions[0]), EndPosition=float(positions[-1]),
+               NumberOfPoints=len(positions))
+    if not np.allclose(positions, grid_positions(ifg)):
+        raise ValueError(f"{cube.path} is not sampled uniformly, the report needs a full run")
+    channel = channel or next(name for name in cube.channels if name != "Z")
+    done = cube.completed_steps()
+    if len(done) != len(positions):
+        raise ValueError(f"{cube.path} has {len(done)} of {len(positions)} steps, the report needs a full run")
+
+    height, width = cube.shape[2:]
+    stride = max(1, int(np.ceil(max(height, width) / ZPD_SAMPLE_PIXELS)))
+    block = np.asarray(cube.block(cube.channel_index(channel), slice(None), slice(None, None, stride), slice(None, None, stride)),
+                       dtype=np.float64)
+    zpd = config["zpd"] if config["zpd"] is not None else find_zpd(cube, channel)
+    # The phase corrected spectrum is real, without correction the amplitude is compared
+    part = np.real if config["phase_correction"] is not None else np.abs
+    reference = part(SpectralTransform(positions, zpd, config).transform(block))
+
+    report = []
+    for ratio in ratios:
+        indices = sample_indices(dict(ifg, SamplingRatio=ratio))
+        spectra = part(SampledTransform(positions[indices], zpd, positions, config).transform(block[indices]))
+        report.append({"ratio": float(ratio), "steps": len(indices), "time_saved": 1.0 - len(indices) / len(positions),
+                       "nrmse": float(np.linalg.norm(spectra - reference) / np.linalg.norm(reference)),
+                       "correlation": float(np.corrcoef(spectra.ravel(), reference.ravel())[0, 1])})
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("run", help="run folder of a fully sampled step scan")
+    parser.add_argument("--ratios", nargs="+", type=float, default=[0.2, 0.25, 0.33, 0.5], help="fractions of the positions kept")
+    parser.add_argument("--mode", choices=("random", "centerburst"), default="centerburst")
+    parser.add_argument("--method", choices=RECONSTRUCTIONS, default=DEFAULT_SETTINGS["reconstruction"])
+    parser.add_argument("--channel", help="channel to compare (default: the first optical channel)")
+    parser.add_argument("--range", nargs=2, type=float, metavar=("MIN", "MAX"), help="wavenumber range in 1/cm")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('logger').setLevel(logging.INFO)
+
+    cube = DataCube.open(args.run)
+    try:
+        report = quality_report(cube, args.ratios, args.mode, args.channel,
+                                {"reconstruction": args.method, "wavenumber_range": args.range}, args.seed)
+    finally:
+        cube.close()
+    print(f"{'ratio':>6} {'steps':>6} {'saved':>6} {'nrmse':>8} {'corr':>7}")
+    for row in report:
+        print(f"{row['ratio']:6.2f} {row['steps']:6d} {row['time_saved']:6.0%} {row['nrmse']:8.4f} {row['correlation']:7.4f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
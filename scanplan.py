@@ -0,0 +1,264 @@
+"""
+Scan plan
+Immutable, validated snapshot of the scan and interferometer parameters with the values derived from them
+"""
+
+import re
+import copy
+import types
+import datetime
+import functools
+
+import logging
+
+logger = logging.getLogger('logger.scanplan')
+
+SCAN_MODES = ("WLI", "WLI_single")
+# Height and the demodulated optical (O) and mechanical (M) amplitude and phase of every harmonic
+CHANNEL_PATTERN = re.compile(r"^(Z|[OM][0-5][AP])$")
+# Bytes per value of the data cube formats, int16 frames are stored with their own scale and offset
+DATA_FORMATS = {"float32": 4, "int16": 2, "float64": 8}
+# Which of the NumberOfPoints evenly spaced positions are measured, see sampling.py
+SAMPLING_MODES = ("uniform", "random", "centerburst", "custom")
+# Values the editors start with
+SCAN_DEFAULTS = {"PhysicalOffsetX": 50.0,
+                 "PhysicalOffsetY": 50.0,
+                 "PhysicalSizeX": 1.0,
+                 "PhysicalSizeY": 1.0,
+                 "TargetResolutionWidth": 100,
+                 "TargetResolutionHeight": 100,
+                 "Angle": 0.0,
+                 "TargetMillisecondsPerPixel": 9.8,
+                 "ScanMode": "WLI",
+                 "Channels": ["Z", "M1A"],     # downloaded and stored, Z is needed by drift tracking and mosaics
+                 "DataFormat": "float32"}
+IFG_DEFAULTS = {"InterferometerCenter": 400.0,
+                "InterferometerDistance": 800.0,
+                "NumberOfPoints": 600,
+                "NumberOfSkippedPoints": 0,
+                "StartPosition": 800.0,
+                "EndPosition": 0.0,
+                "Sampling": "uniform",
+                "SamplingRatio": 0.33,       # fraction of the positions measured by random and centerburst
+                "SamplingCenter": None,      # centre of the dense part of centerburst, None is InterferometerCenter
+                "SamplingSeed": 0,
+                "SampledPositions": None}    # positions in µm measured by custom
+IFG_RANGE = (0.0, 800.0)     # travel of the interferometer mirror in µm
+SCAN_RANGE = (0.0, 100.0)    # travel of the scanner in µm, for the scan centre and size
+
+
+def ifg_ends(ifg):
+    """Start and end position of the interferometer from its center and distance"""
+    return (ifg["InterferometerCenter"] + ifg["InterferometerDistance"] / 2,
+            ifg["InterferometerCenter"] - ifg["InterferometerDistance"] / 2)
+
+
+def sample_count(ifg):
+    """Interferometer positions measured by a step scan with these interferometer parameters"""
+    points = int(ifg["NumberOfPoints"])
+    sampling = ifg.get("Sampling", "uniform")
+    if sampling == "custom":
+        return len(ifg["SampledPositions"])
+    if sampling in ("random", "centerburst"):
+        return min(points, max(2, int(round(points * ifg.get("SamplingRatio", 1.0)))))
+    return points
+
+
+def step_count(scan, ifg):
+    """Images a scan takes, one per measured interferometer position or a single one in WLI_single mode"""
+    if scan.get("ScanMode", "WLI") == "WLI_single":
+        return 1
+    return sample_count(ifg)
+
+
+def sample_size(scan):
+    """Bytes per value of the data cube of a scan, runs from before DataFormat existed were float64"""
+    return DATA_FORMATS[scan.get("DataFormat", "float64")]
+
+
+def _problems(scan, ifg):
+    problems = []
+    for section, values, keys in (("scan", scan, SCAN_DEFAULTS), ("ifg", ifg, IFG_DEFAULTS)):
+        for key, default in keys.items():
+            if isinstance(default, bool) or not isinstance(default, (int, float)):
+                continue
+            value = values[key]
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                problems.append(f"{section} {key} is not a number: {value!r}")
+    if problems:
+        return problems
+    if scan["ScanMode"] not in SCAN_MODES:
+        problems.append(f"unknown ScanMode {scan['ScanMode']!r}, expected one of {', '.join(SCAN_MODES)}")
+    for key in ("PhysicalSizeX", "PhysicalSizeY", "TargetMillisecondsPerPixel"):
+        if scan[key] <= 0:
+            problems.append(f"{key} must be positive, not {scan[key]}")
+    channels = scan["Channels"]
+    if not isinstance(channels, (list, tuple)) or not channels:
+        problems.append(f"Channels must be a list of channel names, not {channels!r}")
+    else:
+        unknown = [channel for channel in channels if not isinstance(channel, str) or not CHANNEL_PATTERN.match(channel)]
+        if unknown:
+            problems.append(f"unknown channels {', '.join(map(str, unknown))}, expected Z or names like O2A and M1P")
+        elif len(set(channels)) != len(channels):
+            problems.append(f"Channels lists a channel twice: {', '.join(channels)}")
+    if scan["DataFormat"] not in DATA_FORMATS:
+        problems.append(f"unknown DataFormat {scan['DataFormat']!r}, expected one of {', '.join(DATA_FORMATS)}")
+    for key in ("TargetResolutionWidth", "TargetResolutionHeight"):
+        if scan[key] < 1 or int(scan[key]) != scan[key]:
+            problems.append(f"{key} must be a whole number of pixels, not {scan[key]}")
+    if ifg["NumberOfPoints"] < 1 or int(ifg["NumberOfPoints"]) != ifg["NumberOfPoints"]:
+        problems.append(f"NumberOfPoints must be a whole number of at least 1, not {ifg['NumberOfPoints']}")
+    bottom, top = IFG_RANGE
+    for key in ("StartPosition", "EndPosition"):
+        if not bottom <= ifg[key] <= top:
+            problems.append(f"{key} {ifg[key]} is outside the interferometer range {bottom}-{top}")
+    if ifg["Sampling"] not in SAMPLING_MODES:
+        problems.append(f"unknown Sampling {ifg['Sampling']!r}, expected one of {', '.join(SAMPLING_MODES)}")
+    elif ifg["Sampling"] in ("random", "centerburst") and not 0.0 < ifg["SamplingRatio"] <= 1.0:
+        problems.append(f"SamplingRatio must be in (0, 1], not {ifg['SamplingRatio']}")
+    elif ifg["Sampling"] == "custom":
+        positions = ifg["SampledPositions"]
+        if not isinstance(positions, (list, tuple)) or len(positions) < 2:
+            problems.append("custom sampling needs at least two SampledPositions")
+        elif any(isinstance(p, bool) or not isinstance(p, (int, float)) or not bottom <= p <= top for p in positions):
+            problems.append(f"SampledPositions must be numbers in the interferometer range {bottom}-{top}")
+    center = ifg["SamplingCenter"]
+    if center is not None and (isinstance(center, bool) or not isinstance(center, (int, float)) or not bottom <= center <= top):
+        problems.append(f"SamplingCenter {center!r} is outside the interferometer range {bottom}-{top}")
+    return problems
+
+
+class ScanPlan():
+    """The parameters of one scan, checked once and never changed afterwards
+
+    Every edit makes a new plan with `with_changes`, so a plan handed to a running scan stays as it was.
+    Values missing from `scan` and `ifg` come from the editor defaults, the interferometer start and
+    end are derived from its center and distance unless given. Unknown keys are kept as they are.
+    Raises ValueError listing every problem of an invalid plan.
+    """
+
+    def __init__(self, scan=None, ifg=None):
+        scan_values = dict(SCAN_DEFAULTS)
+        scan_values.update(scan or {})
+        ifg_values = dict(IFG_DEFAULTS)
+        ifg_values.update(ifg or {})
+        if not {"StartPosition", "EndPosition"} & (ifg or {}).keys():
+            ifg_values["StartPosition"], ifg_values["EndPosition"] = ifg_ends(ifg_values)
+        problems = _problems(scan_values, ifg_values)
+        if problems:
+            raise ValueError("Invalid scan plan: " + "; ".join(problems))
+        object.__setattr__(self, "scan", types.MappingProxyType(copy.deepcopy(scan_values)))
+        object.__setattr__(self, "ifg", types.MappingProxyType(copy.deepcopy(ifg_values)))
+
+    @classmethod
+    def from_parameters(cls, parameters):
+        return cls(parameters.get("scan"), parameters.get("ifg"))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ScanPlan is immutable, use with_changes")
+
+    def __delattr__(self, name):
+        raise AttributeError("ScanPlan is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, ScanPlan):
+            return NotImplemented
+        return dict(self.scan) == dict(other.scan) and dict(self.ifg) == dict(other.ifg)
+
+    def __hash__(self):
+        # Values can be lists, their text is hashable and equal for equal plans
+        return hash(repr((sorted(self.scan.items(), key=lambda item: item[0]),
+                          sorted(self.ifg.items(), key=lambda item: item[0]))))
+
+    def __repr__(self):
+        return f"ScanPlan({dict(self.scan)}, {dict(self.ifg)})"
+
+    def to_parameters(self):
+        """Independent {'scan', 'ifg'} dicts as StepScan, the recipes and the settings file use them"""
+        return {"scan": copy.deepcopy(dict(self.scan)), "ifg": copy.deepcopy(dict(self.ifg))}
+
+    def with_changes(self, scan=None, ifg=None):
+        """New plan with the given values replaced, the same plan when nothing differs"""
+        scan = {key: value for key, value in (scan or {}).items() if self.scan.get(key, object()) != value}
+        ifg = {key: value for key, value in (ifg or {}).items() if self.ifg.get(key, object()) != value}
+        if not scan and not ifg:
+            return self
+        scan_values = dict(self.scan, **scan)
+        ifg_values = dict(self.ifg, **ifg)
+        # Moving the center or changing the distance moves the ends, as in the editor
+        if {"InterferometerCenter", "InterferometerDistance"} & ifg.keys() and not {"StartPosition", "EndPosition"} & ifg.keys():
+            ifg_values["StartPosition"], ifg_values["EndPosition"] = ifg_ends(ifg_values)
+        return ScanPlan(scan_values, ifg_values)
+
+    def diff(self, other):
+        """{'scan.Key': (this value, other value)} of every value that differs from `other`, which may be None"""
+        changes = {}
+        for section in ("scan", "ifg"):
+            mine = getattr(self, section)
+            theirs = getattr(other, section) if other is not None else {}
+            for key in mine.keys() | theirs.keys():
+                if mine.get(key) != theirs.get(key):
+                    changes[f"{section}.{key}"] = (mine.get(key), theirs.get(key))
+        return changes
+
+    @functools.cached_property
+    def single(self):
+        return self.scan["ScanMode"] == "WLI_single"
+
+    @functools.cached_property
+    def steps(self):
+        """Images the scan takes, one per interferometer position"""
+        return step_count(self.scan, self.ifg)
+
+    @functools.cached_property
+    def channels(self):
+        return tuple(self.scan["Channels"])
+
+    @functools.cached_property
+    def pixels(self):
+        return int(self.scan["TargetResolutionWidth"]) * int(self.scan["TargetResolutionHeight"])
+
+    @functools.cached_property
+    def pixel_pitch(self):
+        """(x, y) distance between neighbouring pixels in µm"""
+        return (self.scan["PhysicalSizeX"] / self.scan["TargetResolutionWidth"],
+                self.scan["PhysicalSizeY"] / self.scan["TargetResolutionHeight"])
+
+    @functools.cached_property
+    def step_size(self):
+        """Spacing of the interferometer position grid in µm, 0 for a single image
+
+        With non-uniform sampling the scan measures a subset of this grid, the spectral range stays that of the grid.
+        """
+        points = int(self.ifg["NumberOfPoints"])
+        if self.single or points < 2:
+            return 0.0
+        return abs(self.ifg["StartPosition"] - self.ifg["EndPosition"]) / (points - 1)
+
+    @functools.cached_property
+    def scan_time(self):
+        """Seconds of one image from the pixel dwell time alone, forward and backward"""
+        return self.pixels * self.scan["TargetMillisecondsPerPixel"] / 1000.0 * 2
+
+    def data_volume(self):
+        """Bytes of the data cube of the scan"""
+        return self.steps * self.pixels * len(self.channels) * sample_size(self.scan)
+
+    def duration(self, cost_model=None):
+        """Predicted seconds of the whole scan, from the cost model when there is one"""
+        if cost_model is not None:
+            return cost_model.predict_total(self.scan, self.ifg, self.channels)
+        return self.steps * self.scan_time
+
+    def summary(self, cost_model=None):
+        pitch_x, pitch_y = self.pixel_pitch
+        text = (f"Estimated time: {datetime.timedelta(seconds=int(self.duration(cost_model)))}\n"
+                f"Pixel pitch: {pitch_x * 1e3:.1f} x {pitch_y * 1e3:.1f} nm")
+        if not self.single:
+            text += f", step size: {self.step_size:.3f} µm"
+            if self.ifg["Sampling"] != "uniform":
+                text += f"\nSampling: {self.steps} of {self.ifg['NumberOfPoints']} positions ({self.ifg['Sampling']})"
+        volume = self.data_volume()
+        size = f"{volume / 1e9:.2f} GB" if volume >= 1e9 else f"{volume / 1e6:.1f} MB"
+        text += f"\nData: {size} ({', '.join(self.channels)} as {self.scan['DataFormat']})"
+        return text
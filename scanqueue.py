@@ -0,0 +1,252 @@
+"""
+Queue of scan jobs loaded from a YAML recipe
+Runs the scans back to back, ordered to minimise the scanner travel between the scan centres
+"""
+
+import copy
+import math
+import asyncio
+
+import yaml
+import logging
+
+from stepscan import StepScan
+from scanplan import ScanPlan, ifg_ends
+from mosaic import MosaicLayout, stitch
+from datacube import run_folder
+
+logger = logging.getLogger('logger.scanqueue')
+
+
+class ScanJob():
+
+    def __init__(self, name, parameters, mosaic=None, tile=None):
+        self.name = name
+        self.parameters = parameters
+        # Tiles of a mosaic.MosaicLayout are stitched once the queue has run them all
+        self.mosaic = mosaic
+        self.tile = tile
+
+    @property
+    def center(self):
+        scan = self.parameters["scan"]
+        return (float(scan["PhysicalOffsetX"]), float(scan["PhysicalOffsetY"]))
+
+    def __repr__(self):
+        # The stitching job of a mosaic has no scan parameters
+        if self.parameters is None:
+            return f"ScanJob({self.name!r})"
+        return f"ScanJob({self.name!r}, center={self.center})"
+
+
+def _merge(defaults, overrides):
+    merged = copy.deepcopy(defaults)
+    merged.update(overrides or {})
+    return merged
+
+
+def _merge_ifg(defaults, overrides):
+    merged = _merge(defaults, overrides)
+    overrides = overrides or {}
+    # The editor derives the start and end from the center and distance, recipes usually only give those
+    if ({"InterferometerCenter", "InterferometerDistance"} & overrides.keys()
+            and not {"StartPosition", "EndPosition"} & overrides.keys()):
+        merged["StartPosition"], merged["EndPosition"] = ifg_ends(merged)
+    return merged
+
+
+def _job(name, scan, ifg, **kwargs):
+    # Checked and completed with the editor defaults here, so a bad job fails before the queue starts
+    try:
+        return ScanJob(name, ScanPlan(scan, ifg).to_parameters(), **kwargs)
+    except ValueError as e:
+        raise ValueError(f"{name}: {e}") from e
+
+
+def mosaic_jobs(mosaic, defaults):
+    """One job per tile of a recipe's 'mosaic' section, in acquisition order"""
+    scan = ScanPlan(defaults["scan"], defaults["ifg"]).scan
+    layout = MosaicLayout.from_recipe(mosaic, scan)
+    jobs = []
+    for tile in layout.tiles():
+        x, y = layout.tile_center(tile)
+        jobs.append(_job(f"{layout.name} r{tile[0]}c{tile[1]}", _merge(defaults["scan"], {"PhysicalOffsetX": x, "PhysicalOffsetY": y}),
+                         defaults["ifg"], mosaic=layout, tile=tile))
+    logger.info("%s: %dx%d tiles of %.1f x %.1f um covering %.1f x %.1f um", layout.name, layout.grid[0], layout.grid[1],
+                layout.tile_size[0], layout.tile_size[1], layout.shape[1] * layout.pitch[0], layout.shape[0] * layout.pitch[1])
+    return jobs
+
+
+def parse_recipe(recipe, defaults=None):
+    """Jobs of a recipe
+
+    A recipe is either the [scan, ifg] list written by AutoScanApp.write_settings, or a dict with
+    optional 'defaults' ({scan, ifg}), 'optimize_order', a 'mosaic' and a 'jobs' list. Each job gives a 'name'
+    and the 'scan'/'ifg' values that differ from the defaults. A mosaic gives the 'center' and 'size'
+    of a region in µm, optionally 'overlap', 'name' and the stitching settings of mosaic.DEFAULT_SETTINGS,
+    its tiles are scans with the defaults and come before the jobs.
+    """
+    defaults = copy.deepcopy(defaults) if defaults else {"scan": {}, "ifg": {}}
+    if isinstance(recipe, list):
+        scan, ifg = recipe
+        return [_job("Step Scan", _merge(defaults["scan"], scan), _merge_ifg(defaults["ifg"], ifg))]
+
+    recipe_defaults = recipe.get("defaults", {})
+    defaults = {"scan": _merge(defaults["scan"], recipe_defaults.get("scan")),
+                "ifg": _merge_ifg(defaults["ifg"], recipe_defaults.get("ifg"))}
+    jobs = mosaic_jobs(recipe["mosaic"], defaults) if recipe.get("mosaic") else []
+    for index, entry in enumerate(recipe.get("jobs", [])):
+        name = entry.get("name", f"Job {index + 1}")
+        jobs.append(_job(name, _merge(defaults["scan"], entry.get("scan")), _merge_ifg(defaults["ifg"], entry.get("ifg"))))
+    return jobs
+
+
+def load_recipe(path, defaults=None):
+    with open(path, 'r') as file:
+        recipe = yaml.safe_load(file)
+    jobs = parse_recipe(recipe, defaults)
+    if isinstance(recipe, dict) and recipe.get("optimize_order", True):
+        # The tiles of a mosaic already come in a serpentine, the jobs after them start next to the last tile
+        tiles = [job for job in jobs if job.mosaic is not None]
+        others = [job for job in jobs if job.mosaic is None]
+        jobs = tiles + order_jobs(others, start=tiles[-1].center if tiles else None)
+    return jobs
+
+
+def _path_length(points, order):
+    return sum(math.dist(points[a], points[b]) for a, b in zip(order, order[1:]))
+
+
+def order_jobs(jobs, start=None):
+    """Open travelling-salesman path over the scan centres, nearest neighbour refined by 2-opt
+
+    The path starts at the job closest to `start`, or at the first job when no start is given
+    """
+    if len(jobs) < 3:
+        return list(jobs)
+    points = [job.center for job in jobs]
+    remaining = list(range(len(jobs)))
+    first = 0 if start is None else min(remaining, key=lambda i: math.dist(points[i], start))
+    order = [first]
+    remaining.remove(first)
+    while remaining:
+        last = points[order[-1]]
+        nearest = min(remaining, key=lambda i: math.dist(points[i], last))
+        order.append(nearest)
+        remaining.remove(nearest)
+
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(order) - 1):
+            for j in range(i + 1, len(order)):
+                a, b = points[order[i - 1]], points[order[i]]
+                c = points[order[j]]
+                d = points[order[j + 1]] if j + 1 < len(order) else None
+                before = math.dist(a, b) + (math.dist(c, d) if d else 0.0)
+                after = math.dist(a, c) + (math.dist(b, d) if d else 0.0)
+                if after < before - 1e-9:
+                    order[i:j + 1] = reversed(order[i:j + 1])
+                    improved = True
+    logger.info("Queue travel %.1f um after ordering (%.1f um in recipe order)",
+                _path_length(points, order), _path_length(points, list(range(len(jobs)))))
+    return [jobs[i] for i in order]
+
+
+class ScanQueue():
+    """Runs jobs one after the other on the same SNOM connection
+
+    The tip stays engaged between jobs, StepScan only approaches when the SNOM is not engaged.
+    A failing job is logged and the queue carries on with the next one.
+    """
+
+    def __init__(self, snom, jobs, output_dir="data", storage_settings=None, progress=None,
+                 on_cube=None, on_step=None, cost_model=None, new_tracer=None, processor=None, session=None,
+                 drift_settings=None):
+        self.snom = snom
+        self.jobs = list(jobs)
+        self.output_dir = output_dir
+        self.storage_settings = storage_settings
+        self.processor = processor
+        self.drift_settings = drift_settings
+        # session.Session, reconnects after a dropped connection and continues the interrupted job
+        self.session = session
+        self.progress = progress
+        self.on_cube = on_cube
+        self.on_step = on_step
+        self.cost_model = cost_model
+        # Every job gets its own tracer, exported into its run folder
+        self.new_tracer = new_tracer
+        self.engine = None
+        self.results = []
+        self._paused = False
+
+    def report(self, message):
+        logger.info(message)
+        if self.progress is not None:
+            self.progress(message)
+
+    def pause(self):
+        self._paused = True
+        if self.engine is not None:
+            self.engine.pause()
+
+    def resume(self):
+        self._paused = False
+        if self.engine is not None:
+            self.engine.resume()
+
+    def _resume(self, run_dir):
+        self.engine = StepScan.from_run(self.snom, run_dir, storage_settings=self.storage_settings, progress=self.progress,
+                                        on_cube=self.on_cube, on_step=self.on_step, cost_model=self.cost_model,
+                                        tracer=self.new_tracer() if self.new_tracer is not None else None,
+                                        processor=self.processor, drift_settings=self.drift_settings)
+        self.engine.start_paused = self._paused
+        return self.engine
+
+    async def run(self):
+        self.results = []
+        for index, job in enumerate(self.jobs):
+            self.report(f"Queue job {index + 1}/{len(self.jobs)}: {job.name}")
+            self.engine = StepScan(self.snom, job.parameters, output_dir=self.output_dir, name=job.name,
+                                   storage_settings=self.storage_settings, progress=self.progress,
+                                   on_cube=self.on_cube, on_step=self.on_step, cost_model=self.cost_model,
+                                   tracer=self.new_tracer() if self.new_tracer is not None else None,
+                                   processor=self.processor, drift_settings=self.drift_settings)
+            self.engine.start_paused = self._paused
+            try:
+                if self.session is not None:
+                    result = await self.session.run(self.engine, self._resume)
+                else:
+                    result = await self.engine.run()
+                self.results.append((job, result))
+            except Exception as e:
+                logger.error("Queue job %s failed: %s", job.name, e)
+                self.results.append((job, e))
+        self.engine = None
+        await self._stitch_mosaics()
+        failed = sum(isinstance(result, Exception) for _, result in self.results)
+        self.report(f"Queue finished, {len(self.results) - failed}/{len(self.results)} jobs succeeded")
+        return self.results
+
+    async def _stitch_mosaics(self):
+        loop = asyncio.get_running_loop()
+        layouts = []
+        for job, _ in self.results:
+            if job.mosaic is not None and job.mosaic not in layouts:
+                layouts.append(job.mosaic)
+        for layout in layouts:
+            tiles = {job.tile: result for job, result in self.results if job.mosaic is layout}
+            failed = [tile for tile, result in tiles.items() if isinstance(result, Exception)]
+            if failed:
+                self.report(f"{layout.name} not stitched, {len(failed)}/{len(tiles)} tiles failed")
+                continue
+            self.report(f"Stitching {layout.name} from {len(tiles)} tiles")
+            job = ScanJob(layout.name, None, mosaic=layout)
+            try:
+                result = await loop.run_in_executor(None, stitch, layout, tiles, run_folder(self.output_dir, layout.name),
+                                                    self.storage_settings, self.progress)
+                self.results.append((job, result))
+            except Exception as e:
+                logger.error("Stitching %s failed: %s", layout.name, e)
+                self.results.append((job, e))
@@ -0,0 +1,154 @@
+"""
+Persistent instrument session
+Keeps one SNOM connection alive with a heartbeat, reconnects with backoff when it drops and continues interrupted runs
+"""
+
+import time
+import asyncio
+
+import logging
+
+logger = logging.getLogger('logger.session')
+
+DEFAULT_SETTINGS = {"heartbeat_interval": 30.0,   # seconds between heartbeats while idle, None disables them
+                    "reconnect_attempts": 10,     # per connection loss, None retries forever
+                    "backoff_initial": 1.0,       # seconds before the first retry, doubled after every failure
+                    "backoff_max": 60.0,
+                    "run_retries": 3}             # reconnects a single run may use before it counts as failed
+
+
+class Session():
+    """Owns the connection of one SNOM for the lifetime of the app or the runner
+
+    Runs on the worker's event loop. The heartbeat refreshes the spawned default scan parameters,
+    which both proves the connection alive and keeps the cached defaults the scans use current.
+    While a run is active the heartbeat stays quiet, the run's own SDK calls notice a drop.
+    """
+
+    def __init__(self, snom, path_to_dll, fingerprint, settings=None, on_state=None):
+        self.snom = snom
+        self.path_to_dll = path_to_dll
+        self.fingerprint = fingerprint
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(settings or {})
+        # Called with True/False whenever the connection state changes
+        self.on_state = on_state
+        self.reconnects = 0
+        self.active_runs = 0
+        self.last_heartbeat = None
+        self._heartbeat = None
+        self._reconnecting = None
+        self._closed = True
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def connected(self):
+        return bool(self.snom.connected)
+
+    def _set_state(self, connected):
+        if self.on_state is not None:
+            self.on_state(connected)
+
+    async def _connect_once(self):
+        loop = asyncio.get_running_loop()
+        if not await self.snom.connect(self.path_to_dll, self.fingerprint):
+            raise ConnectionError("Could not connect to the SNOM")
+        # First spawn right away, scans then use the cached defaults
+        await loop.run_in_executor(None, self.snom.default_parameters)
+
+    async def connect(self):
+        await self._connect_once()
+        self._closed = False
+        if self._heartbeat is None and self.settings["heartbeat_interval"]:
+            self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+        self._set_state(True)
+        return True
+
+    async def close(self):
+        self._closed = True
+        for task in (self._heartbeat, self._reconnecting):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._heartbeat = None
+        self._reconnecting = None
+        self.snom.close()
+        self._set_state(False)
+
+    async def reconnect(self):
+        """Reconnect with exponential backoff, concurrent callers share one attempt"""
+        if self._reconnecting is None or self._reconnecting.done():
+            self._reconnecting = asyncio.create_task(self._reconnect())
+        await asyncio.shield(self._reconnecting)
+
+    async def _reconnect(self):
+        self._set_state(False)
+        delay = self.settings["backoff_initial"]
+        attempts = self.settings["reconnect_attempts"]
+        attempt = 0
+        while not self._closed:
+            attempt += 1
+            try:
+                self.snom.close()
+            except Exception as e:
+                logger.debug("Closing the dropped connection failed: %s", e)
+            try:
+                await self._connect_once()
+            except Exception as e:
+                if attempts is not None and attempt >= attempts:
+                    logger.error("Giving up reconnecting after %d attempts: %s", attempt, e)
+                    raise ConnectionError(f"Could not reconnect after {attempt} attempts: {e}") from e
+                logger.warning("Reconnect attempt %d failed (%s), next try in %.1f s", attempt, e, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.settings["backoff_max"])
+                continue
+            self.reconnects += 1
+            logger.warning("Reconnected to the SNOM after %d attempt(s), %d reconnect(s) this session", attempt, self.reconnects)
+            self._set_state(True)
+            return
+        raise ConnectionError("Session closed while reconnecting")
+
+    async def _heartbeat_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.settings["heartbeat_interval"])
+            if self.active_runs or self._closed:
+                continue
+            try:
+                await loop.run_in_executor(None, self.snom.spawn_parameters)
+                if not self.snom.connected:
+                    raise ConnectionError("SNOM reports it is not connected")
+                self.last_heartbeat = time.time()
+            except Exception as e:
+                logger.warning("Heartbeat failed: %s", e)
+                try:
+                    await self.reconnect()
+                except ConnectionError:
+                    # Stays disconnected, the next heartbeat tries again
+                    pass
+
+    async def run(self, engine, resume):
+        """Run a StepScan, after a connection drop reconnect and continue it from its checkpoint journal
+
+        `resume(run_dir)` builds the engine that continues the run in `run_dir`.
+        """
+        self.active_runs += 1
+        retries = 0
+        try:
+            while True:
+                try:
+                    return await engine.run()
+                except ConnectionError as e:
+                    if self._closed or retries >= self.settings["run_retries"]:
+                        raise
+                    retries += 1
+                    logger.warning("Connection lost during %s: %s, reconnecting", engine.run_dir, e)
+                    await self.reconnect()
+                    # Without a cube nothing was acquired yet and the same engine simply starts again
+                    if engine.cube is not None:
+                        engine = resume(engine.run_dir)
+        finally:
+            self.active_runs -= 1
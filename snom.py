@@ -0,0 +1,176 @@
+"""
+Connection to the neaSNOM through the nea_tools SDK, free of any GUI imports
+Used by the GUI app and the headless runner
+"""
+
+import os
+import json
+import shutil
+import threading
+
+import logging
+
+logger = logging.getLogger('logger.snom')
+
+DLL_MANIFEST = "manifest.json"
+
+# The SDK is imported on first use, see load_sdk()
+nea_tools = None
+_sdk_checked = False
+_sdk_lock = threading.Lock()
+_dll_paths = {}
+
+
+def load_sdk():
+    """Import nea_tools once, returns None when the SDK is missing"""
+    global nea_tools, _sdk_checked
+    with _sdk_lock:
+        if not _sdk_checked:
+            try:
+                import nea_tools as module
+                nea_tools = module
+            except Exception as e:
+                logger.warning("nea_tools module could not be imported: %s", e)
+            _sdk_checked = True
+    return nea_tools
+
+
+def sdk_available():
+    return load_sdk() is not None
+
+
+def _manifest(folder):
+    files = {}
+    for root, _, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            info = os.stat(path)
+            files[os.path.relpath(path, folder)] = [info.st_size, int(info.st_mtime)]
+    return files
+
+
+def cached_dll_path(path_to_dll, cache_dir):
+    """Local copy of the SDK folder on the network share, refreshed when the files on the share change
+
+    Falls back to the share itself when there is no cache folder or the copy fails.
+    The result is remembered, so the share is only checked once per session.
+    """
+    if not cache_dir or not os.path.isdir(path_to_dll):
+        return path_to_dll
+    if path_to_dll in _dll_paths:
+        return _dll_paths[path_to_dll]
+    target = os.path.join(cache_dir, os.path.basename(os.path.normpath(path_to_dll)))
+    try:
+        manifest = _manifest(path_to_dll)
+        stored = None
+        if os.path.exists(os.path.join(target, DLL_MANIFEST)):
+            with open(os.path.join(target, DLL_MANIFEST), "r") as file:
+                stored = json.load(file)
+        if stored != manifest:
+            logger.info("Copying the SDK from %s to %s", path_to_dll, target)
+            shutil.rmtree(target, ignore_errors=True)
+            shutil.copytree(path_to_dll, target)
+            with open(os.path.join(target, DLL_MANIFEST), "w") as file:
+                json.dump(manifest, file)
+    except OSError as e:
+        logger.warning("Could not cache the SDK from %s, loading it from the share: %s", path_to_dll, e)
+        target = path_to_dll
+    _dll_paths[path_to_dll] = target
+    return target
+
+class neaSNOM():
+    simulated = False
+
+    def __init__(self,path_to_dll,fingerprint,dll_cache=None):
+
+        self.dll_cache = dll_cache
+        self.name = None
+        self.connected = False
+        self.engaged = False
+        self.context = None
+        self.nea = None
+        self.scan_parameters = None
+        self.scan = None
+        self.approach_sample = None
+
+    async def connect(self,path_to_dll,fingerprint):
+        if load_sdk() is None:
+            logger.error("nea_tools module was not found, missing SDK!")
+            # Never a silent switch to the simulator, that takes simulate: true or --simulate
+            raise ConnectionError("The nea_tools SDK could not be loaded, set simulate: true to use the simulated SNOM")
+        path_to_dll = cached_dll_path(path_to_dll, self.dll_cache)
+
+        host = 'nea-server'
+    
+        try:
+            await nea_tools.connect(host, fingerprint, path_to_dll)
+        except ConnectionError as e:
+            logger.error("Could not connect to %s: %s", host, e)
+            return False
+
+        try:
+            from neaspec import context
+            import Nea.Client.SharedDefinitions as nea
+
+            # global nea_tools
+            # import nea_tools
+
+            from nea_tools.logic import scan
+            # from nea_tools import database, plotter
+            # from nea_tools.utils.colors import COLORS,CMAPS
+            from nea_tools.logic.approach import approach_sample
+
+        except ModuleNotFoundError:
+            raise ConnectionError('Connection refused or timeout. Retry to connect again.')
+        else:
+            self.connected = True
+            self.engaged = False
+            self.scan_parameters = None
+
+            self.context = context
+            self.nea = nea
+            self.scan = scan
+            self.approach_sample = approach_sample
+
+            return True
+        
+    def spawn_parameters(self):
+        if self.connected:
+            self.scan_parameters = self.context.Logic.DefaultScanParameters.Spawn()
+
+    def default_parameters(self):
+        """Spawned default scan parameters, cached until the next connect"""
+        if self.scan_parameters is None:
+            if not self.connected:
+                raise ConnectionError("SNOM is not connected")
+            self.spawn_parameters()
+        return self.scan_parameters
+
+    def close(self):
+        if self.connected:
+            logger.debug('\nDisconnecting from neaServer!')
+            nea_tools.disconnect()
+            self.connected = False
+            self.engaged = False
+        else:
+            logger.debug("SNOM was not connected!")
+
+
+def simulated(config, offline=False):
+    """True when the simulated backend was asked for, with simulate: true, --simulate or offline mode in the GUI"""
+    return offline or bool(config.get('simulate', False))
+
+
+def instrument_id(config, offline=False):
+    """Key of the instrument in the cost model file"""
+    if simulated(config, offline):
+        return 'simulated'
+    return str(config['fingerprint'])
+
+
+def create_snom(config, offline=False):
+    if simulated(config, offline):
+        import nea_sim
+        logger.warning("Working in offline mode, using simulated SNOM")
+        return nea_sim.SimulatedSNOM(config.get('simulation'))
+    return neaSNOM(config['path_to_dll'], config['fingerprint'], (config.get('startup') or {}).get('dll_cache'))
@@ -0,0 +1,77 @@
+"""
+Deferred startup work
+The window shows first, the heavy modules and the instrument SDK are then imported and warmed up once in a background thread
+"""
+
+import time
+import importlib
+import threading
+
+import logging
+
+logger = logging.getLogger('logger.startup')
+
+# Everything a scan needs but the window does not, roughly the slowest first
+HEAVY_MODULES = ("numpy", "pyqtgraph", "h5py", "stepscan", "scanqueue", "processing", "estimator", "checkpoint", "preview")
+DEFAULT_SETTINGS = {"budget": 1.5,          # seconds from import to the shown window, a warning is logged above it
+                    "dll_cache": None}      # local folder for a copy of the SDK on the network share, None disables it
+
+
+class Preloader():
+    """Imports modules and runs warm-up calls in a daemon thread, each step is timed
+
+    Importing in a thread is safe, a module the main thread needs earlier is simply waited for
+    through the import lock. Failures are logged and skipped, the caller imports the module
+    again when it needs it and gets the real error there.
+    """
+
+    def __init__(self, modules=HEAVY_MODULES, warmups=(), on_done=None):
+        self.modules = tuple(modules)
+        self.warmups = list(warmups)
+        self.on_done = on_done
+        self.durations = {}
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="Preloader", daemon=True)
+
+    def start(self):
+        if self.thread.ident is None:
+            self.thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def _timed(self, name, function, *args):
+        start = time.perf_counter()
+        try:
+            function(*args)
+        except Exception as e:
+            logger.warning("Preloading %s failed: %s", name, e)
+        self.durations[name] = time.perf_counter() - start
+
+    def _run(self):
+        start = time.perf_counter()
+        for module in self.modules:
+            self._timed(module, importlib.import_module, module)
+        for name, function in self.warmups:
+            self._timed(name, function)
+        self.durations["total"] = time.perf_counter() - start
+        logger.debug("Preloaded in %.2f s: %s", self.durations["total"],
+                     ", ".join(f"{name} {duration:.2f} s" for name, duration in self.durations.items() if name != "total"))
+        self.done.set()
+        if self.on_done is not None:
+            self.on_done()
+
+
+def warm_numpy():
+    """First FFT and memmap calls pay for their setup, do that off the GUI thread"""
+    import numpy as np
+    np.fft.rfft(np.zeros((64, 4)), axis=0)
+    np.linspace(0.0, 1.0, 8)
+
+
+def check_budget(elapsed, budget):
+    if budget is not None and elapsed > budget:
+        logger.warning("Window shown after %.2f s, over the startup budget of %.2f s", elapsed, budget)
+    else:
+        logger.info("Window shown after %.2f s", elapsed)
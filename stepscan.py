@@ -0,0 +1,419 @@
+"""
+White-light step scan engine
+Walks the interferometer positions and overlaps the acquisition of one step with the download and save of the previous one
+"""
+
+import os
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import logging
+
+from datacube import DataCube, META_FILE, remove_discarded, run_folder
+from checkpoint import Journal
+from estimator import format_duration
+from tracing import Tracer
+from sampling import sampled_positions
+from scanplan import SCAN_DEFAULTS
+from drift import DriftTracker, correct_cube
+from writer import StepWriter
+import logs
+import storage
+
+logger = logging.getLogger('logger.stepscan')
+
+CHANNELS = tuple(SCAN_DEFAULTS["Channels"])
+APPROACH_SETPOINT = 0.8
+
+
+def interferometer_positions(scan_parameters, ifg_parameters):
+    """Reference mirror positions visited by the scan, all of the grid or the subset chosen by its Sampling"""
+    if scan_parameters.get("ScanMode", "WLI") == "WLI_single":
+        return np.array([float(ifg_parameters["InterferometerCenter"])])
+    return sampled_positions(ifg_parameters)
+
+
+class StepScan():
+    """Coroutine based step scan
+
+    The blocking SDK calls run in the loop's executor, so cancelling the task running run()
+    stops the scan right away. pause() and resume() take effect between steps and have to be
+    called from the loop thread.
+
+    Every completed step is recorded in the run's checkpoint journal, an interrupted run is
+    continued with StepScan.from_run(), which only acquires the steps missing from the journal.
+
+    With drift tracking enabled the topography of every downloaded step is compared with the one
+    before, the following steps are scanned at the offset the drift has moved the sample to and
+    the frames are shifted back onto the first one before processing.
+
+    Only the channels of the scan parameters are downloaded, all of them at the same time, into a
+    cube of their DataFormat. The downloaded frames are written, checkpointed and mirrored by a
+    writer.StepWriter, whose queue only holds up the download once it is full.
+    """
+
+    def __init__(self, snom, parameters, output_dir="data", name="Step Scan", channels=None, storage_settings=None, progress=None,
+                 on_cube=None, on_step=None, cost_model=None, tracer=None, processor=None, run_dir=None, drift_settings=None):
+        self.snom = snom
+        # Snapshot, the editors keep changing their dicts while the scan runs
+        self.scan_parameters = dict(parameters["scan"])
+        self.ifg_parameters = dict(parameters["ifg"])
+        self.name = name
+        self.channels = tuple(channels if channels is not None else self.scan_parameters.get("Channels", CHANNELS))
+        self.dtype = np.dtype(self.scan_parameters.get("DataFormat", SCAN_DEFAULTS["DataFormat"]))
+        self.progress = progress
+        self.storage_settings = storage_settings
+        # processing.ProcessingEngine, computes the spectra at the end and optionally during the scan
+        self.processor = processor if processor is not None and processor.enabled else None
+        # Called with the cube folder once it exists and with (step, position) after each saved step
+        self.on_cube = on_cube
+        self.on_step = on_step
+        self.cost_model = cost_model
+        self.tracer = tracer if tracer is not None else Tracer(enabled=False)
+        self.positions = interferometer_positions(self.scan_parameters, self.ifg_parameters)
+        self.drift = DriftTracker(self.scan_parameters, drift_settings) if (drift_settings or {}).get("enabled") else None
+        if self.drift is not None and self.drift.settings["channel"] not in self.channels:
+            logger.warning("Drift tracking needs the %s channel, which %s does not record", self.drift.settings["channel"], name)
+            self.drift = None
+        # Offset every pending step was scanned at
+        self._offsets = {}
+
+        # An existing run folder is resumed
+        self.resuming = run_dir is not None and os.path.exists(os.path.join(run_dir, META_FILE))
+        self.run_dir = run_dir
+        if self.run_dir is None:
+            self.run_dir = run_folder(output_dir, name)
+        self.journal = Journal(self.run_dir)
+        self.completed = set()
+
+        self.laser_wavelength = None
+        self.cube = None
+        self.result_path = None
+        self.spectra_path = None
+        self.current_step = 0
+        self.start_paused = False
+        self.eta = None
+        self.timings = {"approach": None, "scan": [], "download": [], "save": None, "bytes": 0}
+        self._steps_started = None
+        self._acquired = 0
+        self._running = None
+        self._steps = None
+        self._stage_error = None
+        self._live_update = None
+        self._downloads = None
+        self.writer = None
+        self.last_step_time = None
+        self.active = False
+
+    @classmethod
+    def from_run(cls, snom, run_dir, **kwargs):
+        """Engine that continues the interrupted run in `run_dir` with the parameters it was started with"""
+        with open(os.path.join(run_dir, META_FILE), "r") as file:
+            meta = json.load(file)
+        metadata = meta["metadata"]
+        parameters = {"scan": metadata["scan"], "ifg": metadata["ifg"]}
+        return cls(snom, parameters, output_dir=os.path.dirname(run_dir), name=metadata.get("name", "Step Scan"),
+                   channels=meta["channels"], run_dir=run_dir, **kwargs)
+
+    @property
+    def simulated(self):
+        """True when the frames come from nea_sim, recorded in the run metadata"""
+        return bool(getattr(self.snom, "simulated", False))
+
+    def report(self, message):
+        logger.info(message)
+        if self.progress is not None:
+            self.progress(message)
+
+    def metrics(self):
+        """Progress and throughput for metrics.Metrics, read from another thread, None unless the scan runs"""
+        cube = self.cube
+        # The cube is closed before the run returns
+        done = cube.done if self.active and cube is not None else None
+        if done is None:
+            return None
+        channels, steps, height, width = cube.shape
+        elapsed = time.perf_counter() - self._steps_started if self._steps_started is not None else 0.0
+        writer = self.writer
+        return {"step": self.current_step + 1, "steps": steps, "done": int(done.sum()),
+                "pixels_per_second": self._acquired * channels * height * width / elapsed if elapsed > 0 else 0.0,
+                "written_bytes": writer.written_bytes if writer is not None else 0,
+                "eta": self.eta, "last_step": self.last_step_time,
+                "queue_depth": writer.depth if writer is not None else 0,
+                "queue_capacity": writer.capacity if writer is not None else None}
+
+    def pause(self):
+        if self._running is not None and self._running.is_set():
+            self._running.clear()
+            self.report(f"Pausing after step {self.current_step + 1}")
+
+    def resume(self):
+        if self._running is not None and not self._running.is_set():
+            self._running.set()
+            self.report("Resuming scan")
+
+    @property
+    def paused(self):
+        return self._running is not None and not self._running.is_set()
+
+    def create_scan(self, step, position):
+        if self.drift is not None:
+            offset = self.drift.offset(step)
+        else:
+            offset = (self.scan_parameters["PhysicalOffsetX"], self.scan_parameters["PhysicalOffsetY"])
+        self._offsets[step] = offset
+        return self.snom.scan.Whitelight(Name=f"{self.name} {step}",
+                                         PhysicalOffsetX=offset[0],
+                                         PhysicalOffsetY=offset[1],
+                                         PhysicalSizeX=self.scan_parameters["PhysicalSizeX"],
+                                         PhysicalSizeY=self.scan_parameters["PhysicalSizeY"],
+                                         TargetResolutionWidth=self.scan_parameters["TargetResolutionWidth"],
+                                         TargetResolutionHeight=self.scan_parameters["TargetResolutionHeight"],
+                                         Angle=self.scan_parameters["Angle"],
+                                         TargetMillisecondsPerPixel=self.scan_parameters["TargetMillisecondsPerPixel"],
+                                         LaserSourceTargetWavelength=self.laser_wavelength,
+                                         PhysicalRangeM=(position, position))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._running = asyncio.Event()
+        if not self.start_paused:
+            self._running.set()
+        self._steps = asyncio.Queue(maxsize=1)
+        self._stage_error = None
+        logs.set_run(os.path.basename(os.path.normpath(self.run_dir)))
+
+        if self.resuming:
+            with self.tracer.span("open cube"):
+                self.cube = await loop.run_in_executor(None, DataCube.open, self.run_dir, "r+")
+            if not np.allclose(self.cube.positions, self.positions):
+                self.cube.close()
+                raise ValueError(f"The interferometer positions of {self.run_dir} do not match its parameters")
+            self.completed = await loop.run_in_executor(None, self.journal.completed_steps, self.cube)
+            if self.simulated:
+                self.cube.update_metadata(simulated=True)
+            if self.drift is not None:
+                self._restore_drift()
+            self.journal.write("resume", completed=len(self.completed))
+            self.report(f"Resuming {self.run_dir}, {len(self.completed)}/{len(self.positions)} steps already done")
+        else:
+            # Data files of earlier runs that were still mapped when they were discarded
+            await loop.run_in_executor(None, remove_discarded, os.path.dirname(self.run_dir))
+            with self.tracer.span("create cube"):
+                self.cube = await loop.run_in_executor(None, lambda: DataCube.create(
+                    self.run_dir, self.channels, self.positions,
+                    self.scan_parameters["TargetResolutionHeight"],
+                    self.scan_parameters["TargetResolutionWidth"], dtype=self.dtype,
+                    metadata={"name": self.name, "scan": self.scan_parameters, "ifg": self.ifg_parameters,
+                              "simulated": self.simulated}))
+            self.journal.write("start", name=self.name, steps=len(self.positions), channels=list(self.channels))
+        if self.on_cube is not None:
+            self.on_cube(self.run_dir)
+        with self.tracer.span("spawn parameters"):
+            # Spawned once per connection, the session heartbeat keeps the cached defaults current
+            defaults = await loop.run_in_executor(None, self.snom.default_parameters)
+            self.laser_wavelength = defaults.LaserSourceTargetWavelength
+
+        # One thread per channel, the channels of a step download at the same time
+        self._downloads = ThreadPoolExecutor(max_workers=len(self.channels), thread_name_prefix="download")
+        self.writer = StepWriter(self.cube, self.journal, self.storage_settings, self.tracer, written=self._written)
+        self.active = True
+        try:
+            return await self._run()
+        finally:
+            self.active = False
+            logs.clear()
+            self._downloads.shutdown(wait=False)
+            self.journal.close()
+            await loop.run_in_executor(None, self.tracer.export, self.run_dir)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        self.writer.start()
+        stage = asyncio.create_task(self._download_stage())
+        try:
+            if not getattr(self.snom, "engaged", False):
+                with self.tracer.span("approach") as span:
+                    await loop.run_in_executor(None, self.snom.approach_sample, APPROACH_SETPOINT)
+                self.timings["approach"] = span.duration
+                self.snom.engaged = True
+            self._steps_started = time.perf_counter()
+            for step, position in enumerate(self.positions):
+                if step in self.completed:
+                    continue
+                await self._running.wait()
+                if self._stage_error is not None or self.writer.error is not None:
+                    break
+                self.current_step = step
+                logs.set_step(step)
+                await self._acquire(step, position)
+            await self._steps.put(None)
+            await stage
+            await self.writer.close()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                self.report(f"Scan cancelled at step {self.current_step + 1}/{len(self.positions)}")
+            # The tip state is unknown after an aborted scan, approach again next time
+            self.snom.engaged = False
+            stage.cancel()
+            await asyncio.gather(stage, return_exceptions=True)
+            await self.writer.abort()
+            if self._live_update is not None:
+                await asyncio.gather(self._live_update, return_exceptions=True)
+            self._release_pending()
+            self.cube.close()
+            raise
+        if self._stage_error is None:
+            self._stage_error = self.writer.error
+        if self._stage_error is not None:
+            self.cube.close()
+            raise self._stage_error
+        if self.writer.blocked > 0.0:
+            self.report(f"Writing held up the download for {self.writer.blocked:.1f} s, "
+                        f"the queue of {self.writer.capacity} steps was full")
+
+        if self.drift is not None:
+            # A live update still running reads the frames the correction is about to shift
+            if self._live_update is not None:
+                await asyncio.gather(self._live_update, return_exceptions=True)
+            self.cube.update_metadata(drift=self.drift.summary())
+            if self.drift.settings["correct"]:
+                with self.tracer.span("drift correction"):
+                    await loop.run_in_executor(None, correct_cube, self.cube, self.drift.settings, self.progress)
+
+        if self.processor is not None:
+            # Before saving, the storage settings may discard the raw cube
+            await self._process()
+
+        if self.processor is not None and not storage.keeps_cube(self.storage_settings):
+            # The pool workers keep the cube mapped between passes, ending the pool unmaps it so it can be deleted
+            self.processor.close()
+
+        self.timings["bytes"] = self.cube.data.nbytes
+        with self.tracer.span("save", bytes=self.cube.data.nbytes) as span:
+            self.result_path = await loop.run_in_executor(None, storage.save_cube, self.cube, self.storage_settings)
+        self.timings["save"] = span.duration
+        self.cube.close()
+        self.journal.write("finished", result=self.result_path)
+        if self.cost_model is not None:
+            self.cost_model.add_run(self.scan_parameters, self.channels, self.timings)
+        self.report(f"Step scan finished, data saved to {self.result_path}")
+        return self.result_path
+
+    async def _acquire(self, step, position):
+        loop = asyncio.get_running_loop()
+        wl = self.create_scan(step, position)
+        wl.__enter__()
+        try:
+            with self.tracer.span("scan start", step=step) as started:
+                await loop.run_in_executor(None, wl.scan)
+            with self.tracer.span("wait", step=step) as waited:
+                await loop.run_in_executor(None, wl.wait_for_scan)
+            self.timings["scan"].append(started.duration + waited.duration)
+        except BaseException as e:
+            # Leaving the scan context aborts it on the instrument
+            wl.__exit__(type(e), e, e.__traceback__)
+            raise
+        # Waits only while the previous step is still being downloaded
+        with self.tracer.span("hand-off", step=step):
+            await self._steps.put((step, position, wl))
+        self._acquired += 1
+        if self.cost_model is not None:
+            self.eta = self.cost_model.eta(self.scan_parameters, self.channels, self._acquired,
+                                           len(self.positions) - len(self.completed),
+                                           time.perf_counter() - self._steps_started)
+        # Nobody reads the step message without a progress callback and with INFO off
+        if self.progress is None and not logger.isEnabledFor(logging.INFO):
+            return
+        message = f"Step {step + 1}/{len(self.positions)} acquired at {position:.2f}"
+        if self.eta is not None:
+            message += f", ETA {format_duration(self.eta)}"
+        if self.writer.depth:
+            message += f", {self.writer.depth}/{self.writer.capacity} steps waiting to be written"
+        self.report(message)
+
+    async def _download_stage(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._steps.get()
+            if item is None:
+                return
+            step, position, wl = item
+            try:
+                # After a failure the remaining steps are only released, so the acquisition never waits on a dead stage
+                if self._stage_error is None:
+                    with self.tracer.span("download step", step=step) as span:
+                        results = await asyncio.gather(*(loop.run_in_executor(self._downloads, self._download, step, channel, wl)
+                                                         for channel in self.channels))
+                    self.timings["download"].append(span.duration)
+                    self._offsets.pop(step, None)
+                    frames = {channel: frame for channel, (frame, _) in zip(self.channels, results)}
+                    drift = next((record for _, record in results if record is not None), None)
+                    # Waits only while the writer queue is full
+                    await self.writer.put(step, position, frames, drift)
+            except Exception as e:
+                logger.error("Failed to download step %d: %s", step, e, extra={"step": step})
+                self._stage_error = e
+            finally:
+                wl.__exit__(None, None, None)
+
+    def _download(self, step, channel, wl):
+        """(frame, drift record) of one channel of a step, the record only for the drift channel"""
+        with self.tracer.span("download", step=step, channel=channel):
+            frame = wl.data[channel]
+        with self.tracer.span("convert", step=step, channel=channel) as span:
+            frame = np.asarray(frame)
+            span.args["bytes"] = frame.nbytes
+        if self.drift is not None and channel == self.drift.settings["channel"]:
+            # Measured right away, so the feedback reaches the earliest possible step
+            with self.tracer.span("drift", step=step):
+                return frame, self.drift.update(step, frame, self._offsets.get(step, self.drift.nominal))
+        return frame, None
+
+    def _written(self, step, position):
+        self.last_step_time = time.time()
+        if self.on_step is not None:
+            self.on_step(step, position)
+        self._start_live_update(step)
+
+    def _restore_drift(self):
+        """Pick up the drift estimate of the interrupted run from its journal"""
+        records = [record for record in self.journal.records()
+                   if record["event"] == "drift" and record["step"] in self.completed]
+        if records:
+            record = max(records, key=lambda record: record["step"])
+            self.drift.restore(record, self.cube.frame(self.drift.settings["channel"], record["step"]))
+            self.report(f"Continuing from a drift of ({record['drift'][0]:.3f}, {record['drift'][1]:.3f}) µm")
+
+    def _start_live_update(self, step):
+        settings = self.processor.settings if self.processor is not None else {}
+        if not settings.get("live") or (step + 1) % max(1, int(settings["live_interval"])) != 0:
+            return
+        # Skipped while the previous update is still running, the next one picks up its steps
+        if self._live_update is None or self._live_update.done():
+            self._live_update = asyncio.create_task(self._process(live=True))
+
+    async def _process(self, live=False):
+        loop = asyncio.get_running_loop()
+        if not live and self._live_update is not None:
+            await asyncio.gather(self._live_update, return_exceptions=True)
+        try:
+            with self.tracer.span("live process" if live else "process"):
+                path = await loop.run_in_executor(None, self.processor.process, self.cube, None,
+                                                  None if live else self.progress)
+        except Exception as e:
+            # The measured data is still saved, the spectra can be computed again with processing.py
+            logger.error("Processing of %s failed: %s", self.run_dir, e)
+            return
+        if not live:
+            self.spectra_path = path
+
+    def _release_pending(self):
+        while not self._steps.empty():
+            item = self._steps.get_nowait()
+            if item is not None:
+                item[2].__exit__(None, None, None)
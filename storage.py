@@ -0,0 +1,131 @@
+"""
+Binary result files
+Exports the data cube of a run into one chunked, optionally compressed HDF5 file with the scan parameters embedded
+"""
+
+import os
+import json
+
+import numpy as np
+import logging
+
+logger = logging.getLogger('logger.storage')
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+    logger.warning("h5py module not found, results are kept as .npy data cubes")
+
+DEFAULT_SETTINGS = {"format": "hdf5",
+                    "compression": "gzip",    # None, "gzip" or "lzf", all lossless
+                    "compression_level": 4,
+                    "keep_cube": True}
+
+RESULT_FILE = "result.h5"
+CHUNK_BYTES = 1 << 20
+CHUNK_STEPS = 16
+
+
+def choose_chunks(shape, itemsize, target=CHUNK_BYTES, steps=CHUNK_STEPS):
+    """Chunk shape of a (steps, height, width) dataset
+
+    A few steps times a square tile keeps both an image slice and a per-pixel spectrum
+    within a small number of chunks
+    """
+    n, height, width = shape
+    cs = max(1, min(n, steps))
+    tile = int(np.sqrt(target / (itemsize * cs)))
+    tile = max(1, 2**int(np.log2(max(tile, 1))))
+    return (cs, max(1, min(height, tile)), max(1, min(width, tile)))
+
+
+def _set_attributes(group, parameters):
+    for key, value in parameters.items():
+        if isinstance(value, dict):
+            _set_attributes(group.require_group(key), value)
+        elif value is None:
+            group.attrs[key] = "None"
+        else:
+            try:
+                group.attrs[key] = value
+            except (TypeError, ValueError):
+                # Lists of dicts and other values without an HDF5 type are kept as JSON
+                group.attrs[key] = json.dumps(value, default=_plain)
+
+
+def _plain(value):
+    return value.tolist() if isinstance(value, (np.generic, np.ndarray)) else str(value)
+
+
+def export_hdf5(cube, path, compression="gzip", compression_level=4):
+    """Copy the cube into an HDF5 file, one dataset of shape (steps, height, width) per channel
+
+    Integer cubes are copied as they are stored, with the (offset, scale) of every frame in 'scales'.
+    """
+    if h5py is None:
+        raise ImportError("h5py is required to write HDF5 result files")
+    options = {}
+    if compression == "gzip":
+        options = {"compression": "gzip", "compression_opts": compression_level, "shuffle": True}
+    elif compression is not None:
+        options = {"compression": compression, "shuffle": True}
+
+    steps = cube.shape[1]
+    with h5py.File(path, "w") as file:
+        file.create_dataset("positions", data=cube.positions)
+        file.create_dataset("done", data=np.asarray(cube.done))
+        file.attrs["channels"] = json.dumps(cube.channels)
+        _set_attributes(file.require_group("parameters"), cube.meta.get("metadata", {}))
+
+        channels = file.require_group("channels")
+        for index, channel in enumerate(cube.channels):
+            chunks = choose_chunks(cube.shape[1:], cube.data.dtype.itemsize)
+            dataset = channels.create_dataset(channel, shape=cube.shape[1:], dtype=cube.data.dtype,
+                                              chunks=chunks, **options)
+            # Whole chunk rows at a time, straight from the memory map
+            for start in range(0, steps, chunks[0]):
+                stop = min(start + chunks[0], steps)
+                dataset[start:stop] = cube.data[index, start:stop]
+            if cube.scales is not None:
+                file.require_group("scales").create_dataset(channel, data=np.asarray(cube.scales[index]))
+    logger.info("Saved %s", path)
+    return path
+
+
+def keeps_cube(settings=None):
+    """False when save_cube() deletes the data cube after the export"""
+    config = dict(DEFAULT_SETTINGS)
+    config.update(settings or {})
+    return config["keep_cube"] or config["format"] != "hdf5" or h5py is None
+
+
+def save_cube(cube, settings=None):
+    """Write the final result file of a run according to the storage settings"""
+    config = dict(DEFAULT_SETTINGS)
+    config.update(settings or {})
+    if config["format"] != "hdf5" or h5py is None:
+        return cube.path
+
+    path = os.path.join(cube.path, RESULT_FILE)
+    export_hdf5(cube, path, config["compression"], config["compression_level"])
+    if not config["keep_cube"]:
+        # Files the preview still maps stay until datacube.remove_discarded(), the result is written either way
+        cube.discard()
+    return path
+
+
+def read_frames(file, channel, steps=slice(None)):
+    """Frames of one channel of an open result file in the units they were measured in"""
+    values = file["channels"][channel][steps]
+    if "scales" not in file:
+        return values
+    scales = file["scales"][channel][steps]
+    shape = np.shape(scales)[:-1] + (1, 1)
+    return (values * scales[..., 1].reshape(shape) + scales[..., 0].reshape(shape)).astype(np.float32)
+
+
+def load_channel(path, channel):
+    """Read one channel of a result file as an array of shape (steps, height, width)"""
+    with h5py.File(path, "r") as file:
+        return read_frames(file, channel)
@@ -0,0 +1,78 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import nea_sim
+from checkpoint import Journal, find_unfinished, frame_offsets
+from datacube import DataCube
+from scanplan import ScanPlan
+from stepscan import StepScan
+
+PLAN = ScanPlan({"TargetResolutionWidth": 8, "TargetResolutionHeight": 6, "Channels": ["Z", "O2A"]}, {"NumberOfPoints": 16})
+
+
+def connected_snom():
+    snom = nea_sim.SimulatedSNOM({"scan_duration": 0.005, "seed": 0})
+    asyncio.run(snom.connect("", ""))
+    return snom
+
+
+async def interrupted(engine, steps):
+    task = asyncio.ensure_future(engine.run())
+    while len([record for record in engine.journal.records() if record["event"] == "step"]) < steps:
+        await asyncio.sleep(0.002)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def test_journal_records_the_offsets_of_each_step(tmp_path):
+    cube = DataCube.create(str(tmp_path), ["Z", "O2A"], np.arange(4.0), 3, 2, dtype=np.float32)
+    journal = Journal(str(tmp_path))
+    for step in (0, 2):
+        cube.mark_done(step)
+        journal.record_step(cube, step, float(step))
+    journal.close()
+    # Channels are contiguous blocks of 4 steps of 3 x 2 float32 values
+    assert frame_offsets(cube, 2) == {"Z": cube.data.offset + 2 * 24, "O2A": cube.data.offset + 6 * 24}
+    assert Journal(str(tmp_path)).completed_steps(cube) == {0, 2}
+    with open(Journal(str(tmp_path)).filename, "a") as file:
+        file.write('{"event": "step", "step": 3, "posi')
+    assert Journal(str(tmp_path)).completed_steps(cube) == {0, 2}
+    cube.close()
+
+    other = DataCube.create(str(tmp_path / "other"), ["Z", "O2A"], np.arange(5.0), 3, 2, dtype=np.float32)
+    with pytest.raises(ValueError):
+        Journal(str(tmp_path)).completed_steps(other)
+    other.close()
+
+
+def test_interrupted_run_resumes_with_the_missing_steps(tmp_path):
+    engine = StepScan(connected_snom(), PLAN.to_parameters(), output_dir=str(tmp_path / "runs"),
+                      storage_settings={"format": "cube"})
+    asyncio.run(interrupted(engine, 5))
+    assert find_unfinished(str(tmp_path / "runs")) == [engine.run_dir]
+
+    cube = DataCube.open(engine.run_dir)
+    done = set(cube.completed_steps().tolist())
+    cube.close()
+    assert 5 <= len(done) < 16
+    resumed = StepScan.from_run(connected_snom(), engine.run_dir, storage_settings={"format": "cube"})
+    assert resumed.resuming and resumed.channels == ("Z", "O2A")
+    scanned = []
+    resumed.on_step = lambda step, position: scanned.append(step)
+    asyncio.run(resumed.run())
+    assert set(scanned) == set(range(16)) - done
+    assert find_unfinished(str(tmp_path / "runs")) == []
+    events = [record["event"] for record in Journal(engine.run_dir).records()]
+    assert events[0] == "start" and "resume" in events and events[-1] == "finished"
+
+    # The same frames as a run that was never interrupted
+    reference = StepScan(connected_snom(), PLAN.to_parameters(), output_dir=str(tmp_path / "reference"),
+                         storage_settings={"format": "cube"})
+    asyncio.run(reference.run())
+    cube, full = DataCube.open(engine.run_dir), DataCube.open(reference.run_dir)
+    assert cube.completed_steps().tolist() == list(range(16))
+    assert np.array_equal(cube.data, full.data)
+    cube.close()
+    full.close()
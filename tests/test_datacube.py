@@ -0,0 +1,25 @@
+import warnings
+
+import numpy as np
+
+from datacube import DataCube, INTEGER_RANGE
+
+
+def test_int16_write_of_degenerate_ranges(tmp_path):
+    rng = np.random.default_rng(0)
+    frames = [np.full((8, 8), 3.0),                   # flat
+              rng.random((8, 8)) * 1e-322,            # range of a few denormals, the step underflows
+              rng.random((8, 8)),
+              rng.random((8, 8)) * 1e6 - 5e5]
+    cube = DataCube.create(str(tmp_path / "run"), ["Z"], np.arange(len(frames), dtype=float), 8, 8, dtype=np.int16)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", RuntimeWarning)
+        for step, frame in enumerate(frames):
+            cube.write_frame("Z", step, frame)
+    assert np.all(np.isfinite(cube.scales[0]))
+    assert np.all(cube.scales[0, :, 1] > 0)
+    for step, frame in enumerate(frames):
+        stored = np.asarray(cube.frame("Z", step), dtype=np.float64)
+        span = max(frame.max() - frame.min(), 1e-300)
+        assert np.abs(stored - frame).max() <= max(span / INTEGER_RANGE, 1e-300) + 1e-6 * np.abs(frame).max()
+    cube.close()
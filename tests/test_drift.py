@@ -0,0 +1,38 @@
+import asyncio
+import json
+
+import os
+
+import numpy as np
+
+import nea_sim
+import storage
+from checkpoint import JOURNAL_FILE
+from datacube import DataCube
+from scanplan import ScanPlan
+from stepscan import StepScan
+
+
+def test_simulated_run_with_drift_saves_and_finishes(tmp_path):
+    plan = ScanPlan({"PhysicalSizeX": 20.0, "PhysicalSizeY": 20.0, "TargetResolutionWidth": 32, "TargetResolutionHeight": 32,
+                     "Channels": ["Z", "M1A"]}, {"NumberOfPoints": 12})
+    snom = nea_sim.SimulatedSNOM({"scan_duration": 0.0, "seed": 0, "drift": [0.05, 0.03]})
+    asyncio.run(snom.connect("", ""))
+    engine = StepScan(snom, plan.to_parameters(), output_dir=str(tmp_path), storage_settings={"format": "hdf5"},
+                      drift_settings={"enabled": True})
+    path = asyncio.run(engine.run())
+
+    with open(os.path.join(engine.run_dir, JOURNAL_FILE)) as file:
+        events = [json.loads(line)["event"] for line in file]
+    assert events[-1] == "finished"
+    cube = DataCube.open(engine.run_dir)
+    assert len(cube.completed_steps()) == 12
+    assert len(json.loads(cube.meta["metadata"]["drift"]["records"])) == 12
+    assert "drift_correction" in cube.meta["metadata"]
+    cube.close()
+    # Without h5py the cube itself is the result
+    if storage.h5py is not None:
+        assert path.endswith(storage.RESULT_FILE)
+        with storage.h5py.File(path, "r") as file:
+            assert len(json.loads(file["parameters"]["drift"].attrs["records"])) == 12
+            assert np.all(file["done"][()])
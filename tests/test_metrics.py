@@ -0,0 +1,80 @@
+import urllib.request
+import urllib.error
+
+import pytest
+
+import metrics
+from metrics import Metrics, render
+
+
+class Session():
+    closed = False
+    connected = True
+    reconnects = 2
+
+
+class Engine():
+    def metrics(self):
+        return {"step": 3, "steps": 10, "done": 2, "pixels_per_second": 1234.5, "written_bytes": 4096,
+                "eta": None, "last_step": 1700000000.123456, "queue_depth": 1, "queue_capacity": 8}
+
+
+class Queue():
+    engine = Engine()
+
+
+def parse(text):
+    """{name: (labels, value)} of the samples, checking every sample follows its HELP and TYPE lines"""
+    samples = {}
+    lines = text.splitlines()
+    for index, line in enumerate(lines):
+        if line.startswith("#"):
+            continue
+        name, value = line.rsplit(" ", 1)
+        labels = ""
+        if "{" in name:
+            name, labels = name[:-1].split("{")
+        assert lines[index - 2].startswith(f"# HELP {name} ") and lines[index - 1] == f"# TYPE {name} {metrics.METRICS[name][0]}"
+        samples[name] = (labels, float(value))
+    return samples
+
+
+def test_render_follows_the_exposition_format():
+    text = render({"snom_scan_step": 4, "snom_connected": 1, "snom_scan_eta_seconds": None},
+                  {"instrument": 'lab "2"\\b'})
+    assert text.endswith("\n")
+    samples = parse(text)
+    assert set(samples) == {"snom_scan_step", "snom_connected"}
+    # Written in the order of METRICS, with the label value escaped
+    assert text.index("snom_connected") < text.index("snom_scan_step")
+    assert samples["snom_scan_step"] == ('instrument="lab \\"2\\"\\\\b"', 4.0)
+    assert parse(render({"snom_scan_last_step_timestamp_seconds": 1700000000.123456}))[
+        "snom_scan_last_step_timestamp_seconds"] == ("", 1700000000.123456)
+
+
+def test_collect_follows_a_queue_to_its_scan():
+    idle = Metrics(session=lambda: Session(), engine=lambda: None)
+    assert idle.collect() == {"snom_connected": 1, "snom_session_reconnects_total": 2, "snom_scan_running": 0}
+    running = Metrics(instrument="snom-1", session=lambda: None, engine=lambda: Queue())
+    samples = parse(running.text())
+    assert samples["snom_scan_running"] == ('instrument="snom-1"', 1.0)
+    assert samples["snom_scan_step"][1] == 3 and samples["snom_writer_queue_capacity"][1] == 8
+    assert "snom_scan_eta_seconds" not in samples and "snom_connected" not in samples
+
+
+def test_textfile_and_endpoint(tmp_path):
+    path = tmp_path / "snom.prom"
+    exporter = Metrics({"enabled": True, "port": 0, "textfile": str(path), "interval": 60.0},
+                       engine=lambda: Engine()).start()
+    try:
+        url = f"http://127.0.0.1:{exporter.server.server_port}"
+        with urllib.request.urlopen(url + "/metrics", timeout=5) as response:
+            assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+            assert parse(response.read().decode())["snom_scan_steps_done"][1] == 2
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "/other", timeout=5)
+    finally:
+        exporter.stop()
+    # stop() writes the final state and leaves no partial file behind
+    assert parse(path.read_text())["snom_scan_step"][1] == 3
+    assert [file.name for file in tmp_path.iterdir()] == ["snom.prom"]
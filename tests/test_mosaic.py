@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pytest
+import yaml
+
+from datacube import run_folder
+from mosaic import MosaicLayout, tile_edges
+from registration import overlap_offsets, solve_origins
+from scanplan import ScanPlan
+from scanqueue import load_recipe
+
+SCAN = ScanPlan({"PhysicalSizeX": 10.0, "PhysicalSizeY": 10.0, "TargetResolutionWidth": 40, "TargetResolutionHeight": 40}).scan
+
+
+def sample(shape, seed=0):
+    """Smooth random relief, something the correlation can lock on to"""
+    rng = np.random.default_rng(seed)
+    image = rng.normal(size=shape)
+    kernel = np.ones(5) / 5
+    image = np.apply_along_axis(np.convolve, 0, image, kernel, "same")
+    return np.apply_along_axis(np.convolve, 1, image, kernel, "same")
+
+
+def test_layout_covers_the_region_in_a_serpentine():
+    layout = MosaicLayout.from_recipe({"center": [50.0, 50.0], "size": [25.0, 18.0], "overlap": 0.1}, SCAN)
+    assert layout.grid == (2, 3)
+    assert layout.tiles() == [(0, 0), (0, 1), (0, 2), (1, 2), (1, 1), (1, 0)]
+    assert layout.shape[1] * layout.pitch[0] >= 25.0 and layout.shape[0] * layout.pitch[1] >= 18.0
+    assert layout.tile_center((0, 0))[0] < 50.0 < layout.tile_center((0, 2))[0]
+    assert len(layout.neighbours()) == 7
+
+
+def test_tiles_outside_the_scanner_range_are_refused():
+    with pytest.raises(ValueError, match="scanner range"):
+        MosaicLayout.from_recipe({"center": [95.0, 50.0], "size": [30.0, 10.0]}, SCAN)
+    with pytest.raises(ValueError, match="scanner range"):
+        MosaicLayout.from_recipe({"center": [50.0, 3.0], "size": [10.0, 20.0]}, SCAN)
+    with pytest.raises(ValueError, match="rotated"):
+        MosaicLayout.from_recipe({"center": [50.0, 50.0], "size": [10.0, 10.0]}, dict(SCAN, Angle=30.0))
+
+
+def test_registration_recovers_a_misplaced_tile():
+    layout = MosaicLayout.from_recipe({"center": [50.0, 50.0], "size": [24.0, 10.0], "overlap": 0.25}, SCAN)
+    assert layout.grid == (1, 3)
+    image = sample((80, 160))
+    shifts = {(0, 0): (0, 0), (0, 1): (2, -3), (0, 2): (1, -2)}
+    rows, columns = layout.tile_pixels
+    tiles = {}
+    for tile, (dy, dx) in shifts.items():
+        y, x = np.add(layout.origin(tile), (20 + dy, 20 + dx))
+        tiles[tile] = image[y:y + rows, x:x + columns]
+    margin = (5, 5)
+    depth = tuple(overlap + extra for overlap, extra in zip(layout.overlap_pixels, margin))
+    edges = {tile: tile_edges(frame, depth) for tile, frame in tiles.items()}
+    offsets = overlap_offsets(edges, layout.neighbours(), margin)
+    dy, dx, peak = offsets[((0, 0), (0, 1))]
+    assert peak > 0.9 and (dy, dx) == pytest.approx((2, -3), abs=0.3)
+
+    nominal = {tile: layout.origin(tile) for tile in layout.tiles()}
+    origins = solve_origins(nominal, offsets, anchor=(0, 0))
+    for tile, shift in shifts.items():
+        assert origins[tile] == pytest.approx(tuple(np.add(nominal[tile], shift)), abs=0.3)
+
+
+def test_featureless_overlaps_keep_their_nominal_place():
+    nominal = {(0, 0): (0, 0), (0, 1): (0, 30)}
+    flat = np.ones((40, 15))
+    edges = {tile: tile_edges(flat, (15, 15)) for tile in nominal}
+    offsets = overlap_offsets(edges, [((0, 0), (0, 1), 1)], (5, 5))
+    assert offsets[((0, 0), (0, 1))][2] == 0.0
+    origins = solve_origins(nominal, offsets)
+    for tile, origin in nominal.items():
+        assert origins[tile] == pytest.approx(origin)
+
+
+def test_jobs_after_a_mosaic_are_ordered(tmp_path):
+    recipe = {"defaults": {"scan": {"PhysicalSizeX": 10.0, "PhysicalSizeY": 10.0}},
+              "mosaic": {"name": "Overview", "center": [20.0, 20.0], "size": [18.0, 18.0]},
+              "jobs": [{"name": "Far", "scan": {"PhysicalOffsetX": 90.0, "PhysicalOffsetY": 90.0}},
+                       {"name": "Near", "scan": {"PhysicalOffsetX": 30.0, "PhysicalOffsetY": 30.0}},
+                       {"name": "Middle", "scan": {"PhysicalOffsetX": 60.0, "PhysicalOffsetY": 60.0}}]}
+    with open(tmp_path / "recipe.yaml", "w") as file:
+        yaml.safe_dump(recipe, file)
+    jobs = load_recipe(str(tmp_path / "recipe.yaml"))
+    tiles = [job for job in jobs if job.mosaic is not None]
+    assert [job.tile for job in tiles] == tiles[0].mosaic.tiles()
+    assert jobs[:len(tiles)] == tiles
+    assert [job.name for job in jobs[len(tiles):]] == ["Near", "Middle", "Far"]
+
+
+def test_run_folders_are_numbered(tmp_path):
+    first = run_folder(str(tmp_path), "Region A")
+    assert os.path.basename(first).endswith("_Region_A")
+    os.makedirs(first)
+    second = run_folder(str(tmp_path), "Region A")
+    assert second != first and not os.path.exists(second)
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from datacube import DataCube
+from processing import SpectralTransform, apodization, process_cube
+
+LINES = (1200.0, 1700.0)    # 1/cm
+ZPD = 180.0                 # um
+
+
+def interferograms(positions, zpd=ZPD, lines=LINES, pixels=(2, 3)):
+    """Cosine interferograms of lines of unit strength, the same in every pixel but scaled per pixel"""
+    opd = 2.0 * (np.asarray(positions) - zpd) * 1e-4
+    signal = sum(np.cos(2 * np.pi * line * opd) for line in lines) + 5.0
+    gain = np.arange(1, pixels[0] * pixels[1] + 1, dtype=np.float64).reshape(pixels)
+    return signal[:, None, None] * gain
+
+
+def peaks(wavenumbers, spectrum, count=2):
+    spectrum = np.real(spectrum)
+    local = np.flatnonzero((spectrum[1:-1] > spectrum[:-2]) & (spectrum[1:-1] > spectrum[2:])) + 1
+    return np.sort(wavenumbers[local[np.argsort(spectrum[local])[-count:]]])
+
+
+def test_apodization_ends():
+    opd = np.linspace(-1.0, 1.0, 11)
+    for name in ("boxcar", "triangle", "happ-genzel", "blackman-harris"):
+        window = apodization(name, opd)
+        assert window[5] == pytest.approx(1.0, abs=0.01)
+    assert apodization("triangle", opd)[0] == pytest.approx(0.0)
+
+
+def test_lines_of_a_known_spectrum():
+    positions = np.linspace(0.0, 400.0, 512)
+    plan = SpectralTransform(positions, ZPD)
+    spectra = plan.transform(interferograms(positions))
+    assert spectra.shape == (len(plan.wavenumbers), 2, 3)
+    resolution = plan.wavenumbers[1] - plan.wavenumbers[0]
+    assert np.allclose(peaks(plan.wavenumbers, spectra[:, 0, 0]), LINES, atol=2 * resolution)
+    # Phase corrected, the lines are positive and real, and scale with the pixel's signal
+    line = np.argmin(np.abs(plan.wavenumbers - LINES[0]))
+    assert np.all(np.real(spectra[line]) > 0)
+    assert np.allclose(spectra[line] / spectra[line, 0, 0], np.arange(1, 7).reshape(2, 3), rtol=1e-6)
+
+
+def test_scan_direction_and_missing_steps():
+    positions = np.linspace(400.0, 0.0, 512)
+    block = interferograms(positions)
+    plan = SpectralTransform(positions, ZPD)
+    forward = SpectralTransform(positions[::-1], ZPD).transform(block[::-1])
+    assert np.allclose(plan.transform(block), forward)
+    valid = np.ones(len(positions), dtype=bool)
+    valid[::7] = False
+    spectra = plan.transform(block, valid)
+    resolution = plan.wavenumbers[1] - plan.wavenumbers[0]
+    assert np.allclose(peaks(plan.wavenumbers, spectra[:, 1, 2]), LINES, atol=2 * resolution)
+
+
+def test_uneven_positions_are_refused():
+    with pytest.raises(ValueError):
+        SpectralTransform([0.0, 1.0, 3.0], 1.0)
+
+
+def test_process_pool_matches_in_process(tmp_path):
+    positions = np.linspace(0.0, 400.0, 512)
+    cube = DataCube.create(str(tmp_path / "run"), ["Z", "O2A"], positions, 12, 5)
+    block = interferograms(positions, pixels=(12, 5))
+    for step in range(len(positions)):
+        cube.write_frame("Z", step, np.zeros((12, 5)))
+        cube.write_frame("O2A", step, block[step])
+        if step != 3:
+            cube.mark_done(step)
+    settings = {"zpd": ZPD, "wavenumber_range": [800, 2500]}
+    single = process_cube(cube, dict(settings, workers=1), path=str(tmp_path / "single"))
+    pooled = process_cube(cube, dict(settings, workers=2), path=str(tmp_path / "pooled"))
+    cube.close()
+    single, pooled = DataCube.open(single), DataCube.open(pooled)
+    assert single.channels == ["O2A"]
+    assert np.all(single.positions >= 800) and np.all(single.positions <= 2500)
+    assert np.allclose(single.data, pooled.data, rtol=1e-5, atol=1e-6 * np.abs(single.data).max())
+    assert single.meta["metadata"]["steps_done"] == 511
+    single.close()
+    pooled.close()
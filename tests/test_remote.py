@@ -0,0 +1,124 @@
+import json
+import asyncio
+
+import numpy as np
+
+import remote
+from remote import RemoteServer, preview_frame
+from scanplan import ScanPlan
+
+
+class Worker():
+    """Stands in for the ScannerApp Worker, records what the server asks of it"""
+
+    def __init__(self):
+        self.plan = ScanPlan()
+        self.session_open = True
+        self.snom = None
+        self.engine = None
+        self.busy = False
+        self.started = []
+
+    def run_measurement(self, plan):
+        if self.busy:
+            return False
+        self.busy = True
+        self.started.append(plan)
+        return True
+
+    def cancel_measurement(self):
+        self.busy = False
+
+
+class Connection():
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.next_id = 0
+
+    async def send(self, line):
+        self.writer.write(line.encode("utf-8") + b"\n")
+        await self.writer.drain()
+        return await self.receive()
+
+    async def receive(self):
+        return json.loads(await asyncio.wait_for(self.reader.readline(), 5.0))
+
+    async def call(self, method, **params):
+        self.next_id += 1
+        return await self.send(json.dumps({"jsonrpc": "2.0", "id": self.next_id, "method": method, "params": params}))
+
+
+def serve(settings, scenario, worker=None):
+    """Runs `scenario(server, connection)` against a server on a free port"""
+    worker = worker if worker is not None else Worker()
+
+    async def main():
+        server = RemoteServer(worker, dict(settings, port=0))
+        port = await server.start()
+        connection = Connection(*await asyncio.open_connection("127.0.0.1", port))
+        try:
+            return await scenario(server, connection)
+        finally:
+            connection.writer.close()
+            await server.stop()
+    return asyncio.run(main())
+
+
+def test_login_with_the_token():
+    async def scenario(server, connection):
+        refused = await connection.call("status")
+        wrong = await connection.call("login", token="guess")
+        still_refused = await connection.call("status")
+        accepted = await connection.call("login", token="secret")
+        return refused, wrong, still_refused, accepted, await connection.call("status")
+    refused, wrong, still_refused, accepted, status = serve({"token": "secret"}, scenario)
+    assert refused["error"]["code"] == remote.REFUSED and "login" in refused["error"]["message"]
+    assert wrong["error"]["code"] == remote.REFUSED and still_refused["error"]["code"] == remote.REFUSED
+    assert accepted["result"] is True and accepted["id"] == 4
+    assert status["result"] == {"connected": False, "busy": False, "paused": False, "run": None, "scan": None}
+
+
+def test_errors_are_reported_with_their_codes():
+    async def scenario(server, connection):
+        return [await connection.send("{not json"),
+                await connection.send("[1, 2]"),
+                await connection.call("explode"),
+                await connection.call("status", verbose=True),
+                await connection.send(json.dumps({"jsonrpc": "2.0", "id": 9, "method": "subscribe", "params": [1]})),
+                await connection.call("subscribe", events=["weather"]),
+                await connection.call("submit", scan={"PhysicalSizeX": -1.0})]
+    replies = serve({}, scenario)
+    codes = [reply["error"]["code"] for reply in replies]
+    assert codes == [remote.PARSE_ERROR, remote.INVALID_REQUEST, remote.METHOD_NOT_FOUND] + [remote.INVALID_PARAMS] * 4
+    assert replies[0]["id"] is None and replies[4]["id"] == 9
+
+
+def test_submit_and_notifications():
+    worker = Worker()
+
+    async def scenario(server, connection):
+        started = await connection.call("submit", scan={"PhysicalSizeX": 5.0})
+        again = await connection.call("submit")
+        subscribed = await connection.call("subscribe", events=["step", "finished"])
+        server.on_cube("run-1")
+        server.on_step(0, 12.5)
+        server.on_progress("ignored, not subscribed")
+        server.on_finished()
+        return started, again, subscribed, await connection.receive(), await connection.receive()
+    started, again, subscribed, step, finished = serve({}, scenario, worker)
+    assert started["result"]["started"] and started["result"]["plan"]["scan"]["PhysicalSizeX"] == 5.0
+    assert worker.started[0].scan["PhysicalSizeX"] == 5.0 and len(worker.started) == 1
+    assert again["error"]["code"] == remote.REFUSED
+    assert subscribed["result"] == ["finished", "step"]
+    assert step == {"jsonrpc": "2.0", "method": "step", "params": {"run": "run-1", "step": 0, "position": 12.5}}
+    assert finished["method"] == "finished" and finished["params"] == {"run": "run-1"}
+
+
+def test_preview_frames_are_binned():
+    frame = np.arange(200 * 130, dtype=np.float64).reshape(200, 130)
+    preview = preview_frame(frame, 64)
+    assert preview.dtype == np.float32 and preview.shape == (50, 32)
+    assert preview[0, 0] == frame[:4, :4].mean()
+    assert preview_frame(frame[:10, :10], 64).shape == (10, 10)
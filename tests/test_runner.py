@@ -0,0 +1,71 @@
+import os
+
+import yaml
+import pytest
+
+import logs
+import runner
+from stepscan import StepScan
+
+RECIPE = {"defaults": {"scan": {"TargetResolutionWidth": 8, "TargetResolutionHeight": 8, "Channels": ["Z"]},
+                       "ifg": {"NumberOfPoints": 4}},
+          "jobs": [{"name": "First", "scan": {"PhysicalOffsetX": 10.0}},
+                   {"name": "Second", "scan": {"PhysicalOffsetX": 20.0}},
+                   {"name": "Single", "scan": {"PhysicalOffsetX": 30.0, "ScanMode": "WLI_single"}}]}
+
+
+@pytest.fixture
+def files(tmp_path):
+    config = {"fingerprint": "id", "path_to_dll": "sdk", "output_dir": str(tmp_path / "data"),
+              "storage": {"format": "cube"}, "tracing": {"enabled": False},
+              "logging": {"console": False, "file": None},
+              "simulation": {"scan_duration": 0.0}}
+    with open(tmp_path / "config.yaml", "w") as file:
+        yaml.safe_dump(config, file)
+    with open(tmp_path / "recipe.yaml", "w") as file:
+        yaml.safe_dump(RECIPE, file)
+    yield {"config": str(tmp_path / "config.yaml"), "recipe": str(tmp_path / "recipe.yaml"),
+           "defaults": str(tmp_path / "none.yaml"), "data": tmp_path / "data"}
+    logs.shutdown()
+
+
+def run(files, *args):
+    return runner.main([files["recipe"], "--config", files["config"], "--defaults", files["defaults"], *args])
+
+
+def test_simulated_recipe_succeeds(files):
+    assert run(files, "--simulate") == runner.EXIT_OK
+    assert len(os.listdir(files["data"])) == 3
+
+
+def test_missing_recipe_is_an_error(files):
+    files["recipe"] = files["recipe"] + ".missing"
+    assert run(files, "--simulate") == runner.EXIT_ERROR
+
+
+def test_failed_connection_is_an_error(files, monkeypatch):
+    import snom
+    # No SDK and no --simulate, the runner must not fall back to the simulator
+    monkeypatch.setattr(snom, "load_sdk", lambda: None)
+    assert run(files) == runner.EXIT_ERROR
+    assert not files["data"].exists()
+
+
+def test_failed_job_fails_the_run(files, monkeypatch):
+    original = StepScan.run
+
+    async def broken(engine):
+        if engine.name == "Second":
+            raise RuntimeError("broken")
+        return await original(engine)
+    monkeypatch.setattr(StepScan, "run", broken)
+    assert run(files, "--simulate") == runner.EXIT_FAILED
+
+
+def test_dry_run_counts_single_shot_jobs_once(files, capsys):
+    assert run(files, "--simulate", "--dry-run") == runner.EXIT_OK
+    output = capsys.readouterr().out.splitlines()
+    lines = {line.split(":")[0]: line for line in output}
+    assert "4 positions" in lines["First"]
+    assert "1 positions" in lines["Single"]
+    assert output[-1].startswith("3 jobs")
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from processing import SpectralTransform, spectral_transform
+from sampling import SampledTransform, grid_positions, sample_indices, sampled_positions
+from scanplan import ScanPlan
+
+ZPD = 180.0
+LINES = (1200.0, 1700.0)
+
+
+def interferograms(positions):
+    opd = 2.0 * (np.asarray(positions) - ZPD) * 1e-4
+    signal = sum(np.cos(2 * np.pi * line * opd) for line in LINES) + 3.0
+    return signal[:, None] * np.array([1.0, 2.0])
+
+
+def subset(ratio, mode="centerburst"):
+    ifg = ScanPlan(ifg={"StartPosition": 0.0, "EndPosition": 400.0, "NumberOfPoints": 512, "Sampling": mode,
+                        "SamplingRatio": ratio, "SamplingCenter": ZPD}).ifg
+    return dict(ifg), sample_indices(ifg)
+
+
+def test_sampled_positions_keep_the_ends_and_repeat():
+    ifg, indices = subset(0.3)
+    assert len(indices) == round(512 * 0.3)
+    assert indices[0] == 0 and indices[-1] == 511
+    assert np.array_equal(indices, subset(0.3)[1])
+    assert np.allclose(sampled_positions(ifg), grid_positions(ifg)[indices])
+    # Half of them in one block around the centre
+    middle = np.argmin(np.abs(grid_positions(ifg) - ZPD))
+    assert np.all(np.isin(np.arange(middle - 10, middle + 10), indices))
+
+
+def test_full_grid_matches_the_uniform_transform():
+    positions = np.linspace(0.0, 400.0, 512)
+    block = interferograms(positions)
+    reference = SpectralTransform(positions, ZPD).transform(block)
+    for method in ("nudft", "sparse"):
+        spectra = SampledTransform(positions, ZPD, positions, {"reconstruction": method}).transform(block)
+        assert np.allclose(spectra, reference, atol=1e-6 * np.abs(reference).max())
+
+
+@pytest.mark.parametrize("method", ["nudft", "sparse"])
+def test_undersampled_spectrum_is_recovered(method):
+    ifg, indices = subset(0.4)
+    grid = grid_positions(ifg)
+    full = SpectralTransform(grid, ZPD)
+    reference = np.real(full.transform(interferograms(grid)))
+    plan = spectral_transform(grid[indices], ZPD, {"reconstruction": method}, ifg)
+    assert isinstance(plan, SampledTransform) and np.allclose(plan.wavenumbers, full.wavenumbers)
+    spectra = np.real(plan.transform(interferograms(grid[indices])))
+    # The lines stand out at their wavenumbers with their full strength, the samples left out only add noise
+    strongest = plan.wavenumbers[np.argsort(spectra[:, 1])[-4:]]
+    assert all(min(abs(strongest - line)) < 10 for line in LINES)
+    for line in LINES:
+        near = np.abs(plan.wavenumbers - line) < 30
+        assert spectra[near, 1].max() == pytest.approx(reference[near, 1].max(), rel=0.15)
+    if method == "sparse":
+        assert np.linalg.norm(spectra - reference) / np.linalg.norm(reference) < 0.1
+
+
+def test_sparse_needs_grid_positions():
+    grid = np.linspace(0.0, 400.0, 512)
+    with pytest.raises(ValueError):
+        SampledTransform(grid[:100] + 0.3, ZPD, grid, {"reconstruction": "sparse"})
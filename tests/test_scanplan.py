@@ -0,0 +1,54 @@
+import pytest
+
+from scanplan import ScanPlan, SCAN_DEFAULTS, step_count
+
+
+def test_defaults_and_derived_ends():
+    plan = ScanPlan(ifg={"InterferometerCenter": 300.0, "InterferometerDistance": 200.0})
+    assert plan.scan["PhysicalOffsetX"] == SCAN_DEFAULTS["PhysicalOffsetX"]
+    assert (plan.ifg["StartPosition"], plan.ifg["EndPosition"]) == (400.0, 200.0)
+    assert plan.steps == plan.ifg["NumberOfPoints"]
+    assert ScanPlan({"ScanMode": "WLI_single"}).steps == 1 == step_count({"ScanMode": "WLI_single"}, plan.ifg)
+
+
+def test_every_problem_is_reported():
+    with pytest.raises(ValueError) as error:
+        ScanPlan({"PhysicalSizeX": -1.0, "TargetResolutionWidth": 2.5, "Channels": ["Z", "Q9"], "DataFormat": "int8"},
+                 {"StartPosition": 900.0, "EndPosition": 0.0, "Sampling": "random", "SamplingRatio": 0.0})
+    message = str(error.value)
+    for problem in ("PhysicalSizeX", "TargetResolutionWidth", "Q9", "DataFormat", "StartPosition", "SamplingRatio"):
+        assert problem in message
+    with pytest.raises(ValueError, match="not a number"):
+        ScanPlan({"PhysicalOffsetX": "fifty"})
+    with pytest.raises(ValueError, match="twice"):
+        ScanPlan({"Channels": ["Z", "Z"]})
+
+
+def test_plans_are_immutable():
+    plan = ScanPlan()
+    with pytest.raises(AttributeError):
+        plan.scan = {}
+    with pytest.raises(TypeError):
+        plan.scan["PhysicalSizeX"] = 2.0
+    # Parameters handed out are copies, changing them leaves the plan as it was
+    parameters = plan.to_parameters()
+    parameters["scan"]["Channels"].append("O2A")
+    assert plan.scan["Channels"] == SCAN_DEFAULTS["Channels"]
+    assert ScanPlan.from_parameters(plan.to_parameters()) == plan
+    assert hash(ScanPlan.from_parameters(plan.to_parameters())) == hash(plan)
+
+
+def test_with_changes_and_diff():
+    plan = ScanPlan()
+    assert plan.with_changes(scan={"PhysicalSizeX": plan.scan["PhysicalSizeX"]}) is plan
+    moved = plan.with_changes(scan={"PhysicalSizeX": 5.0}, ifg={"InterferometerCenter": 300.0, "InterferometerDistance": 400.0})
+    assert plan.scan["PhysicalSizeX"] == SCAN_DEFAULTS["PhysicalSizeX"]
+    assert (moved.ifg["StartPosition"], moved.ifg["EndPosition"]) == (500.0, 100.0)
+    changes = moved.diff(plan)
+    assert changes["scan.PhysicalSizeX"] == (5.0, plan.scan["PhysicalSizeX"])
+    assert changes["ifg.InterferometerCenter"] == (300.0, plan.ifg["InterferometerCenter"])
+    assert "ifg.StartPosition" in changes and "scan.PhysicalSizeY" not in changes
+    assert plan.diff(plan) == {}
+    assert set(plan.diff(None)) >= {"scan.PhysicalSizeX", "ifg.NumberOfPoints"}
+    with pytest.raises(ValueError):
+        plan.with_changes(scan={"TargetResolutionWidth": 0})
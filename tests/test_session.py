@@ -0,0 +1,142 @@
+import asyncio
+
+import pytest
+
+import session as session_module
+from session import Session
+
+
+class FlakySNOM():
+    """Connects only after `failures` refused attempts, counts the calls"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.connected = False
+        self.connects = 0
+        self.spawns = 0
+
+    async def connect(self, path_to_dll, fingerprint):
+        self.connects += 1
+        if self.failures > 0:
+            self.failures -= 1
+            return False
+        self.connected = True
+        return True
+
+    def default_parameters(self):
+        return None
+
+    def spawn_parameters(self):
+        self.spawns += 1
+
+    def close(self):
+        self.connected = False
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    waited = []
+    sleep = asyncio.sleep
+
+    async def recorded(delay):
+        waited.append(delay)
+        await sleep(0)
+    monkeypatch.setattr(session_module.asyncio, "sleep", recorded)
+    return waited
+
+
+def test_reconnect_backs_off_exponentially(delays):
+    snom = FlakySNOM()
+    states = []
+    settings = {"heartbeat_interval": None, "backoff_initial": 1.0, "backoff_max": 5.0, "reconnect_attempts": 10}
+    instrument = Session(snom, "sdk", "id", settings, on_state=states.append)
+
+    async def scenario():
+        await instrument.connect()
+        snom.failures = 5
+        await instrument.reconnect()
+    asyncio.run(scenario())
+    assert delays == [1.0, 2.0, 4.0, 5.0, 5.0]
+    assert snom.connects == 7 and snom.connected
+    assert instrument.reconnects == 1
+    assert states == [True, False, True]
+
+
+def test_reconnect_gives_up(delays):
+    snom = FlakySNOM()
+    instrument = Session(snom, "sdk", "id", {"heartbeat_interval": None, "reconnect_attempts": 3})
+
+    async def scenario():
+        await instrument.connect()
+        snom.failures = 100
+        with pytest.raises(ConnectionError):
+            await instrument.reconnect()
+    asyncio.run(scenario())
+    assert snom.connects == 1 + 3
+    assert delays == [1.0, 2.0]
+
+
+def test_concurrent_callers_share_one_reconnect(delays):
+    snom = FlakySNOM()
+    instrument = Session(snom, "sdk", "id", {"heartbeat_interval": None})
+
+    async def scenario():
+        await instrument.connect()
+        snom.failures = 2
+        await asyncio.gather(instrument.reconnect(), instrument.reconnect(), instrument.reconnect())
+    asyncio.run(scenario())
+    assert snom.connects == 1 + 3
+    assert instrument.reconnects == 1
+
+
+def test_heartbeat_notices_a_drop_but_not_during_a_run():
+    snom = FlakySNOM()
+    instrument = Session(snom, "sdk", "id", {"heartbeat_interval": 0.01, "backoff_initial": 0.01})
+
+    async def scenario():
+        await instrument.connect()
+        await asyncio.sleep(0.05)
+        assert snom.spawns > 0 and instrument.last_heartbeat is not None
+        instrument.active_runs = 1
+        spawns = snom.spawns
+        await asyncio.sleep(0.05)
+        assert snom.spawns == spawns
+        instrument.active_runs = 0
+        snom.connected = False
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if instrument.reconnects:
+                break
+        await instrument.close()
+    asyncio.run(scenario())
+    assert instrument.reconnects == 1
+    assert not snom.connected
+
+
+def test_run_continues_after_a_drop(delays):
+    snom = FlakySNOM()
+    instrument = Session(snom, "sdk", "id", {"heartbeat_interval": None, "run_retries": 2})
+
+    class Engine():
+        def __init__(self, fail):
+            self.fail = fail
+            self.run_dir = "run"
+            self.cube = object()
+
+        async def run(self):
+            if self.fail:
+                snom.connected = False
+                raise ConnectionError("dropped")
+            return "result"
+    resumed = []
+
+    def resume(run_dir):
+        resumed.append(run_dir)
+        return Engine(False)
+
+    async def scenario():
+        await instrument.connect()
+        return await instrument.run(Engine(True), resume)
+    assert asyncio.run(scenario()) == "result"
+    assert resumed == ["run"]
+    assert instrument.reconnects == 1 and instrument.active_runs == 0
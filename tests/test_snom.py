@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+
+import nea_sim
+import snom
+
+
+def test_simulator_only_on_request(monkeypatch):
+    monkeypatch.setattr(snom, "load_sdk", lambda: None)
+    config = {"simulate": False, "path_to_dll": "sdk", "fingerprint": "id"}
+    assert not snom.simulated(config)
+    assert isinstance(snom.create_snom(config), snom.neaSNOM)
+    assert snom.instrument_id(config) == "id"
+    assert isinstance(snom.create_snom(config, offline=True), nea_sim.SimulatedSNOM)
+    assert isinstance(snom.create_snom(dict(config, simulate=True)), nea_sim.SimulatedSNOM)
+
+
+def test_missing_sdk_is_a_connection_error(monkeypatch):
+    monkeypatch.setattr(snom, "load_sdk", lambda: None)
+    instrument = snom.create_snom({"path_to_dll": "sdk", "fingerprint": "id"})
+    with pytest.raises(ConnectionError):
+        asyncio.run(instrument.connect("sdk", "id"))
+    assert not instrument.connected
+
+
+def test_simulated_runs_are_marked(tmp_path):
+    from datacube import DataCube
+    from scanplan import ScanPlan
+    from stepscan import StepScan
+
+    plan = ScanPlan({"TargetResolutionWidth": 8, "TargetResolutionHeight": 8, "Channels": ["Z"]}, {"NumberOfPoints": 3})
+    instrument = nea_sim.SimulatedSNOM({"scan_duration": 0.0, "seed": 0})
+    asyncio.run(instrument.connect("", ""))
+    engine = StepScan(instrument, plan.to_parameters(), output_dir=str(tmp_path), storage_settings={"format": "cube"})
+    asyncio.run(engine.run())
+    cube = DataCube.open(engine.run_dir)
+    assert cube.meta["metadata"]["simulated"] is True
+    cube.close()
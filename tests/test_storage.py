@@ -0,0 +1,54 @@
+import json
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip("h5py")
+
+import storage
+from datacube import DataCube
+
+
+def test_export_keeps_nested_list_metadata_as_json(tmp_path):
+    metadata = {"name": "Nested", "records": [{"step": 0, "drift": [0.1, 0.2]}, {"step": 1, "peak": None}],
+                "mixed": [1, "a", None], "scan": {"PhysicalSizeX": 20.0, "Channels": ["Z", "M1A"]}}
+    cube = DataCube.create(str(tmp_path / "run"), ["Z"], np.arange(3.0), 4, 4, metadata=metadata)
+    for step in range(3):
+        cube.write_frame("Z", step, np.full((4, 4), float(step)))
+        cube.mark_done(step)
+    path = str(tmp_path / "result.h5")
+    storage.export_hdf5(cube, path)
+    cube.close()
+
+    with h5py.File(path, "r") as file:
+        parameters = file["parameters"]
+        assert json.loads(parameters.attrs["records"]) == metadata["records"]
+        assert json.loads(parameters.attrs["mixed"]) == metadata["mixed"]
+        assert parameters["scan"].attrs["PhysicalSizeX"] == 20.0
+    assert np.array_equal(storage.load_channel(path, "Z")[2], np.full((4, 4), 2.0))
+
+
+def test_discard_leaves_mapped_files_for_later(tmp_path, monkeypatch):
+    import datacube
+
+    cube = DataCube.create(str(tmp_path / "run"), ["Z"], np.arange(2.0), 4, 4)
+    cube.write_frame("Z", 0, np.ones((4, 4)))
+    cube.mark_done(0)
+    remove = datacube.os.remove
+
+    def locked(path):
+        # As on Windows while the preview still maps the cube
+        if path.endswith(datacube.CUBE_FILE):
+            raise PermissionError(path)
+        remove(path)
+    monkeypatch.setattr(datacube.os, "remove", locked)
+    path = storage.save_cube(cube, {"keep_cube": False})
+    assert path.endswith(storage.RESULT_FILE)
+    with open(tmp_path / "run" / datacube.META_FILE) as file:
+        assert json.load(file)["discarded"] == [datacube.CUBE_FILE]
+
+    monkeypatch.setattr(datacube.os, "remove", remove)
+    datacube.remove_discarded(str(tmp_path))
+    assert not (tmp_path / "run" / datacube.CUBE_FILE).exists()
+    with open(tmp_path / "run" / datacube.META_FILE) as file:
+        assert "discarded" not in json.load(file)
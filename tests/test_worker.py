@@ -0,0 +1,76 @@
+import time
+import threading
+
+import pytest
+
+pytest.importorskip("PySide6")
+
+from PySide6 import QtCore
+
+import nea_sim
+from scanplan import ScanPlan
+from ScannerApp import Worker
+
+
+def wait_until(condition, timeout=10.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def worker(tmp_path):
+    snom = nea_sim.SimulatedSNOM({"scan_duration": 0.05})
+    worker = Worker(snom)
+    worker.output_dir = str(tmp_path)
+    worker.storage_settings = {"format": "cube"}
+    worker.plan = ScanPlan({"TargetResolutionWidth": 8, "TargetResolutionHeight": 8, "Channels": ["Z"]}, {"NumberOfPoints": 200})
+    finished = threading.Event()
+    # No Qt event loop runs here, the signal is taken in the emitting thread
+    worker.finished.connect(finished.set, QtCore.Qt.DirectConnection)
+    worker.finished_event = finished
+    yield worker
+    worker.shutdown()
+
+
+def test_busy_until_the_cancelled_scan_has_cleaned_up(worker):
+    worker.connect_snom("", "")
+    wait_until(lambda: worker.snom.connected)
+    assert worker.run_measurement()
+    wait_until(lambda: worker.engine.current_step > 1)
+    assert not worker.run_measurement()
+    worker.cancel_measurement()
+    # Still busy while the scan unwinds, idle only with the cube closed
+    assert worker.busy
+    assert worker.finished_event.wait(10.0)
+    assert not worker.busy
+    assert worker.engine.cube.data is None
+
+
+def test_cancel_right_after_start_still_finishes(worker):
+    worker.connect_snom("", "")
+    wait_until(lambda: worker.snom.connected)
+    assert worker.run_measurement()
+    worker.cancel_measurement()
+    assert worker.finished_event.wait(10.0)
+    assert not worker.busy
+
+
+def test_disconnect_waits_for_the_scan(worker):
+    closed = []
+    close = worker.snom.close
+
+    def record_close():
+        closed.append(worker.engine.active)
+        close()
+    worker.snom.close = record_close
+    worker.connect_snom("", "")
+    wait_until(lambda: worker.session_open)
+    assert worker.run_measurement()
+    wait_until(lambda: worker.engine.active)
+    worker.disconnect_snom()
+    wait_until(lambda: closed)
+    # The scan had stopped before the connection was closed
+    assert closed == [False]
+    assert worker.finished_event.wait(10.0)
@@ -0,0 +1,89 @@
+import time
+import asyncio
+
+import numpy as np
+import pytest
+
+from checkpoint import Journal
+from datacube import DataCube
+from writer import StepWriter, restore_mirror
+
+CHANNELS = ["Z", "O2A"]
+HEIGHT, WIDTH, STEPS = 6, 5, 10
+
+
+def frames(step):
+    rng = np.random.default_rng(step)
+    return {channel: rng.normal(scale=10.0, size=(HEIGHT, WIDTH)) for channel in CHANNELS}
+
+
+def cube(path, dtype=np.float32):
+    return DataCube.create(str(path), CHANNELS, np.linspace(0.0, 100.0, STEPS), HEIGHT, WIDTH, dtype=dtype)
+
+
+def write_all(writer, delay=0.0):
+    async def scenario():
+        writer.start()
+        for step in range(STEPS):
+            await writer.put(step, float(step), frames(step))
+            await asyncio.sleep(delay)
+        await writer.close()
+    asyncio.run(scenario())
+
+
+def test_full_queue_holds_up_the_producer(tmp_path):
+    target = cube(tmp_path)
+    journal = Journal(str(tmp_path))
+    # Two steps fit in the queue, the writer takes 20 ms per frame
+    step_bytes = len(CHANNELS) * HEIGHT * WIDTH * 8
+    written = []
+    writer = StepWriter(target, journal, {"queue_bytes": 2 * step_bytes}, written=lambda step, position: written.append(step))
+    original = target.write_frame
+
+    def slow(channel, step, frame):
+        time.sleep(0.02)
+        original(channel, step, frame)
+    target.write_frame = slow
+    write_all(writer)
+    assert writer.capacity == 2
+    assert 0 < writer.max_depth <= writer.capacity
+    assert writer.blocked > 0.1
+    assert written == list(range(STEPS)) and writer.error is None
+    assert target.completed_steps().tolist() == list(range(STEPS))
+    assert journal.completed_steps(target) == set(range(STEPS))
+    journal.close()
+    target.close()
+
+
+def test_failed_write_does_not_block_the_producer(tmp_path):
+    target = cube(tmp_path)
+    journal = Journal(str(tmp_path))
+    writer = StepWriter(target, journal, {"queue_bytes": 1})
+
+    def broken(channel, step, frame):
+        raise OSError("disk full")
+    target.write_frame = broken
+    write_all(writer)
+    assert isinstance(writer.error, OSError)
+    assert target.completed_steps().tolist() == []
+    journal.close()
+    target.close()
+
+
+@pytest.mark.parametrize("dtype, codec", [(np.float32, "zlib"), (np.int16, "zlib"), (np.float64, None)])
+def test_mirror_restores_the_cube(tmp_path, dtype, codec):
+    target = cube(tmp_path / "runs" / "run", dtype)
+    journal = Journal(target.path)
+    writer = StepWriter(target, journal, {"mirror": str(tmp_path / "nas"), "mirror_compression": codec})
+    write_all(writer)
+    assert writer.mirror is None
+    journal.close()
+
+    restored = restore_mirror(str(tmp_path / "nas" / "run"), str(tmp_path / "restored"))
+    assert restored.channels == target.channels and restored.data.dtype == target.data.dtype
+    assert restored.completed_steps().tolist() == list(range(STEPS))
+    assert np.array_equal(restored.data, target.data)
+    for step in (0, STEPS - 1):
+        assert np.array_equal(restored.frame("O2A", step), target.frame("O2A", step))
+    restored.close()
+    target.close()
@@ -0,0 +1,113 @@
+"""
+Per-phase tracing of the acquisition pipeline
+Records spans with their duration, thread and bytes moved and exports them as Chrome trace (chrome://tracing, Perfetto) JSON
+"""
+
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+
+import numpy as np
+import logging
+
+logger = logging.getLogger('logger.tracing')
+
+TRACE_FILE = "trace.json"
+SUMMARY_FILE = "trace_summary.json"
+
+
+class Span():
+
+    __slots__ = ("tracer", "name", "args", "start", "duration")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+        self.duration = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.record(self.name, self.start, self.duration, **self.args)
+        return False
+
+
+class Tracer():
+    """Collects spans from any thread
+
+    Use as `with tracer.span("download", step=3, channel="M1A") as span: span.args["bytes"] = n`.
+    The span keeps its duration after the block, so callers can reuse the measurement.
+    """
+
+    def __init__(self, enabled=True, histograms=True):
+        self.enabled = enabled
+        self.histograms = histograms
+        self.events = []
+        self._lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def span(self, name, **args):
+        return Span(self, name, args)
+
+    def record(self, name, start, duration, **args):
+        if not self.enabled:
+            return
+        event = (name, start, duration, threading.get_ident(), threading.current_thread().name, args)
+        with self._lock:
+            self.events.append(event)
+
+    def chrome_trace(self):
+        with self._lock:
+            events = list(self.events)
+        threads = {}
+        trace = []
+        for name, start, duration, tid, thread_name, args in events:
+            threads[tid] = thread_name
+            trace.append({"name": name, "cat": "acquisition", "ph": "X", "pid": self.pid, "tid": tid,
+                          "ts": start * 1e6, "dur": duration * 1e6, "args": args})
+        for tid, thread_name in threads.items():
+            trace.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": thread_name}})
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+    def summary(self, bins=20):
+        """Total, count, mean and bytes per span name, plus a duration histogram per name when enabled"""
+        durations = defaultdict(list)
+        moved = defaultdict(int)
+        with self._lock:
+            events = list(self.events)
+        for name, start, duration, tid, thread_name, args in events:
+            durations[name].append(duration)
+            moved[name] += int(args.get("bytes", 0))
+        wall = (max(s + d for _, s, d, *_ in events) - min(s for _, s, *_ in events)) if events else 0.0
+        spans = {}
+        for name, values in durations.items():
+            values = np.asarray(values)
+            entry = {"count": len(values), "total": float(values.sum()), "mean": float(values.mean()),
+                     "max": float(values.max()), "bytes": moved[name]}
+            if moved[name] and values.sum() > 0:
+                entry["MB_per_s"] = moved[name] / values.sum() / 1e6
+            if self.histograms and len(values) > 1:
+                counts, edges = np.histogram(values, bins=min(bins, len(values)))
+                entry["histogram"] = {"counts": counts.tolist(), "edges": edges.tolist()}
+            spans[name] = entry
+        return {"wall_time": wall, "spans": spans}
+
+    def export(self, directory):
+        if not self.enabled or not self.events:
+            return None
+        path = os.path.join(directory, TRACE_FILE)
+        with open(path, 'w') as file:
+            json.dump(self.chrome_trace(), file)
+        with open(os.path.join(directory, SUMMARY_FILE), 'w') as file:
+            json.dump(self.summary(), file, indent=1)
+        logger.info("Trace written to %s", path)
+        return path
@@ -0,0 +1,291 @@
+"""
+Background writer of step scans
+Takes the downloaded frames off the acquisition path: a bounded queue feeds one writer thread that fills the data cube,
+checkpoints the step and optionally streams it losslessly compressed to a mirror folder, e.g. on the NAS
+
+    python writer.py <mirror run folder> <new run folder>     # rebuilds the data cube of a run from its mirror
+"""
+
+import os
+import sys
+import json
+import zlib
+import shutil
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import logging
+
+from datacube import DataCube, META_FILE
+from tracing import Tracer
+
+logger = logging.getLogger('logger.writer')
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+DEFAULT_SETTINGS = {"queue_bytes": 256 << 20,       # frames waiting to be written at most, then the download waits
+                    "mirror": None,                 # folder every step is also streamed to, e.g. on the NAS
+                    "mirror_compression": "zstd",   # zstd, blosc, zlib or None, all lossless
+                    "mirror_level": 3,
+                    "compression_threads": 2}       # channels of a step compressed at the same time
+
+FRAMES_FILE = "frames.bin"
+INDEX_FILE = "index.jsonl"
+
+
+def compressor(name, level=DEFAULT_SETTINGS["mirror_level"]):
+    """(name, compress(data, itemsize)) of a codec, zlib when the module of the requested one is missing"""
+    if name == "zstd" and zstandard is not None:
+        # Compressor objects are not thread-safe, every call makes its own
+        return name, lambda data, itemsize: zstandard.ZstdCompressor(level=level).compress(data)
+    if name == "blosc" and blosc is not None:
+        return name, lambda data, itemsize: blosc.compress(data, typesize=itemsize, clevel=level, shuffle=blosc.SHUFFLE)
+    if name is None:
+        return None, lambda data, itemsize: data
+    if name not in ("zstd", "blosc", "zlib"):
+        raise ValueError(f"Unknown mirror compression {name}, use zstd, blosc, zlib or None")
+    if name != "zlib":
+        logger.warning("%s module not found, the mirror is compressed with zlib", name)
+    # zlib releases the GIL while it compresses, the threads still run side by side
+    return "zlib", lambda data, itemsize: zlib.compress(data, level)
+
+
+def _decompressor(name):
+    if name == "zstd":
+        if zstandard is None:
+            raise ImportError("zstandard is required to read this mirror")
+        return zstandard.ZstdDecompressor().decompress
+    if name == "blosc":
+        if blosc is None:
+            raise ImportError("blosc is required to read this mirror")
+        return blosc.decompress
+    return zlib.decompress if name == "zlib" else (lambda data: data)
+
+
+class Mirror():
+    """Append-only copy of the steps of a run in another folder, written as the scan goes
+
+    Every channel frame is compressed on its own and appended to frames.bin, then described by one
+    line of index.jsonl, as stored in the cube (integer cubes with their offset and scale).
+    A resumed run appends to the same files, the last record of a frame wins.
+    """
+
+    def __init__(self, root, cube, settings):
+        self.path = os.path.join(root, os.path.basename(os.path.normpath(cube.path)))
+        os.makedirs(self.path, exist_ok=True)
+        shutil.copy2(os.path.join(cube.path, META_FILE), os.path.join(self.path, META_FILE))
+        self.codec, self.compress = compressor(settings["mirror_compression"], settings["mirror_level"])
+        self.pool = ThreadPoolExecutor(max_workers=max(1, int(settings["compression_threads"])), thread_name_prefix="compress")
+        self.frames = open(os.path.join(self.path, FRAMES_FILE), "ab")
+        self.index = open(os.path.join(self.path, INDEX_FILE), "a")
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def write(self, cube, step):
+        frames = [np.ascontiguousarray(cube.data[index, step]) for index in range(len(cube.channels))]
+        blobs = list(self.pool.map(lambda frame: self.compress(frame.tobytes(), frame.itemsize), frames))
+        records = []
+        for index, (frame, blob) in enumerate(zip(frames, blobs)):
+            record = {"step": int(step), "channel": cube.channels[index], "offset": self.frames.tell(), "length": len(blob),
+                      "codec": self.codec}
+            if cube.scales is not None:
+                record["scale"] = [float(value) for value in cube.scales[index, step]]
+            self.frames.write(blob)
+            records.append(record)
+            self.bytes_in += frame.nbytes
+            self.bytes_out += len(blob)
+        # The index only ever points at data that was written out
+        self.frames.flush()
+        self.index.write("".join(json.dumps(record) + "\n" for record in records))
+        self.index.flush()
+
+    def finish(self, cube):
+        """Copy the final metadata of the run"""
+        shutil.copy2(os.path.join(cube.path, META_FILE), os.path.join(self.path, META_FILE))
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.frames.close()
+        self.index.close()
+
+
+def restore_mirror(mirror_path, run_dir):
+    """Rebuild the data cube of a run in `run_dir` from its mirror"""
+    with open(os.path.join(mirror_path, META_FILE), "r") as file:
+        meta = json.load(file)
+    records = {}
+    with open(os.path.join(mirror_path, INDEX_FILE), "r") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("Ignoring damaged index line in %s", mirror_path)
+                continue
+            records[(record["step"], record["channel"])] = record
+    channels, steps, height, width = meta["shape"]
+    cube = DataCube.create(run_dir, meta["channels"], meta["positions"], height, width, dtype=np.dtype(meta["dtype"]),
+                           metadata=meta["metadata"])
+    complete = {}
+    with open(os.path.join(mirror_path, FRAMES_FILE), "rb") as file:
+        for (step, channel), record in sorted(records.items()):
+            file.seek(record["offset"])
+            data = _decompressor(record["codec"])(file.read(record["length"]))
+            index = cube.channel_index(channel)
+            cube.data[index, step] = np.frombuffer(data, dtype=cube.data.dtype).reshape(height, width)
+            if "scale" in record:
+                cube.scales[index, step] = record["scale"]
+            complete[step] = complete.get(step, 0) + 1
+    for step, count in complete.items():
+        if count == len(cube.channels):
+            cube.mark_done(step)
+    logger.info("Restored %d/%d steps of %s into %s", len(cube.completed_steps()), steps, mirror_path, run_dir)
+    return cube
+
+
+class StepWriter():
+    """Writes the downloaded steps into the cube on a thread of its own, fed by a bounded queue
+
+    put() returns as soon as a step is queued. It only waits while queue_bytes of frames are
+    already waiting, that wait is the backpressure on the download and, through the hand-off to
+    the download, on the acquisition. written(step, position) is called in the loop once a step
+    is on disk and checkpointed. A failing mirror is dropped, the scan carries on without it.
+    """
+
+    def __init__(self, cube, journal, settings=None, tracer=None, written=None):
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update({key: value for key, value in (settings or {}).items() if key in DEFAULT_SETTINGS})
+        self.cube = cube
+        self.journal = journal
+        self.tracer = tracer if tracer is not None else Tracer(enabled=False)
+        self.written = written
+        # Frames arrive as the SDK delivers them, counted at 8 bytes per value
+        channels, steps, height, width = cube.shape
+        self.capacity = max(1, int(self.settings["queue_bytes"] // (channels * height * width * 8)))
+        self.queue = None
+        self.error = None
+        self.max_depth = 0
+        self.blocked = 0.0
+        self.written_bytes = 0
+        self.step_bytes = channels * height * width * cube.data.dtype.itemsize
+        self.mirror = None
+        self._task = None
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+
+    @property
+    def depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def start(self):
+        if self.settings["mirror"]:
+            try:
+                self.mirror = Mirror(self.settings["mirror"], self.cube, self.settings)
+            except OSError as e:
+                logger.error("Cannot mirror %s to %s: %s", self.cube.path, self.settings["mirror"], e)
+        self.queue = asyncio.Queue(maxsize=self.capacity)
+        self._task = asyncio.create_task(self._run())
+
+    async def put(self, step, position, frames, drift=None):
+        if self.queue.full():
+            logger.debug("Writer queue full (%d steps), step %d waits", self.capacity, step)
+            with self.tracer.span("backpressure", step=step) as span:
+                await self.queue.put((step, position, frames, drift))
+            self.blocked += span.duration
+        else:
+            self.queue.put_nowait((step, position, frames, drift))
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    async def close(self):
+        """Write everything still queued"""
+        await self.queue.put(None)
+        await self._task
+        await asyncio.get_running_loop().run_in_executor(self._thread, self._finish)
+        self._thread.shutdown(wait=False)
+
+    async def abort(self):
+        """Drop the queued steps and wait for the one being written, they are acquired again on resume"""
+        if self._task is None:
+            return
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+        await asyncio.gather(self._task, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(self._thread, self._finish)
+        self._thread.shutdown(wait=False)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            # After a failure the queue is only drained, so put() never waits on a dead writer
+            if self.error is not None:
+                continue
+            try:
+                await loop.run_in_executor(self._thread, self._write, *item)
+            except Exception as e:
+                logger.error("Failed to write step %d: %s", item[0], e, extra={"step": item[0]})
+                self.error = e
+                continue
+            if self.written is not None:
+                self.written(item[0], item[1])
+
+    def _write(self, step, position, frames, drift):
+        for channel, frame in frames.items():
+            with self.tracer.span("write", step=step, channel=channel):
+                self.cube.write_frame(channel, step, frame)
+        with self.tracer.span("flush", step=step):
+            self.cube.mark_done(step)
+            self.journal.record_step(self.cube, step, position)
+            if drift is not None:
+                self.journal.write("drift", **drift)
+        self.written_bytes += self.step_bytes
+        if self.mirror is not None:
+            try:
+                with self.tracer.span("mirror", step=step):
+                    self.mirror.write(self.cube, step)
+            except OSError as e:
+                logger.error("Mirroring to %s failed, continuing without it: %s", self.mirror.path, e)
+                self.mirror.close()
+                self.mirror = None
+
+    def _finish(self):
+        if self.mirror is None:
+            return
+        try:
+            self.mirror.finish(self.cube)
+            if self.mirror.bytes_in:
+                logger.info("Mirrored %s to %s, %.1f MB compressed %.1fx", self.cube.path, self.mirror.path,
+                            self.mirror.bytes_out / 1e6, self.mirror.bytes_in / max(1, self.mirror.bytes_out))
+        except OSError as e:
+            logger.error("Could not finish the mirror %s: %s", self.mirror.path, e)
+        self.mirror.close()
+        self.mirror = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mirror", help="mirror folder of a run")
+    parser.add_argument("run", help="new run folder for the data cube")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('logger').setLevel(logging.INFO)
+
+    if os.path.exists(os.path.join(args.run, META_FILE)):
+        parser.error(f"{args.run} already holds a data cube")
+    restore_mirror(args.mirror, args.run).close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())